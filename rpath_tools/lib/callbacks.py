@@ -33,6 +33,8 @@ class JsonUpdateCallback(updatecmd.JsonUpdateCallback):
     def __init__(self, job):
         updatecmd.JsonUpdateCallback.__init__(self)
         self.job = job
+        # Progress messages are frequent, write them in batches
+        self.job.bufferLogs()
         self.out = self.LogStream(job)
 
     def _message(self, text):
@@ -42,6 +44,7 @@ class JsonUpdateCallback(updatecmd.JsonUpdateCallback):
 
     def done(self):
         self.out.write("Done")
+        self.job.flushLogs()
     updateDone = done
 
 
@@ -55,6 +58,8 @@ class UpdateCallback(updatecmd.UpdateCallback):
     def __init__(self, job):
         updatecmd.UpdateCallback.__init__(self)
         self.job = job
+        # Progress messages are frequent, write them in batches
+        self.job.bufferLogs()
         self.out = self.LogStream(job)
 
     def _message(self, text):
@@ -64,6 +69,7 @@ class UpdateCallback(updatecmd.UpdateCallback):
 
     def done(self):
         self.job.logs.add("Done")
+        self.job.flushLogs()
     updateDone = done
 
 
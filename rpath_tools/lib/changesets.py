@@ -0,0 +1,536 @@
+#!/usr/bin/python
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Helpers for dealing with the changesets of update jobs.
+"""
+
+import errno
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from conary import callbacks
+from conary.lib import util
+
+from rpath_tools.lib import concurrency
+
+logger = logging.getLogger(__name__)
+
+
+def jobKey(job):
+    """
+    Return a string uniquely identifying a job tuple
+    (name, (oldVersion, oldFlavor), (newVersion, newFlavor), isAbsolute).
+    Versions are frozen, so the key includes the repository they come from.
+    """
+    name, (oldVersion, oldFlavor), (newVersion, newFlavor), isAbsolute = job
+    return '%s=%s[%s]--%s[%s]%s' % (name,
+        oldVersion is not None and oldVersion.freeze() or '',
+        oldFlavor is not None and oldFlavor.freeze() or '',
+        newVersion is not None and newVersion.freeze() or '',
+        newFlavor is not None and newFlavor.freeze() or '',
+        isAbsolute and '*' or '')
+
+
+def jobListDigest(jobList):
+    """
+    Return a hex digest identifying a list of jobs, independently of the
+    order of the jobs.
+    """
+    return hashlib.sha1('\n'.join(sorted(jobKey(x)
+        for x in jobList))).hexdigest()
+
+
+class ChangeSetSizeCache(object):
+    """
+    Persistent cache of the changeset size for individual jobs, as
+    returned by the repository's C{getChangeSetSize}.
+    @cvar maxEntries: number of entries kept; the least recently used
+    ones are dropped beyond that
+    """
+    maxEntries = 50000
+
+    def __init__(self, path):
+        self.path = path
+        self._entries = None
+        self._modified = False
+
+    def split(self, jobs):
+        """
+        Split C{jobs} into the list of known sizes and the list of jobs
+        whose size is unknown.
+        """
+        entries = self._load()
+        now = time.time()
+        sizes = []
+        missing = []
+        for job in jobs:
+            entry = entries.get(jobKey(job))
+            if entry is None:
+                missing.append(job)
+                continue
+            entry[1] = now
+            sizes.append(entry[0])
+        return sizes, missing
+
+    def update(self, jobSizes):
+        """Record (job, size) pairs"""
+        entries = self._load()
+        now = time.time()
+        for job, size in jobSizes:
+            entries[jobKey(job)] = [ size, now ]
+            self._modified = True
+
+    def save(self):
+        if not self._modified:
+            return
+        entries = self._load()
+        if len(entries) > self.maxEntries:
+            keep = sorted(entries.iteritems(), key=lambda x: x[1][1],
+                reverse=True)[:self.maxEntries]
+            entries = self._entries = dict(keep)
+        dirName = os.path.dirname(self.path)
+        util.mkdirChain(dirName)
+        fd, tmpPath = tempfile.mkstemp(dir=dirName,
+            prefix='.' + os.path.basename(self.path) + '.')
+        try:
+            f = os.fdopen(fd, 'w')
+            try:
+                json.dump(entries, f, separators=(',', ':'))
+            finally:
+                f.close()
+            os.rename(tmpPath, self.path)
+        except:
+            os.unlink(tmpPath)
+            raise
+        self._modified = False
+
+    def _load(self):
+        if self._entries is not None:
+            return self._entries
+        try:
+            self._entries = dict((str(k), v)
+                for k, v in json.load(file(self.path)).iteritems())
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            self._entries = {}
+        except (ValueError, AttributeError):
+            logger.warning("Ignoring corrupted changeset size cache %s",
+                self.path)
+            self._entries = {}
+        return self._entries
+
+
+class ChangeSetStore(object):
+    """
+    Changesets shared between update jobs, addressed by the digest of
+    their job list (see L{jobListDigest}).
+
+    Changesets are hard-linked into the jobs' download directories, so a
+    changeset is only stored once no matter how many jobs use it. The link
+    count doubles as a reference count: entries still linked from a job
+    are never evicted, and they become evictable once the job expires and
+    is removed. Unreferenced entries are evicted least recently used first
+    when the store grows over C{maxSize} bytes.
+
+    The size and SHA-1 digest of every entry's contents are recorded next
+    to it when it is added, along with the entry's inode and modification
+    time. Before an entry is reused its size is checked, and its contents
+    are only hashed again if the inode or modification time changed;
+    entries that do not match are dropped. Entries are marked as used by
+    touching their info file, so that the entries themselves keep their
+    modification time. Adding and fetching entries hold a shared lock on
+    the store, evicting holds it exclusively, so an entry never disappears
+    between being checked and being linked.
+    """
+    maxSize = 2 * 1024 * 1024 * 1024
+    lockName = '.lock'
+    entrySuffix = '.ccs'
+    infoSuffix = '.info'
+
+    def __init__(self, path, maxSize=None):
+        self.path = path
+        if maxSize is not None:
+            self.maxSize = maxSize
+
+    def _entryPath(self, digest):
+        return os.path.join(self.path, digest[:2], digest + self.entrySuffix)
+
+    def fetch(self, digest, dest):
+        """
+        Link the changeset for C{digest} to C{dest}. Return False if the
+        store does not have it, or its entry is damaged.
+        """
+        entry = self._entryPath(digest)
+        lock = self._lock(fcntl.LOCK_SH)
+        try:
+            if not os.path.exists(entry):
+                return False
+            if not self._verify(entry):
+                logger.warning("Dropping damaged changeset store entry %s",
+                    entry)
+                self._remove(entry)
+                return False
+            self._link(entry, dest)
+            # Mark it as recently used
+            os.utime(entry + self.infoSuffix, None)
+            return True
+        finally:
+            lock.close()
+
+    def add(self, digest, src):
+        """Add the changeset file C{src} to the store"""
+        entry = self._entryPath(digest)
+        dirName = os.path.dirname(entry)
+        sha1 = self._sha1(src)
+        lock = self._lock(fcntl.LOCK_SH)
+        try:
+            util.mkdirChain(dirName)
+            # The info file goes first, so an entry always has one. The
+            # entry is normally a hard link to src, with the same inode
+            # and modification time; otherwise it is hashed once more the
+            # first time it is fetched.
+            self._writeInfo(entry, os.stat(src), sha1)
+            self._writeAtomic(entry, lambda path: self._link(src, path))
+        finally:
+            lock.close()
+
+    def evict(self):
+        """
+        Remove unreferenced entries until the store fits in C{maxSize}.
+        Return the number of bytes freed.
+        """
+        lock = self._lock(fcntl.LOCK_EX)
+        try:
+            return self._evict()
+        finally:
+            lock.close()
+
+    def _evict(self):
+        total = 0
+        unused = []
+        for dirPath, dirNames, fileNames in os.walk(self.path):
+            for fileName in fileNames:
+                if not fileName.endswith(self.entrySuffix):
+                    continue
+                fpath = os.path.join(dirPath, fileName)
+                try:
+                    st = os.lstat(fpath)
+                except OSError, e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                    continue
+                total += st.st_size
+                if st.st_nlink == 1:
+                    unused.append((self._lastUsed(fpath, st), fpath,
+                        st.st_size))
+        unused.sort()
+        freed = 0
+        for mtime, fpath, size in unused:
+            if total - freed <= self.maxSize:
+                break
+            self._remove(fpath)
+            freed += size
+        if freed:
+            logger.info("Evicted %d bytes from changeset store %s", freed,
+                self.path)
+        return freed
+
+    def _lock(self, mode):
+        util.mkdirChain(self.path)
+        lock = open(os.path.join(self.path, self.lockName), 'a')
+        fcntl.flock(lock.fileno(), mode)
+        return lock
+
+    def _verify(self, entry):
+        try:
+            info = json.load(file(entry + self.infoSuffix))
+            st = os.stat(entry)
+            if st.st_size != info['size']:
+                return False
+            if (st.st_ino, st.st_mtime) == (info.get('ino'),
+                    info.get('mtime')):
+                return True
+            if self._sha1(entry) != info['sha1']:
+                return False
+            # Unchanged contents; avoid hashing them again next time
+            self._writeInfo(entry, st, info['sha1'])
+            return True
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return False
+
+    def _writeInfo(self, entry, st, sha1):
+        info = json.dumps(dict(size=st.st_size, sha1=sha1, ino=st.st_ino,
+            mtime=st.st_mtime))
+        self._writeAtomic(entry + self.infoSuffix,
+            lambda path: file(path, 'w').write(info))
+
+    def _lastUsed(self, entry, st):
+        try:
+            return os.stat(entry + self.infoSuffix).st_mtime
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return st.st_mtime
+
+    def _remove(self, entry):
+        for path in [ entry, entry + self.infoSuffix ]:
+            try:
+                os.unlink(path)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+    @classmethod
+    def _sha1(cls, path):
+        digest = hashlib.sha1()
+        f = open(path, 'rb')
+        try:
+            while True:
+                data = f.read(1024 * 1024)
+                if not data:
+                    break
+                digest.update(data)
+        finally:
+            f.close()
+        return digest.hexdigest()
+
+    @classmethod
+    def _writeAtomic(cls, path, write):
+        """
+        Create C{path} by calling C{write} on a temporary file in the same
+        directory, then renaming the temporary file into place
+        """
+        dirName, fileName = os.path.split(path)
+        fd, tmpPath = tempfile.mkstemp(dir=dirName, prefix='.' + fileName)
+        os.close(fd)
+        try:
+            write(tmpPath)
+            os.rename(tmpPath, path)
+        except:
+            if os.path.exists(tmpPath):
+                os.unlink(tmpPath)
+            raise
+
+    @classmethod
+    def _link(cls, src, dest):
+        if os.path.exists(dest):
+            os.unlink(dest)
+        try:
+            os.link(src, dest)
+        except OSError, e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            # Different file systems; a copy is the best we can do
+            shutil.copyfile(src, dest)
+
+
+class _DownloadProgress(object):
+    """
+    Aggregate the progress of concurrent downloads and report the total
+    to an update callback.
+    """
+    def __init__(self, callback, total):
+        self.callback = callback
+        self.total = total
+        self.done = 0
+        self._lock = threading.Lock()
+
+    def add(self, count):
+        self._lock.acquire()
+        try:
+            self.done += count
+            if self.callback is not None:
+                self.callback.downloadingChangeSet(self.done,
+                    max(self.total, self.done))
+        finally:
+            self._lock.release()
+
+
+class _ChangeSetCallback(callbacks.ChangesetCallback):
+    """
+    Callback for a single changeset download, forwarding the number of
+    bytes received to the aggregated progress.
+    """
+    def __init__(self, progress):
+        callbacks.ChangesetCallback.__init__(self)
+        self.progress = progress
+        self.got = 0
+
+    def downloadingChangeSet(self, got, need):
+        if got > self.got:
+            self.progress.add(got - self.got)
+            self.got = got
+
+
+class ChangeSetDownloader(object):
+    """
+    Download the changesets of an update job into a directory.
+
+    There is one changeset per job list of the update job. Changesets
+    served by different repositories are downloaded in parallel, with at
+    most C{perHostConcurrency} downloads per repository server at any
+    time; a changeset involving several servers counts against each of
+    them.
+
+    Only update jobs made of repository troves can be downloaded this way
+    (see L{canDownload}); others have to use conary's C{downloadUpdate}.
+
+    Every changeset is downloaded to a temporary file, renamed into place
+    once complete, and recorded in a checkpoint file along with the digest
+    of its job list. Restarting an interrupted download skips the
+    changesets recorded in the checkpoint.
+
+    If a L{ChangeSetStore} is specified, changesets it already has are
+    linked from it instead of being downloaded, and newly downloaded ones
+    are added to it.
+
+    Repository clients are not thread safe: download threads use their
+    own, created by C{createRepos}. Without it, they share C{repos}.
+    """
+    perHostConcurrency = 1
+    checkpointName = 'checkpoint'
+
+    def __init__(self, repos, destDir, callback=None,
+            perHostConcurrency=None, store=None, createRepos=None):
+        self.repos = repos
+        self._repos = concurrency.PerThread(createRepos or (lambda: repos),
+            repos)
+        self.destDir = destDir
+        self.callback = callback
+        self.store = store
+        if perHostConcurrency is not None:
+            self.perHostConcurrency = perHostConcurrency
+        self.checkpointPath = os.path.join(destDir, self.checkpointName)
+        self._lock = threading.Lock()
+        self._hostSlots = {}
+
+    @classmethod
+    def canDownload(cls, updateJob):
+        """
+        Return True if every job list of C{updateJob} installs or updates
+        troves from a repository. Job lists that only erase troves, and
+        troves coming from local changesets, are handled by conary's
+        C{downloadUpdate} only.
+        """
+        for jobList in updateJob.getJobs():
+            newVersions = [ x[2][0] for x in jobList if x[2][0] is not None ]
+            if not newVersions:
+                return False
+            if [ x for x in newVersions if x.isOnLocalHost() ]:
+                return False
+        return True
+
+    def download(self, updateJob, downloadSize=0):
+        """
+        Download all changesets for C{updateJob}, and record them in the
+        update job. Return the list of changeset files.
+        """
+        util.mkdirChain(self.destDir)
+        checkpoint = self._readCheckpoint()
+        progress = _DownloadProgress(self.callback, downloadSize)
+        csFiles = []
+        pending = []
+        hosts = set()
+        for i, jobList in enumerate(updateJob.getJobs()):
+            csFile = os.path.join(self.destDir, '%04d.ccs' % i)
+            csFiles.append(csFile)
+            digest = jobListDigest(jobList)
+            if (checkpoint.get(os.path.basename(csFile)) == digest
+                    and os.path.exists(csFile)):
+                progress.add(os.stat(csFile).st_size)
+                continue
+            jobHosts = self._getHosts(jobList)
+            hosts.update(jobHosts)
+            pending.append((jobList, csFile, digest, jobHosts))
+
+        for host in hosts:
+            self._hostSlots[host] = threading.Semaphore(
+                self.perHostConcurrency)
+        logger.info("Downloading %d changesets from %d repositories "
+            "(%d already downloaded)", len(pending), len(hosts),
+            len(csFiles) - len(pending))
+        concurrency.parallelMap(lambda item: self._fetch(item, progress),
+            pending, max(len(hosts), 1) * self.perHostConcurrency)
+
+        updateJob.setJobsChangesetList(csFiles)
+        return csFiles
+
+    @classmethod
+    def _getHosts(cls, jobList):
+        hosts = set()
+        for _, (oldVersion, _), (newVersion, _), _ in jobList:
+            version = newVersion or oldVersion
+            if version is not None:
+                hosts.add(version.getHost())
+        return tuple(sorted(hosts))
+
+    def _fetch(self, item, progress):
+        jobList, csFile, digest, hosts = item
+        if self.store is not None and self.store.fetch(digest, csFile):
+            progress.add(os.stat(csFile).st_size)
+        else:
+            # Hosts are sorted, so slots are always taken in the same order
+            slots = [ self._hostSlots[x] for x in hosts ]
+            for slot in slots:
+                slot.acquire()
+            try:
+                partial = csFile + '.partial'
+                self._repos.get().createChangeSetFile(jobList, partial,
+                    recurse=False, callback=_ChangeSetCallback(progress))
+            finally:
+                for slot in reversed(slots):
+                    slot.release()
+            os.rename(partial, csFile)
+            if self.store is not None:
+                self.store.add(digest, csFile)
+        self._lock.acquire()
+        try:
+            f = open(self.checkpointPath, 'a')
+            try:
+                f.write('%s %s\n' % (os.path.basename(csFile), digest))
+            finally:
+                f.close()
+        finally:
+            self._lock.release()
+
+    def _readCheckpoint(self):
+        checkpoint = {}
+        try:
+            f = open(self.checkpointPath)
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return checkpoint
+        try:
+            for line in f:
+                fields = line.split()
+                # Ignore a partially written trailing line
+                if len(fields) == 2 and line.endswith('\n'):
+                    checkpoint[fields[0]] = fields[1]
+        finally:
+            f.close()
+        return checkpoint
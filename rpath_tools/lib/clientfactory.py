@@ -22,29 +22,151 @@ from conary import conarycfg
 from conary import conaryclient
 from conary.conaryclient import cml
 from conary.conaryclient import systemmodel
+from conary.lib import util
 
 
+import copy
 import logging
+import os
+import threading
+
+from rpath_tools.lib import concurrency
 
 logger = logging.getLogger(__name__)
 
 
 class ConaryClientFactory(object):
+    """
+    Create conary configuration and client objects.
+
+    Both are expensive to create (configuration files are parsed, flavors
+    initialized), so they are cached for the lifetime of the process. A
+    cached object is discarded as soon as one of the files it was built
+    from changes: the conary configuration files for configurations, and
+    additionally the system model and the conary database for clients.
+
+    Callers modify what they are given, so every caller gets its own copy
+    of a cached configuration. A cached client is shared, but its update
+    callback is replaced whenever it is handed out, and it is given the
+    caller's system model file, or a new one read from disk. Child
+    processes drop the cache after a fork, rather than sharing the
+    parent's database handle and connections.
+    @cvar configPaths: files and directories whose change invalidates
+    the cache
+    """
+    configPaths = [ '/etc/conaryrc', '/etc/conary', '/etc/conary/config.d',
+        '~/.conaryrc', ]
+
+    _cache = {}
+    _lock = threading.RLock()
+
     def getClient(self, modelFile=None, model=True):
-        ccfg = self.getCfg()
+        ccfg = self._getCachedCfg(True, True)
+        paths = [ util.joinPaths(ccfg.root, ccfg.dbPath, 'conarydb') ]
         if model:
-            if not modelFile:
-                model = cml.CML(ccfg)
-                modelFile = systemmodel.SystemModelFile(model)
-            cclient = conaryclient.ConaryClient(ccfg, modelFile=modelFile)
-        else:
-            cclient = conaryclient.ConaryClient(ccfg)
-        callback = updatecmd.callbacks.UpdateCallback()
-        cclient.setUpdateCallback(callback)
+            paths.append(util.joinPaths(ccfg.root, ccfg.modelPath))
+        cclient = self._getCached(('client', bool(model)),
+            self._stamp(self.configPaths + paths),
+            lambda: self._newClient(copy.deepcopy(ccfg), model))
+        self._resetClient(cclient, model, modelFile)
         return cclient
 
     def getCfg(self, readconfig=True, initflv=True):
+        return copy.deepcopy(self._getCachedCfg(readconfig, initflv))
+
+    def _getCachedCfg(self, readconfig, initflv):
+        """
+        Return the cached configuration itself; callers must not modify it
+        """
+        return self._getCached(('cfg', bool(readconfig), bool(initflv)),
+            self.configStamp(),
+            lambda: self._newCfg(readconfig, initflv))
+
+    @classmethod
+    def configStamp(cls):
+        """
+        Return a value that changes whenever the conary configuration files
+        change
+        """
+        return cls._stamp(cls.configPaths)
+
+    @classmethod
+    def clearCache(cls):
+        cls._lock.acquire()
+        try:
+            cls._cache.clear()
+        finally:
+            cls._lock.release()
+
+    def _newCfg(self, readconfig, initflv):
         ccfg = conarycfg.ConaryConfiguration(readConfigFiles=readconfig)
         if initflv:
             ccfg.initializeFlavors()
         return ccfg
+
+    def _newClient(self, ccfg, model):
+        if model:
+            modelFile = systemmodel.SystemModelFile(cml.CML(ccfg))
+            cclient = conaryclient.ConaryClient(ccfg, modelFile=modelFile)
+        else:
+            cclient = conaryclient.ConaryClient(ccfg)
+        # Set up the repository client now, so it gets reused too
+        cclient.getRepos()
+        callback = updatecmd.callbacks.UpdateCallback()
+        cclient.setUpdateCallback(callback)
+        return cclient
+
+    def _resetClient(self, cclient, model, modelFile=None):
+        """
+        Undo the changes an earlier caller may have made to a cached
+        client: set a new update callback, and give it C{modelFile}, or a
+        system model file read again from disk. The earlier caller's model
+        file is replaced, not modified, since that caller may still use it.
+        """
+        callback = updatecmd.callbacks.UpdateCallback()
+        cclient.setUpdateCallback(callback)
+        if model:
+            if modelFile is None:
+                modelFile = systemmodel.SystemModelFile(cml.CML(cclient.cfg))
+            cclient.modelFile = modelFile
+
+    def _getCached(self, kind, stamp, create):
+        self._lock.acquire()
+        try:
+            cached = self._cache.get(kind)
+            if cached is not None and cached[0] == stamp:
+                return cached[1]
+            if cached is not None:
+                logger.debug("Discarding cached conary %s", kind[0])
+            obj = create()
+            self._cache[kind] = (stamp, obj)
+            return obj
+        finally:
+            self._lock.release()
+
+    @classmethod
+    def _stamp(cls, paths):
+        """
+        Return a value that changes whenever one of the paths (or, for
+        directories, one of the files they contain) changes.
+        """
+        stamp = []
+        for path in paths:
+            path = os.path.expanduser(path)
+            stamp.append((path, cls._statKey(path)))
+            if os.path.isdir(path):
+                for fname in sorted(os.listdir(path)):
+                    fpath = os.path.join(path, fname)
+                    stamp.append((fpath, cls._statKey(fpath)))
+        return tuple(stamp)
+
+    @classmethod
+    def _statKey(cls, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime)
+
+
+concurrency.registerForkHandler(ConaryClientFactory.clearCache)
@@ -0,0 +1,193 @@
+#!/usr/bin/python
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Helpers for running blocking (mostly network) calls concurrently.
+"""
+
+import cPickle
+import errno
+import os
+import Queue
+import signal
+import sys
+import threading
+import traceback
+
+_forkHandlers = []
+
+
+def registerForkHandler(function):
+    """
+    Register C{function} to be called in every child process forked by
+    L{ForkedCall} or the worker pool, typically to drop process-wide
+    caches holding objects (database handles, connections) which must
+    not be shared with the parent.
+    """
+    if function not in _forkHandlers:
+        _forkHandlers.append(function)
+
+
+def afterFork():
+    "Run the handlers registered with L{registerForkHandler}"
+    for function in _forkHandlers:
+        function()
+
+
+class PerThread(object):
+    """
+    One object per thread, for objects that are not safe to share between
+    threads (such as conary repository clients, which keep a cache of
+    server connections). The object for a thread is created by
+    C{factory} the first time the thread asks for it; the thread that
+    created the L{PerThread} uses C{default}, if specified.
+    """
+    def __init__(self, factory, default=None):
+        self._factory = factory
+        self._local = threading.local()
+        if default is not None:
+            self._local.value = default
+
+    def get(self):
+        value = getattr(self._local, 'value', None)
+        if value is None:
+            value = self._local.value = self._factory()
+        return value
+
+
+def parallelMap(function, items, maxWorkers):
+    """
+    Call C{function} for every item, using at most C{maxWorkers} threads,
+    and return the list of results, in the same order as C{items}.
+    If any of the calls raises an exception, the first one (in item order)
+    is re-raised once all the calls have finished.
+    """
+    items = list(items)
+    if maxWorkers <= 1 or len(items) <= 1:
+        return [ function(x) for x in items ]
+
+    work = Queue.Queue()
+    for i, item in enumerate(items):
+        work.put((i, item))
+    results = [ None ] * len(items)
+    errors = {}
+
+    def worker():
+        while True:
+            try:
+                i, item = work.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[i] = function(item)
+            except Exception:
+                errors[i] = sys.exc_info()
+
+    threads = [ threading.Thread(target=worker)
+        for x in range(min(maxWorkers, len(items))) ]
+    for thread in threads:
+        thread.setDaemon(True)
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        excType, excValue, excTb = errors[min(errors)]
+        raise excType, excValue, excTb
+    return results
+
+
+class ForkedCallError(Exception):
+    "Raised when a function called in a child process fails"
+
+
+class ForkedCall(object):
+    """
+    Call a function in a forked child process, so that CPU-bound work
+    (which threads would serialize) can overlap with the parent's work.
+    The function's return value must be picklable; it is sent back to the
+    parent through a pipe.
+    """
+    def __init__(self, function, *args, **kwargs):
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.pid = None
+        self._fd = None
+
+    def start(self):
+        readFd, writeFd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(readFd)
+            try:
+                try:
+                    afterFork()
+                    result = (True, self.function(*self.args, **self.kwargs))
+                except:
+                    result = (False, traceback.format_exc())
+                data = cPickle.dumps(result, cPickle.HIGHEST_PROTOCOL)
+                while data:
+                    data = data[os.write(writeFd, data):]
+            finally:
+                os._exit(0)
+        os.close(writeFd)
+        self.pid = pid
+        self._fd = readFd
+        return self
+
+    def wait(self):
+        """
+        Wait for the child to finish, and return the function's result.
+        @raises ForkedCallError: if the function raised an exception, or
+        the child died before returning a result
+        """
+        chunks = []
+        try:
+            while True:
+                chunk = os.read(self._fd, 65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        finally:
+            self._close()
+        try:
+            success, result = cPickle.loads(''.join(chunks))
+        except (EOFError, ValueError, cPickle.UnpicklingError):
+            raise ForkedCallError("Child process %s exited without a result"
+                % self.pid)
+        if not success:
+            raise ForkedCallError(result)
+        return result
+
+    def cancel(self):
+        """Kill the child, if it is still running"""
+        if self._fd is None:
+            return
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+        except OSError, e:
+            if e.errno != errno.ESRCH:
+                raise
+        self._close()
+
+    def _close(self):
+        if self._fd is None:
+            return
+        os.close(self._fd)
+        self._fd = None
+        os.waitpid(self.pid, 0)
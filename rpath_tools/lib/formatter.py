@@ -16,6 +16,10 @@
 #
 
 
+import copy
+import json
+import StringIO
+
 from conary.deps import arch as cny_arch
 from conary.deps import deps as cny_deps
 from lxml import etree
@@ -30,13 +34,21 @@ def getArchFromFlavor(flavor):
 
 
 class Formatter(object):
-    __slots__ = [ 'jobs', 'root', 'changes' ]
+    """
+    Generate the XML preview of an update job.
+
+    Large updates have few distinct flavors, and every version is rendered
+    several times, so rendered flavors, architectures, versions and
+    revisions are memoized for the lifetime of the formatter.
+    """
+    __slots__ = [ 'jobs', 'root', 'changes', '_memo' ]
     def __init__(self, updateJob):
         self.jobs = []
         if updateJob is not None:
             self.jobs = updateJob.getJobs()
         self.root = None
         self.changes = None
+        self._memo = {}
 
     def format(self):
         self.root = etree.Element('preview')
@@ -63,25 +75,116 @@ class Formatter(object):
         etree.SubElement(self.root, 'downloaded').text = \
             'true' if downloaded else 'false'
 
+    def addTimings(self, stages):
+        """
+        Add the timings of an operation, as returned by
+        C{timings.Timings.asList}
+        """
+        node = etree.SubElement(self.root, 'timings')
+        for stage in stages:
+            stageNode = etree.SubElement(node, 'stage')
+            etree.SubElement(stageNode, 'name').text = stage['name']
+            etree.SubElement(stageNode, 'seconds').text = str(stage['seconds'])
+            for key in sorted(stage):
+                if key not in ('name', 'seconds'):
+                    etree.SubElement(stageNode, key).text = str(stage[key])
+
     def toxml(self):
         return etree.tostring(self.root)
 
+    def writeJsonTo(self, stream):
+        """
+        Write the JSON version of the preview to the file object C{stream}.
+        The document is the same as L{xmlToJson}'s for the XML preview,
+        but the package changes are generated from the jobs directly, one
+        at a time.
+        """
+        preview = dict(self.root.attrib)
+        for child in self.root:
+            if child.tag != 'conary_package_changes':
+                _jsonAddElement(preview, child)
+        stream.write('{"preview": {')
+        for key, value in preview.iteritems():
+            stream.write('%s: %s, ' % (json.dumps(key), json.dumps(value)))
+        stream.write('"conary_package_changes": ')
+        count = sum(len(x) for x in self.jobs)
+        if count == 0:
+            stream.write('null')
+        elif count == 1:
+            for oneJob in self.jobs:
+                for j in oneJob:
+                    stream.write('{"conary_package_change": %s}' %
+                        json.dumps(self._jsonJob(j)))
+        else:
+            stream.write('{"conary_package_change": [')
+            sep = ''
+            for oneJob in self.jobs:
+                for j in oneJob:
+                    stream.write(sep)
+                    stream.write(json.dumps(self._jsonJob(j)))
+                    sep = ', '
+            stream.write(']}')
+        stream.write('}}')
+
+    def tojson(self):
+        stream = StringIO.StringIO()
+        self.writeJsonTo(stream)
+        return stream.getvalue()
+
+    def _jsonJob(self, job):
+        (name, (oldVer, oldFla), (newVer, newFla)) = job[:3]
+        if oldVer is None:
+            return { 'type' : 'added', 'added_conary_package' :
+                self._jsonSpec(name, newVer, newFla) }
+        if newVer is None:
+            return { 'type' : 'removed', 'removed_conary_package' :
+                self._jsonSpec(name, oldVer, oldFla) }
+        diff = {}
+        for tag, oldValue, newValue in [
+                ('version', self._freeze(oldVer), self._freeze(newVer)),
+                ('revision', self._revision(oldVer), self._revision(newVer)),
+                ('flavor', self._flavor(oldFla), self._flavor(newFla)),
+                ('architecture', self._arch(oldFla), self._arch(newFla)), ]:
+            if oldValue != newValue:
+                diff[tag] = { 'from' : oldValue or None,
+                    'to' : newValue or None }
+        return {
+            'type' : 'changed',
+            'from_conary_package' : self._jsonSpec(name, oldVer, oldFla),
+            'to_conary_package' : self._jsonSpec(name, newVer, newFla),
+            # An empty element has no text
+            'conary_package_diff' : diff or None,
+        }
+
+    def _jsonSpec(self, name, version, flavor):
+        # Empty strings become empty elements in the XML preview, which
+        # have no text
+        return {
+            'name' : str(name) or None,
+            'version' : self._freeze(version) or None,
+            'architecture' : self._arch(flavor) or None,
+            'flavor' : self._flavor(flavor) or None,
+            'revision' : self._revision(version) or None,
+        }
+
     def _formatJob(self, job):
         (name, (oldVer, oldFla), (newVer, newFla)) = job[:3]
         if oldVer is None:
-            self._formatInstall(name, newVer, newFla)
+            return self._formatInstall(name, newVer, newFla)
         elif newVer is None:
-            self._formatErase(name, oldVer, oldFla)
+            return self._formatErase(name, oldVer, oldFla)
         else:
-            self._formatUpdate(name, oldVer, oldFla, newVer, newFla)
+            return self._formatUpdate(name, oldVer, oldFla, newVer, newFla)
 
     def _formatInstall(self, name, version, flavor):
         node = self._newPackageChange('added')
         self._packageSpec(node, 'added_conary_package', name, version, flavor)
+        return node
 
     def _formatErase(self, name, version, flavor):
         node = self._newPackageChange('removed')
         self._packageSpec(node, 'removed_conary_package', name, version, flavor)
+        return node
 
     def _formatUpdate(self, name, oldVersion, oldFlavor, newVersion, newFlavor):
         node = self._newPackageChange('changed')
@@ -89,16 +192,15 @@ class Formatter(object):
         self._packageSpec(node, 'to_conary_package', name, newVersion, newFlavor)
 
         diff = etree.SubElement(node, 'conary_package_diff')
-        oldRev = oldVersion.trailingRevision()
-        newRev = newVersion.trailingRevision()
-        oldArch = getArchFromFlavor(oldFlavor)
-        newArch = getArchFromFlavor(newFlavor)
-
         self._fieldDiff(diff, 'version',
-                oldVersion.freeze(), newVersion.freeze())
-        self._fieldDiff(diff, 'revision', oldRev, newRev)
-        self._fieldDiff(diff, 'flavor', oldFlavor, newFlavor)
-        self._fieldDiff(diff, 'architecture', oldArch, newArch)
+                self._freeze(oldVersion), self._freeze(newVersion))
+        self._fieldDiff(diff, 'revision',
+                self._revision(oldVersion), self._revision(newVersion))
+        self._fieldDiff(diff, 'flavor',
+                self._flavor(oldFlavor), self._flavor(newFlavor))
+        self._fieldDiff(diff, 'architecture',
+                self._arch(oldFlavor), self._arch(newFlavor))
+        return node
 
     def _newPackageChange(self, type):
         node = etree.SubElement(self.changes, 'conary_package_change')
@@ -108,16 +210,135 @@ class Formatter(object):
     def _packageSpec(self, parent, tag, name, version, flavor):
         node = etree.SubElement(parent, tag)
         etree.SubElement(node, 'name').text = str(name)
-        etree.SubElement(node, 'version').text = version.freeze()
-        etree.SubElement(node, 'architecture').text = getArchFromFlavor(flavor)
-        etree.SubElement(node, 'flavor').text = str(flavor)
-        etree.SubElement(node, 'revision').text = str(
-                version.trailingRevision())
+        etree.SubElement(node, 'version').text = self._freeze(version)
+        etree.SubElement(node, 'architecture').text = self._arch(flavor)
+        etree.SubElement(node, 'flavor').text = self._flavor(flavor)
+        etree.SubElement(node, 'revision').text = self._revision(version)
         return node
 
     def _fieldDiff(self, parent, tag, oldValue, newValue):
         if oldValue == newValue:
             return
         node = etree.SubElement(parent, tag)
-        etree.SubElement(node, 'from').text = str(oldValue)
-        etree.SubElement(node, 'to').text = str(newValue)
+        etree.SubElement(node, 'from').text = oldValue
+        etree.SubElement(node, 'to').text = newValue
+
+    def _render(self, kind, function, obj, key=None):
+        if key is None:
+            key = obj
+        key = (kind, key)
+        try:
+            return self._memo[key]
+        except KeyError:
+            value = self._memo[key] = function(obj)
+            return value
+
+    def _freeze(self, version):
+        # Versions compare equal regardless of their timestamps, which are
+        # part of the frozen version; the job list keeps the versions
+        # alive, so their ids are stable
+        return self._render('freeze', _freezeVersion, version, id(version))
+
+    def _revision(self, version):
+        return self._render('revision', _trailingRevision, version)
+
+    def _flavor(self, flavor):
+        return self._render('flavor', str, flavor)
+
+    def _arch(self, flavor):
+        return self._render('arch', getArchFromFlavor, flavor)
+
+
+def _freezeVersion(version):
+    return version.freeze()
+
+
+def _trailingRevision(version):
+    return str(version.trailingRevision())
+
+
+def xmlToJson(xml):
+    """
+    Convert an XML document to JSON: elements become objects holding
+    their attributes and children, leaf elements become their text, and
+    repeated elements become lists.
+    """
+    root = etree.fromstring(xml)
+    return json.dumps({root.tag: _elementToJson(root)})
+
+
+def _elementToJson(root):
+    result = dict(root.attrib)
+    for e in root:
+        _jsonAddElement(result, e)
+    return result
+
+
+def _jsonAddElement(result, e):
+    if len(e):
+        result.update(e.attrib)
+        obj = _elementToJson(e)
+    else:
+        obj = e.text
+    _jsonAdd(result, e.tag, obj)
+
+
+def _jsonAdd(result, tag, obj):
+    current = result.get(tag)
+    if not current:
+        result[tag] = obj
+    elif hasattr(current, 'append'):
+        current.append(obj)
+    else:
+        result[tag] = [current, obj]
+
+
+class StreamingFormatter(Formatter):
+    """
+    Formatter writing the package changes one at a time instead of
+    building the whole document first. The output is identical to
+    L{Formatter.toxml}'s.
+
+    Only the small elements added after L{format} (observed and desired
+    versions, download size...) are kept in a tree; the package changes
+    are generated while writing.
+    """
+    __slots__ = []
+
+    def format(self):
+        self.root = etree.Element('preview')
+
+    def _newPackageChange(self, type):
+        node = etree.Element('conary_package_change')
+        etree.SubElement(node, 'type').text = type
+        return node
+
+    def writeTo(self, stream):
+        """Write the preview to the file object C{stream}"""
+        if not hasattr(etree, 'xmlfile'):
+            # No incremental writing in this lxml version
+            formatter = Formatter(None)
+            formatter.jobs = self.jobs
+            formatter.format()
+            for child in self.root:
+                formatter.root.append(copy.deepcopy(child))
+            formatter.root.attrib.update(self.root.attrib)
+            stream.write(formatter.toxml())
+            return
+        with etree.xmlfile(stream) as xf:
+            with xf.element(self.root.tag, dict(self.root.attrib)):
+                if any(self.jobs):
+                    with xf.element('conary_package_changes'):
+                        for oneJob in self.jobs:
+                            for j in oneJob:
+                                xf.write(self._formatJob(j))
+                else:
+                    # Same as an empty element in a tree
+                    xf.write(etree.Element('conary_package_changes'))
+                for child in self.root:
+                    xf.write(child)
+
+    def toxml(self):
+        stream = StringIO.StringIO()
+        self.writeTo(stream)
+        return stream.getvalue()
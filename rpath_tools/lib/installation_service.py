@@ -280,6 +280,8 @@ class UpdateCallback(updatecmd.UpdateCallback):
     def __init__(self, job):
         updatecmd.UpdateCallback.__init__(self)
         self.job = job
+        # Progress messages are frequent, write them in batches
+        self.job.bufferLogs()
         self.out = self.LogStream(job)
 
     def _message(self, text):
@@ -289,4 +291,5 @@ class UpdateCallback(updatecmd.UpdateCallback):
 
     def done(self):
         self.job.logs.add("Done")
+        self.job.flushLogs()
     updateDone = done
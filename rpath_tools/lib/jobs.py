@@ -17,17 +17,28 @@
 
 
 import itertools
+import logging
 import optparse
 import os
 import shutil
+import StringIO
 import subprocess
 import sys
+import time
 import traceback
 
-from rpath_tools.lib import stored_objects
-from rpath_tools.lib import installation_service, update
+from rpath_tools.lib import concurrency, stored_objects
+from rpath_tools.lib import installation_service, metrics, profiling
+from rpath_tools.lib import reaper, scheduler, update
+from rpath_tools.lib import workerpool
+
+logger = logging.getLogger(__name__)
 
 class TaskRunner(object):
+    Scheduler = scheduler.Scheduler
+    Metrics = metrics.Metrics
+    Profiler = profiling.Profiler
+
     def runAsync(self, task, *args, **kwargs):
         task.job.state = "Starting"
 
@@ -37,15 +48,65 @@ class TaskRunner(object):
     def runSync(self, task, *args, **kwargs):
         job = task.job
         job.pid = os.getpid()
+
+        slot = None
+        if task.schedulerKind is not None:
+            # Wait for our turn
+            job.state = "Queued"
+            slot = self.Scheduler(task.storagePath).acquire(job.keyId,
+                task.schedulerKind, priority=task.schedulerPriority)
+            if slot is None:
+                job.state = "Cancelled"
+                self._recordMetrics(task, job.state)
+                return
+            job.queueWait = slot.waited
         job.state = "Running"
+        start = time.time()
+
+        try:
+            try:
+                try:
+                    self._runTask(task, args, kwargs)
+                finally:
+                    job.closeLogs()
+            except scheduler.TaskCancelled:
+                job.state = "Cancelled"
+            except Exception:
+                job.jsonContent = None
+                job.content = traceback.format_exc()
+                job.state = "Exception"
+            else:
+                job.state = "Completed"
+        finally:
+            if slot is not None:
+                slot.release()
+        self._recordMetrics(task, job.state, time.time() - start,
+            slot.waited if slot is not None else None)
 
+        # We are detached from the caller already, take the opportunity to
+        # get rid of expired jobs
         try:
-            task.run(*args, **kwargs)
+            task.reapExpired()
         except Exception:
-            job.content = traceback.format_exc()
-            job.state = "Exception"
-        else:
-            job.state = "Completed"
+            logger.exception("Unable to reap expired jobs")
+
+    def _runTask(self, task, args, kwargs):
+        profiles = task.profiles or self.Profiler.fromEnvironment(os.environ)
+        if not profiles:
+            return task.run(*args, **kwargs)
+        profiler = self.Profiler(profiles)
+        try:
+            return profiler.runcall(task.run, *args, **kwargs)
+        finally:
+            task.job.profile = profiler.cpuReport
+            task.job.memoryProfile = profiler.memoryReport
+
+    def _recordMetrics(self, task, state, duration=None, queueWait=None):
+        try:
+            self.Metrics(task.storagePath).jobFinished(
+                task.__class__.__name__, state, duration, queueWait)
+        except Exception:
+            logger.exception("Unable to record job metrics")
 
     def background_run(self, function, task, args, kwargs):
         task.preFork(*args, **kwargs)
@@ -60,6 +121,7 @@ class TaskRunner(object):
                     # The first child exits and is waited by the parent
                     # the finally part will do the os._exit
                     return
+                concurrency.afterFork()
                 task.postFork(*args, **kwargs)
                 # Redirect stdin, stdout, stderr
                 fd = os.open(os.devnull, os.O_RDWR)
@@ -87,6 +149,12 @@ class BaseTask(object):
     storagePath = installation_service.InstallationService.UpdateSetFactory.storagePath
     jobFactory = None
     TaskRunner = TaskRunner
+    # Kind of task, as known to the scheduler (None runs unscheduled), and
+    # priority in the scheduler's queue
+    schedulerKind = None
+    schedulerPriority = 0
+    # Profiles to capture while running (see profiling.Profiler)
+    profiles = None
     def __init__(self):
         self.concreteJob = None
 
@@ -144,6 +212,14 @@ class BaseTask(object):
         for key in self.job.storage.enumerateAll():
             self.job.storage.delete(key)
 
+    def reapExpired(self, batchSize=None, timeBudget=None):
+        """
+        Remove expired jobs of this task's kind
+        """
+        factory = self.jobFactory(self.storagePath)
+        return reaper.ExpiryReaper(factory, batchSize=batchSize,
+            timeBudget=timeBudget).run()
+
 class BaseUpdateTask(BaseTask):
     jobFactory = stored_objects.ConcreteUpdateJobFactory
 
@@ -152,22 +228,42 @@ class BaseUpdateTask(BaseTask):
         shutil.rmtree(os.path.join(
             self.job.storage.cfg.storagePath, self.job.keyId))
 
+    def reapExpired(self, batchSize=None, timeBudget=None):
+        """
+        Remove expired update jobs, and the expired memos of their
+        previews
+        """
+        stats = super(BaseUpdateTask, self).reapExpired(batchSize=batchSize,
+            timeBudget=timeBudget)
+        factory = stored_objects.PreviewMemoFactory(self.storagePath)
+        reaper.ExpiryReaper(factory, batchSize=batchSize,
+            timeBudget=timeBudget).run()
+        return stats
+
 class UpdateCheckTask(BaseUpdateTask):
+    schedulerKind = 'preview'
+
     def run(self):
         instserv = installation_service.InstallationService()
         instserv.updateAllCheck()
 
 class UpdateAllTask(BaseUpdateTask):
+    schedulerKind = 'update'
+
     def run(self, instanceId):
         instserv = installation_service.InstallationService()
         instserv.updateAllApply(instanceId)
 
 class UpdateTask(BaseUpdateTask):
+    schedulerKind = 'update'
+
     def run(self, sources, flags):
         instserv = installation_service.InstallationService()
         self.job.content = instserv.updateOperation(self.job, sources, flags)
 
 class SyncPreviewTask(BaseUpdateTask):
+    schedulerKind = 'preview'
+
     def preFork(self, systemModelPath, flags=None):
         self.job.systemModel = file(systemModelPath).read()
 
@@ -179,6 +275,8 @@ class SyncPreviewTask(BaseUpdateTask):
         operation.preview(self.job, raiseExceptions=True)
 
 class SyncApplyTask(BaseUpdateTask):
+    schedulerKind = 'apply'
+
     def postFork(self, *args, **kwargs):
         update.SyncModel.fixSignals()
 
@@ -192,6 +290,8 @@ class SyncApplyTask(BaseUpdateTask):
                 key.rsplit('/', 1)[-1])
 
 class UpdatePreviewTask(BaseUpdateTask):
+    schedulerKind = 'preview'
+
     def preFork(self, systemModelPath, flags=None):
         self.job.systemModel = file(systemModelPath).read()
 
@@ -203,6 +303,8 @@ class UpdatePreviewTask(BaseUpdateTask):
         operation.preview(self.job, raiseExceptions=True)
 
 class DownloadTask(BaseUpdateTask):
+    schedulerKind = 'download'
+
     def postFork(self, *args, **kwargs):
         update.SyncModel.fixSignals()
 
@@ -226,12 +328,25 @@ class AnyTask(object):
                 return klass().load(keyId)
         return None
 
-def startUpdateOperation(sources, flags):
+def startUpdateOperation(sources, flags, priority=None, profiles=None):
     task = UpdateTask().new()
+    if priority is not None:
+        task.schedulerPriority = priority
+    task.profiles = profiles
     task(sources, flags)
     return task
 
+def workerPoolSocket():
+    return os.path.join(BaseTask.storagePath, 'workers.sock')
+
 def reexec(args):
+    # Hand the request to the worker pool, if one is running, to avoid
+    # starting a new interpreter
+    try:
+        return workerpool.submit(workerPoolSocket(), args)
+    except workerpool.PoolUnavailable:
+        pass
+
     pythonExec = os.path.join(sys.exec_prefix, "bin", "python")
     execPath = __file__
     callArgs = [ pythonExec, execPath ] + args
@@ -242,7 +357,35 @@ def reexec(args):
     jobProc.wait()
     return jobProc
 
-def main():
+def _handlePoolRequest(args):
+    """
+    Run main() in a worker of the pool, capturing its output
+    """
+    out = StringIO.StringIO()
+    stdout, sys.stdout = sys.stdout, out
+    try:
+        try:
+            main(args)
+            status = 0
+        except SystemExit, e:
+            status = e.code or 0
+    finally:
+        sys.stdout = stdout
+    return status, out.getvalue()
+
+def _warmPool():
+    update.UpdateService().warmCaches()
+
+def serve(workers=None):
+    """
+    Run the worker pool serving reexec() requests, until terminated
+    """
+    update.SyncModel.fixSignals()
+    pool = workerpool.WorkerPool(workerPoolSocket(), _handlePoolRequest,
+        warm=_warmPool, workers=workers)
+    pool.serve()
+
+def main(args=None):
     parser = optparse.OptionParser()
     parser.add_option("-t", "--test", action="store_true", dest="test")
     parser.add_option("-m", "--mode", action="store", type="choice",
@@ -250,10 +393,63 @@ def main():
     parser.add_option("-p", "--package", action="append", dest="package")
     parser.add_option("--system-model-path", action="store", dest="systemModelPath")
     parser.add_option("--update-id", action="store", dest="updateId")
-    (options, args) = parser.parse_args()
+    parser.add_option("--reap", action="store_true", dest="reap",
+        help="remove expired jobs and exit")
+    parser.add_option("--reap-batch-size", action="store", type="int",
+        dest="reapBatchSize")
+    parser.add_option("--reap-time-budget", action="store", type="float",
+        dest="reapTimeBudget")
+    parser.add_option("--priority", action="store", type="int",
+        dest="priority", help="priority in the job queue")
+    parser.add_option("--cancel", action="store", dest="cancelId",
+        help="cancel a queued or running job and exit")
+    parser.add_option("--queue-status", action="store_true",
+        dest="queueStatus", help="show the job queue and exit")
+    parser.add_option("--serve", action="store_true", dest="serve",
+        help="run a pool of workers for starting jobs quickly")
+    parser.add_option("--workers", action="store", type="int",
+        dest="workers", help="number of idle workers in the pool")
+    parser.add_option("--metrics", action="store_true", dest="metrics",
+        help="show the job metrics and exit")
+    parser.add_option("--profile", action="store", dest="profile",
+        help="profile the job: cpu, memory or all")
+    (options, args) = parser.parse_args(args)
+
+    if options.serve:
+        serve(workers=options.workers)
+        sys.exit()
 
     kwargs = {}
 
+    if options.cancelId:
+        jobId = BaseTask.sanitizeKey(options.cancelId)
+        if not scheduler.Scheduler(BaseTask.storagePath).cancel(jobId):
+            sys.exit(1)
+        sys.exit()
+
+    if options.queueStatus:
+        stats = scheduler.Scheduler(BaseTask.storagePath).stats()
+        for kind, kindStats in sorted(stats.items()):
+            print "%s: queued=%d running=%d oldestWait=%.2f" % (kind,
+                kindStats['queued'], kindStats['running'],
+                kindStats['oldestWait'])
+        sys.exit()
+
+    if options.metrics:
+        sys.stdout.write(metrics.Metrics(BaseTask.storagePath).format())
+        sys.exit()
+
+    if options.reap:
+        for jobFactory in [ stored_objects.ConcreteUpdateJobFactory,
+                stored_objects.ConcreteSurveyJobFactory,
+                stored_objects.PreviewMemoFactory ]:
+            stats = reaper.ExpiryReaper(jobFactory(BaseTask.storagePath),
+                batchSize=options.reapBatchSize,
+                timeBudget=options.reapTimeBudget).run()
+            print "%s: %s" % (jobFactory.factory.keyPrefix or
+                jobFactory.factory.prefix, stats)
+        sys.exit()
+
     if not options.mode:
         sys.exit(-1)
 
@@ -263,14 +459,28 @@ def main():
     kwargs[options.mode] = True
     kwargs['test'] = bool(options.test)
 
+    profiles = None
+    if options.profile:
+        try:
+            profiles = profiling.Profiler.parse(options.profile)
+        except ValueError, e:
+            parser.error(str(e))
+
     flags = installation_service.InstallationService.UpdateFlags(**kwargs)
     if options.package:
-        task = startUpdateOperation(sources=options.package, flags=flags)
+        task = startUpdateOperation(sources=options.package, flags=flags,
+            priority=options.priority, profiles=profiles)
     elif options.systemModelPath:
         task = SyncPreviewTask().new()
+        if options.priority is not None:
+            task.schedulerPriority = options.priority
+        task.profiles = profiles
         task(options.systemModelPath, flags)
     elif options.updateId:
         task = SyncApplyTask().load(options.updateId)
+        if options.priority is not None:
+            task.schedulerPriority = options.priority
+        task.profiles = profiles
         task(flags)
     print task.get_job_id()
     sys.exit()
@@ -0,0 +1,280 @@
+#!/usr/bin/python
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Append-only storage for job log entries.
+
+Log entries are appended to a single segment file. For every entry a
+fixed-size record (timestamp, offset, length) is appended to an offset index
+file, so entries can be listed without reading the segment, and read back
+one at a time.
+
+Timestamps are stored with the precision they are presented with (see
+L{LogSegment.round}), and are unique: an entry whose timestamp is not
+newer than the previous entry's gets the next possible timestamp instead.
+"""
+
+import atexit
+import errno
+import fcntl
+import os
+import struct
+import threading
+import time
+import weakref
+
+from conary.lib import util
+
+from rpath_tools.lib import concurrency
+
+
+class LogSegment(object):
+    """
+    Log entries stored in the directory C{path}.
+    @cvar segmentName: name of the file holding the entries' contents
+    @cvar indexName: name of the offset index file
+    """
+    segmentName = '.segment'
+    indexName = '.segment.idx'
+    recordFormat = '!dQI'
+    recordSize = struct.calcsize(recordFormat)
+    resolution = 0.0001
+
+    def __init__(self, path):
+        self.path = path
+        self.segmentPath = os.path.join(path, self.segmentName)
+        self.indexPath = os.path.join(path, self.indexName)
+
+    @classmethod
+    def round(cls, timestamp):
+        "Return C{timestamp} with the precision used for log entries"
+        return float("%.4f" % timestamp)
+
+    @classmethod
+    def nextTimestamp(cls, timestamp, last):
+        """
+        Return C{timestamp}, rounded, or the timestamp following C{last} if
+        that is not newer than C{last}
+        """
+        timestamp = cls.round(timestamp)
+        if last is not None and timestamp <= last:
+            timestamp = cls.round(last + cls.resolution)
+        return timestamp
+
+    def append(self, entries):
+        """
+        Append entries to the segment.
+        @param entries: list of (timestamp, content) tuples
+        @return: the list of timestamps the entries were stored with
+        """
+        if not entries:
+            return []
+        try:
+            idx = open(self.indexPath, 'ab')
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            util.mkdirChain(self.path)
+            idx = open(self.indexPath, 'ab')
+        try:
+            # The lock serializes writers, so offsets are computed against
+            # the real end of the segment
+            fcntl.flock(idx.fileno(), fcntl.LOCK_EX)
+            last = self.lastTimestamp()
+            seg = open(self.segmentPath, 'ab')
+            try:
+                seg.seek(0, 2)
+                offset = seg.tell()
+                records = []
+                timestamps = []
+                for timestamp, content in entries:
+                    last = self.nextTimestamp(timestamp, last)
+                    timestamps.append(last)
+                    records.append(struct.pack(self.recordFormat,
+                        last, offset, len(content)))
+                    offset += len(content)
+                seg.write(''.join(x[1] for x in entries))
+            finally:
+                seg.close()
+            # Written after the contents, so the index never points past the
+            # end of the segment
+            idx.write(''.join(records))
+        finally:
+            idx.close()
+        return timestamps
+
+    def sequence(self):
+        """
+        Return the number of entries in the segment. This only needs a stat
+        call, and can be used to cheaply detect new entries.
+        """
+        try:
+            return os.stat(self.indexPath).st_size // self.recordSize
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return 0
+
+    def lastTimestamp(self):
+        "Return the timestamp of the last entry, or None if there is none"
+        count = self.sequence()
+        if not count:
+            return None
+        records = self.records(count - 1, count)
+        if not records:
+            return None
+        return records[0][0]
+
+    def records(self, start=0, stop=None):
+        """
+        Return the list of (timestamp, offset, length) records for the
+        entries in the segment, in the order they were added. C{start} and
+        C{stop} select a range of entries, as sequence numbers.
+        """
+        try:
+            idx = file(self.indexPath, 'rb')
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return []
+        try:
+            idx.seek(start * self.recordSize)
+            if stop is None:
+                data = idx.read()
+            else:
+                data = idx.read(max(stop - start, 0) * self.recordSize)
+        finally:
+            idx.close()
+        # Ignore a partially written trailing record
+        count = len(data) // self.recordSize
+        return [ struct.unpack_from(self.recordFormat, data,
+            i * self.recordSize) for i in xrange(count) ]
+
+    def read(self, records=None):
+        """
+        Generate (timestamp, content) tuples for the specified records (by
+        default, all the entries in the segment, sorted by timestamp),
+        reading one entry at a time.
+        """
+        if records is None:
+            records = sorted(self.records())
+        if not records:
+            return
+        seg = open(self.segmentPath, 'rb')
+        try:
+            for timestamp, offset, length in records:
+                seg.seek(offset)
+                yield timestamp, seg.read(length)
+        finally:
+            seg.close()
+
+
+class LogWriter(object):
+    """
+    Buffer log entries in memory and append them to a L{LogSegment} in
+    batches. Buffered entries are written once C{flushSize} bytes are
+    buffered, C{flushInterval} seconds after the first of them was added
+    (by a timer thread), on L{flush} or L{close}, and when the process
+    exits.
+    @cvar flushSize: flush once this many bytes are buffered
+    @cvar flushInterval: maximum number of seconds an entry stays buffered
+    """
+    flushSize = 64 * 1024
+    flushInterval = 1.0
+
+    def __init__(self, segment):
+        self.segment = segment
+        self._buffer = []
+        self._bufferSize = 0
+        self._lastTimestamp = segment.lastTimestamp()
+        self._lock = threading.RLock()
+        self._timer = None
+        _writers.add(self)
+
+    def add(self, content, timestamp=None):
+        """
+        Add an entry, returning its timestamp. The timestamp is unique
+        among the entries added through this writer; should another
+        process append newer entries to the segment before the buffer is
+        flushed, the entry is stored with a later timestamp.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        content = str(content)
+        self._lock.acquire()
+        try:
+            timestamp = self.segment.nextTimestamp(float(timestamp),
+                self._lastTimestamp)
+            self._lastTimestamp = timestamp
+            self._buffer.append((timestamp, content))
+            self._bufferSize += len(content)
+            if self._bufferSize >= self.flushSize:
+                self.flush()
+            elif self._timer is None or not self._timer.isAlive():
+                # Timers do not survive a fork, hence the liveness check
+                self._timer = threading.Timer(self.flushInterval, self.flush)
+                self._timer.setDaemon(True)
+                self._timer.start()
+        finally:
+            self._lock.release()
+        return timestamp
+
+    def flush(self):
+        self._lock.acquire()
+        try:
+            if self._timer is not None:
+                if self._timer is not threading.currentThread():
+                    self._timer.cancel()
+                self._timer = None
+            if not self._buffer:
+                return
+            buf, self._buffer, self._bufferSize = self._buffer, [], 0
+            timestamps = self.segment.append(buf)
+            self._lastTimestamp = max(self._lastTimestamp, timestamps[-1])
+        finally:
+            self._lock.release()
+
+    def close(self):
+        "Write the buffered entries; the writer can still be used afterwards"
+        self.flush()
+        _writers.discard(self)
+
+    def _afterFork(self):
+        """
+        Called in a forked child: the lock may have been held by another
+        thread of the parent (such as the timer), the timer thread is
+        gone, and the buffered entries are the parent's to write.
+        """
+        self._lock = threading.RLock()
+        self._timer = None
+        self._buffer = []
+        self._bufferSize = 0
+
+
+_writers = weakref.WeakSet()
+
+def _flushWriters():
+    for writer in list(_writers):
+        writer.flush()
+
+def _resetWriters():
+    for writer in list(_writers):
+        writer._afterFork()
+
+atexit.register(_flushWriters)
+concurrency.registerForkHandler(_resetWriters)
@@ -0,0 +1,223 @@
+#!/usr/bin/python
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Job metrics, exported in the Prometheus text exposition format.
+
+Every job runs in its own process, so the metrics are accumulated in a
+state file, updated under an exclusive lock when a job finishes. The text
+file is then regenerated (and atomically replaced), ready to be collected
+by the textfile collector of a node exporter. Durations are histograms;
+percentiles are computed from them on the Prometheus side, with
+C{histogram_quantile}.
+"""
+
+import errno
+import fcntl
+import json
+import logging
+import os
+import tempfile
+
+from conary.lib import util
+
+logger = logging.getLogger(__name__)
+
+
+class Metrics(object):
+    """
+    Counters and histograms of the jobs run with a storage path.
+    @cvar textfilePath: path of the text file to be collected; by default,
+    it is stored in the metrics directory
+    @cvar durationBuckets: upper bounds, in seconds, of the buckets of
+    duration histograms
+    @cvar definitions: map of a metric name to its type and help text
+    """
+    namespace = 'rpath_tools'
+    metricsDir = 'metrics'
+    stateName = 'state.json'
+    textfileName = 'rpath_tools.prom'
+    textfilePath = None
+    durationBuckets = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600,
+        1800, 3600)
+    definitions = {
+        'jobs_total' : ('counter',
+            'Jobs run, by task and final state.'),
+        'job_duration_seconds' : ('histogram',
+            'Time spent running jobs, by task and final state.'),
+        'job_queue_wait_seconds' : ('histogram',
+            'Time jobs spent waiting in the queue, by task.'),
+        'actions_total' : ('counter',
+            'Update actions run, by action and final state.'),
+        'action_duration_seconds' : ('histogram',
+            'Time spent running update actions, by action and final state.'),
+        'action_stage_seconds' : ('histogram',
+            'Time spent in the stages of update actions, by action and '
+            'stage.'),
+    }
+
+    def __init__(self, storagePath, textfilePath=None):
+        self.path = os.path.join(storagePath, self.metricsDir)
+        if textfilePath is not None:
+            self.textfilePath = textfilePath
+        elif self.textfilePath is None:
+            self.textfilePath = os.path.join(self.path, self.textfileName)
+
+    def jobFinished(self, taskName, state, duration=None, queueWait=None):
+        """
+        Record a job of task C{taskName} ending in state C{state}.
+        C{duration} is None if the job did not run.
+        """
+        labels = dict(task=taskName, state=state)
+        def update(data):
+            self._increment(data, 'jobs_total', labels)
+            if duration is not None:
+                self._observe(data, 'job_duration_seconds', labels, duration)
+            if queueWait is not None:
+                self._observe(data, 'job_queue_wait_seconds',
+                    dict(task=taskName), queueWait)
+        self._update(update)
+
+    def actionFinished(self, action, state, duration, stages=()):
+        """
+        Record an update action ending in state C{state}, with the
+        timings of its C{stages} (see L{timings.Timings.asList})
+        """
+        labels = dict(action=action, state=state)
+        def update(data):
+            self._increment(data, 'actions_total', labels)
+            self._observe(data, 'action_duration_seconds', labels, duration)
+            for stage in stages:
+                self._observe(data, 'action_stage_seconds',
+                    dict(action=action, stage=stage['name']),
+                    stage['seconds'])
+        self._update(update)
+
+    def read(self):
+        """Return the accumulated metrics"""
+        try:
+            f = open(os.path.join(self.path, self.stateName))
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return {}
+        try:
+            try:
+                return json.load(f)
+            except ValueError:
+                logger.warning("Ignoring corrupted metrics state in %s",
+                    self.path)
+                return {}
+        finally:
+            f.close()
+
+    def format(self, data=None):
+        """Return the metrics in the Prometheus text exposition format"""
+        if data is None:
+            data = self.read()
+        lines = []
+        for name in sorted(data):
+            if name not in self.definitions:
+                continue
+            metricType, helpText = self.definitions[name]
+            fullName = '%s_%s' % (self.namespace, name)
+            lines.append('# HELP %s %s' % (fullName, helpText))
+            lines.append('# TYPE %s %s' % (fullName, metricType))
+            for labels, value in sorted(data[name].iteritems()):
+                if metricType == 'counter':
+                    lines.append('%s{%s} %s' % (fullName, labels,
+                        self._formatValue(value)))
+                    continue
+                cumulative = 0
+                for bound, count in zip(self.durationBuckets,
+                        value['buckets']):
+                    cumulative += count
+                    lines.append('%s_bucket{%s,le="%s"} %d' % (fullName,
+                        labels, bound, cumulative))
+                lines.append('%s_bucket{%s,le="+Inf"} %d' % (fullName,
+                    labels, value['count']))
+                lines.append('%s_sum{%s} %s' % (fullName, labels,
+                    self._formatValue(value['sum'])))
+                lines.append('%s_count{%s} %d' % (fullName, labels,
+                    value['count']))
+        return ''.join(x + '\n' for x in lines)
+
+    def _update(self, function):
+        util.mkdirChain(self.path)
+        lockFile = open(os.path.join(self.path, self.stateName + '.lock'),
+            'a')
+        try:
+            fcntl.flock(lockFile.fileno(), fcntl.LOCK_EX)
+            data = self.read()
+            function(data)
+            self._writeFile(os.path.join(self.path, self.stateName),
+                json.dumps(data, sort_keys=True))
+            self._writeFile(self.textfilePath, self.format(data))
+        finally:
+            lockFile.close()
+
+    def _increment(self, data, name, labels):
+        values = data.setdefault(name, {})
+        key = self._formatLabels(labels)
+        values[key] = values.get(key, 0) + 1
+
+    def _observe(self, data, name, labels, value):
+        values = data.setdefault(name, {})
+        key = self._formatLabels(labels)
+        histogram = values.get(key)
+        if histogram is None:
+            histogram = values[key] = dict(count=0, sum=0.0,
+                buckets=[ 0 ] * len(self.durationBuckets))
+        histogram['count'] += 1
+        histogram['sum'] += value
+        # Buckets are stored individually; they are made cumulative when
+        # formatted
+        for i, bound in enumerate(self.durationBuckets):
+            if value <= bound:
+                histogram['buckets'][i] += 1
+                break
+
+    @classmethod
+    def _formatLabels(cls, labels):
+        return ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\')
+                .replace('"', '\\"').replace('\n', '\\n'))
+            for key, value in sorted(labels.iteritems()))
+
+    @classmethod
+    def _formatValue(cls, value):
+        if isinstance(value, float):
+            return repr(value)
+        return str(value)
+
+    @classmethod
+    def _writeFile(cls, path, data):
+        dirName = os.path.dirname(path)
+        util.mkdirChain(dirName)
+        fd, tmpPath = tempfile.mkstemp(dir=dirName,
+            prefix='.' + os.path.basename(path) + '.')
+        try:
+            f = os.fdopen(fd, 'w')
+            try:
+                f.write(data)
+            finally:
+                f.close()
+            os.chmod(tmpPath, 0644)
+            os.rename(tmpPath, path)
+        except:
+            os.unlink(tmpPath)
+            raise
@@ -0,0 +1,244 @@
+#!/usr/bin/python
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Sharing of loaded model trove caches.
+"""
+
+import logging
+import os
+import threading
+
+from conary.conaryclient import modelupdate
+from conary.lib import util
+
+from rpath_tools.lib import clientfactory
+from rpath_tools.lib import troveindex
+
+logger = logging.getLogger(__name__)
+
+
+class LazyTroveCache(modelupdate.CMLTroveCache):
+    """
+    Model trove cache that can be saved in two files next to the model
+    cache: the troves go to a memory-mapped L{troveindex} file
+    (C{modelcache.troves}), and are only thawed when the update looks them
+    up; everything else goes to C{modelcache.lazy}, in the regular model
+    cache format.
+    """
+    lazySuffix = '.lazy'
+    trovesSuffix = '.troves'
+
+    def loadLazy(self, path):
+        """Load the cache saved by L{saveLazy} at C{path}"""
+        reader = troveindex.TroveIndexReader(path + self.trovesSuffix)
+        try:
+            self.load(path + self.lazySuffix)
+            if not isinstance(self.cache, dict):
+                raise troveindex.TroveIndexError(
+                    "unsupported model cache layout")
+        except:
+            reader.close()
+            raise
+        self.cache = troveindex.LazyTroveDict(reader, self.cache)
+
+    def saveLazy(self, path):
+        """
+        Save the cache next to C{path}, as loaded by L{loadLazy}. Caches
+        with an unknown layout are saved to C{path} in the regular format.
+        """
+        troves = self.cache
+        if not isinstance(troves, dict):
+            logger.warning("Unsupported model cache layout; "
+                "saving %s in the regular format", path)
+            self.save(path)
+            return
+        leftovers = {}
+
+        def entries():
+            if isinstance(troves, troveindex.LazyTroveDict):
+                for entry in troves.iterRaw():
+                    yield entry
+                added = troves.added()
+            else:
+                added = troves.iteritems()
+            for troveTup, trv in added:
+                try:
+                    entry = troveindex.freezeEntry(troveTup, trv)
+                except Exception:
+                    # Not a trove; it is saved with the rest of the cache
+                    leftovers[troveTup] = trv
+                    continue
+                yield entry
+
+        troveindex.TroveIndexWriter(path + self.trovesSuffix).write(
+            entries())
+        self.cache = leftovers
+        try:
+            self.save(path + self.lazySuffix)
+        finally:
+            self.cache = troves
+
+    def cacheModified(self):
+        troves = self.cache
+        if not isinstance(troves, troveindex.LazyTroveDict):
+            return modelupdate.CMLTroveCache.cacheModified(self)
+        if troves.modified():
+            return True
+        # The troves in the index are not modifications; the rest of the
+        # cache is compared with what was loaded along with the index
+        self.cache = dict(troves.added())
+        try:
+            return modelupdate.CMLTroveCache.cacheModified(self)
+        finally:
+            self.cache = troves
+
+
+class ModelCachePool(object):
+    """
+    Keep model trove caches (C{modelupdate.CMLTroveCache}) loaded for the
+    lifetime of the process, so that only the first update job built by
+    a process pays for loading the model cache from disk.
+
+    A loaded cache is reused by any client of the same conary database as
+    long as the database, the model cache files and the conary
+    configuration do not change. It keeps using the database and
+    repository objects of the client it was loaded for, which are then
+    equivalent to the caller's. L{warm} loads the cache ahead of the first
+    update job, for instance in an idle worker of the L{workerpool}.
+
+    The pool only lives as long as the process. Other processes (such as
+    re-executed job processes) share the lazily loaded trove index below
+    instead, which saves them thawing every trove.
+
+    With C{lazyLoading}, caches are L{LazyTroveCache}s, saved in the lazy
+    format. The regular model cache, which conary itself also writes, is
+    only read if it is newer than the lazy files, and is then converted.
+    """
+    lazyLoading = True
+    lazySuffix = LazyTroveCache.lazySuffix
+    trovesSuffix = LazyTroveCache.trovesSuffix
+
+    _cache = {}
+    _lock = threading.RLock()
+
+    def get(self, cclient, path, callback=None):
+        """
+        Return a model trove cache for C{cclient}, loaded from C{path}
+        """
+        cfg = cclient.cfg
+        dbPath = util.joinPaths(cfg.root, cfg.dbPath)
+        self._lock.acquire()
+        try:
+            cached = self._cache.get(path)
+            if (cached is not None and cached[0] == dbPath and
+                    cached[1] == self._stamp(path)):
+                cache = cached[2]
+                cache.callback = callback
+                logger.info("using loaded model cache for %s", path)
+                return cache
+            cache = self._load(cclient.getDatabase(), cclient.getRepos(),
+                path, callback)
+            self._cache[path] = (dbPath, self._stamp(path), cache)
+            return cache
+        finally:
+            self._lock.release()
+
+    def save(self, cache, path):
+        """
+        Save C{cache} to C{path}, keeping it current in the pool
+        """
+        self._lock.acquire()
+        try:
+            if self.lazyLoading:
+                cache.saveLazy(path)
+            else:
+                cache.save(path)
+            cached = self._cache.get(path)
+            if cached is not None and cached[2] is cache:
+                self._cache[path] = (cached[0], self._stamp(path), cache)
+        finally:
+            self._lock.release()
+
+    def warm(self, cclient, path):
+        """Load the model cache for C{cclient} ahead of its first use"""
+        self.get(cclient, path)
+
+    @classmethod
+    def clearCache(cls):
+        cls._lock.acquire()
+        try:
+            cls._cache.clear()
+        finally:
+            cls._lock.release()
+
+    def _load(self, db, repos, path, callback):
+        if not self.lazyLoading:
+            cache = modelupdate.CMLTroveCache(db, repos, callback=callback)
+            if os.path.exists(path):
+                logger.info("loading model cache from %s", path)
+                if callback:
+                    callback.loadingModelCache()
+                cache.load(path)
+            return cache
+        if self._isLazyCurrent(path):
+            logger.info("loading model cache from %s", path + self.lazySuffix)
+            cache = LazyTroveCache(db, repos, callback=callback)
+            if callback:
+                callback.loadingModelCache()
+            try:
+                cache.loadLazy(path)
+                return cache
+            except (troveindex.TroveIndexError, EnvironmentError), e:
+                logger.warning("Unable to load model cache from %s: %s",
+                    path + self.lazySuffix, e)
+        cache = LazyTroveCache(db, repos, callback=callback)
+        if os.path.exists(path):
+            logger.info("loading model cache from %s", path)
+            if callback:
+                callback.loadingModelCache()
+            cache.load(path)
+            logger.info("converting model cache %s", path)
+            cache.saveLazy(path)
+        return cache
+
+    def _isLazyCurrent(self, path):
+        lazyPath = path + self.lazySuffix
+        if not (os.path.exists(lazyPath) and
+                os.path.exists(path + self.trovesSuffix)):
+            return False
+        if not os.path.exists(path):
+            return True
+        return os.stat(lazyPath).st_mtime >= os.stat(path).st_mtime
+
+    def _stamp(self, path):
+        # The model cache lives next to the conary database
+        paths = [ path, os.path.join(os.path.dirname(path), 'conarydb') ]
+        if self.lazyLoading:
+            paths.extend([ path + self.lazySuffix, path + self.trovesSuffix ])
+        # The repository objects depend on the configuration
+        return (tuple(self._statKey(x) for x in paths),
+            clientfactory.ConaryClientFactory.configStamp())
+
+    @classmethod
+    def _statKey(cls, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime)
@@ -0,0 +1,131 @@
+#!/usr/bin/python
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Optional profiling of jobs.
+
+Profiling is requested per task, or for every job with the
+C{RPATH_TOOLS_PROFILE} environment variable, set to a comma-separated list
+of profiles: C{cpu} (cProfile), C{memory} (tracemalloc), or C{all}.
+tracemalloc is not part of every python version; without it, the memory
+report only has the peak resident set size of the process.
+"""
+
+import cProfile
+import pstats
+import resource
+import StringIO
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+class Profiler(object):
+    """
+    Run a function under the requested profilers, and keep their reports
+    in C{cpuReport} and C{memoryReport}.
+    @cvar limit: number of entries in the reports
+    """
+    envVar = 'RPATH_TOOLS_PROFILE'
+    profiles = ('cpu', 'memory')
+    limit = 40
+
+    def __init__(self, profiles):
+        self.profiles = frozenset(profiles)
+        self.cpuReport = None
+        self.memoryReport = None
+
+    @classmethod
+    def parse(cls, value):
+        """
+        Return the set of profiles in C{value}, a comma-separated list
+        """
+        profiles = set()
+        for name in value.split(','):
+            name = name.strip()
+            if name == 'all':
+                profiles.update(cls.profiles)
+            elif name in cls.profiles:
+                profiles.add(name)
+            elif name:
+                raise ValueError("unknown profile %r" % name)
+        return profiles
+
+    @classmethod
+    def fromEnvironment(cls, environ):
+        """
+        Return the set of profiles requested in C{environ}
+        """
+        value = environ.get(cls.envVar)
+        if not value:
+            return set()
+        try:
+            return cls.parse(value)
+        except ValueError:
+            # A typo should not break jobs
+            return set()
+
+    def runcall(self, function, *args, **kwargs):
+        """
+        Call C{function} under the profilers and return its result. The
+        reports are generated even if it raises an exception.
+        """
+        cpuProfiler = None
+        memory = 'memory' in self.profiles
+        if memory:
+            self._startMemory()
+        try:
+            if 'cpu' in self.profiles:
+                cpuProfiler = cProfile.Profile()
+                return cpuProfiler.runcall(function, *args, **kwargs)
+            return function(*args, **kwargs)
+        finally:
+            if cpuProfiler is not None:
+                self.cpuReport = self._cpuReport(cpuProfiler)
+            if memory:
+                self.memoryReport = self._stopMemory()
+
+    def _cpuReport(self, cpuProfiler):
+        stream = StringIO.StringIO()
+        stats = pstats.Stats(cpuProfiler, stream=stream)
+        stats.sort_stats('cumulative').print_stats(self.limit)
+        return stream.getvalue()
+
+    def _startMemory(self):
+        if tracemalloc is not None and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def _stopMemory(self):
+        lines = []
+        if tracemalloc is not None and tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            lines.append("Traced memory: %d KiB, peak: %d KiB" %
+                (current / 1024, peak / 1024))
+            lines.append("Top %d allocations by line:" % self.limit)
+            lines.extend(str(x) for x in
+                snapshot.statistics('lineno')[:self.limit])
+        else:
+            lines.append("tracemalloc is not available")
+        # ru_maxrss is in kilobytes on Linux
+        lines.append("Peak resident set size: %d KiB" %
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,144 @@
+#!/usr/bin/python
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Out-of-band removal of expired stored objects.
+
+Expiring an object is done in two steps: the object is first renamed into
+the storage's trash directory, which is cheap and can be done while
+iterating over objects, and the trash is emptied later by the reaper,
+within a time budget.
+"""
+
+import errno
+import logging
+import os
+import stat
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class ReaperStats(object):
+    """
+    @ivar expired: number of expired objects moved to the trash
+    @ivar jobs: number of trashed objects completely removed
+    @ivar bytes: number of bytes freed
+    @ivar pending: number of trashed objects left for a later run
+    """
+    __slots__ = [ 'expired', 'jobs', 'bytes', 'pending', ]
+
+    def __init__(self):
+        for s in self.__slots__:
+            setattr(self, s, 0)
+
+    def __repr__(self):
+        return "<%s object at %s; %s>" % (self.__class__.__name__,
+            id(self), ', '.join("%s=%s" % (x, getattr(self, x))
+                for x in self.__slots__))
+
+    __str__ = __repr__
+
+
+class ExpiryReaper(object):
+    """
+    Remove the expired objects produced by a L{StoredObjectsFactory}.
+    @cvar batchSize: maximum number of expired objects moved to the trash,
+    and of trashed objects removed, in one run
+    @cvar timeBudget: number of seconds after which a run stops removing
+    files; whatever is left is picked up by the next run
+    """
+    batchSize = 100
+    timeBudget = 5.0
+
+    def __init__(self, factory, batchSize=None, timeBudget=None):
+        self.factory = factory
+        if batchSize is not None:
+            self.batchSize = batchSize
+        if timeBudget is not None:
+            self.timeBudget = timeBudget
+
+    def run(self, now=None):
+        if now is None:
+            now = time.time()
+        deadline = time.time() + self.timeBudget
+        stats = ReaperStats()
+        strg = self.factory.factory.getStorage(self.factory.storagePath)
+
+        expired = self.factory.expired(now)[:self.batchSize]
+        for key in expired:
+            if strg.trash(key) is not None:
+                stats.expired += 1
+        index = self.factory.getIndex()
+        if index is not None and expired:
+            index.remove(expired)
+
+        trashPath = strg.getTrashPath()
+        try:
+            trashed = sorted(os.listdir(trashPath))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            trashed = []
+        for i, name in enumerate(trashed):
+            if i >= self.batchSize or time.time() > deadline:
+                stats.pending = len(trashed) - i
+                break
+            if self._remove(os.path.join(trashPath, name), deadline, stats):
+                stats.jobs += 1
+            else:
+                stats.pending = len(trashed) - i
+                break
+        logger.info("Reaped expired objects: %s", stats)
+        return stats
+
+    @classmethod
+    def _remove(cls, path, deadline, stats):
+        """
+        Remove path, stopping at the deadline.
+        Return True if the path was removed completely.
+        """
+        try:
+            st = os.lstat(path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return True
+        if not stat.S_ISDIR(st.st_mode):
+            cls._unlink(path, st, stats)
+            return True
+        for dirPath, dirNames, fileNames in os.walk(path, topdown=False):
+            for fileName in fileNames + [ x for x in dirNames
+                    if os.path.islink(os.path.join(dirPath, x)) ]:
+                if time.time() > deadline:
+                    return False
+                fpath = os.path.join(dirPath, fileName)
+                cls._unlink(fpath, os.lstat(fpath), stats)
+            for dirName in dirNames:
+                fpath = os.path.join(dirPath, dirName)
+                if os.path.isdir(fpath) and not os.path.islink(fpath):
+                    os.rmdir(fpath)
+        os.rmdir(path)
+        return True
+
+    @classmethod
+    def _unlink(cls, path, st, stats):
+        os.unlink(path)
+        # Files still linked from elsewhere do not free any space
+        if st.st_nlink == 1:
+            stats.bytes += st.st_size
@@ -0,0 +1,296 @@
+#!/usr/bin/python
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Local job scheduler.
+
+Tasks still run in their own (detached) process, but before doing any work
+the process enters a persistent queue and waits for a slot. Every kind of
+task maps to a resource with a fixed number of slots: previews can run a
+few at a time, while everything that modifies the conary database shares a
+single slot, so they never race on it.
+
+Slots are exclusive locks on per-resource lock files; the operating system
+releases them if the process holding them dies. Code that may run either
+in a task process or directly in a caller's process (see
+L{update.SyncModel}) acquires its slot as reentrant: it gets it at once
+if the calling thread already holds a slot for the same resource. Queue entries are stored
+objects (see L{stored_objects.QueuedTask}); entries left behind by dead
+processes are dropped the next time the queue is read. The queue order
+is read from the queue's index (see L{stored_index.QueueIndex}), so
+waiting tasks read a single file every time they poll.
+"""
+
+import errno
+import fcntl
+import logging
+import os
+import signal
+import thread
+import time
+
+from conary.lib import util
+
+from rpath_tools.lib import stored_objects
+
+logger = logging.getLogger(__name__)
+
+
+class TaskCancelled(Exception):
+    "Raised in a running task when it gets cancelled"
+
+
+class Slot(object):
+    """
+    A slot held by a running task. It must be released once the task
+    finishes.
+    @ivar waited: number of seconds spent in the queue
+    """
+    def __init__(self, scheduler, entry, lockFile, waited,
+            interruptible=False, resource=None):
+        self.scheduler = scheduler
+        self.entry = entry
+        self.waited = waited
+        self._lockFile = lockFile
+        self._resource = resource
+        self._oldHandler = None
+        if interruptible:
+            # Cancelling a running task terminates it
+            self._oldHandler = signal.signal(signal.SIGTERM,
+                self._terminated)
+
+    @classmethod
+    def _terminated(cls, signum, frame):
+        raise TaskCancelled("Task cancelled")
+
+    def release(self):
+        if self._lockFile is None:
+            return
+        if self._oldHandler is not None:
+            signal.signal(signal.SIGTERM, self._oldHandler)
+            self._oldHandler = None
+        self._lockFile.close()
+        self._lockFile = None
+        if self._resource is not None:
+            self.scheduler._held.pop(self._resource, None)
+        self.scheduler._remove(self.entry)
+
+
+class Scheduler(object):
+    """
+    Queue tasks and hand out slots to them.
+    @cvar resources: map of a task kind to the resource it uses and the
+    number of tasks that can use the resource at the same time
+    @cvar interruptible: kinds of tasks that can be cancelled while running
+    @cvar pollInterval: number of seconds between checks of the queue
+    while waiting for a slot
+    """
+    resources = {
+        'preview' : ('preview', 2),
+        'download' : ('conarydb', 1),
+        'apply' : ('conarydb', 1),
+        'update' : ('conarydb', 1),
+    }
+    interruptible = frozenset([ 'preview', 'download', ])
+    pollInterval = 0.5
+    lockDir = 'locks'
+
+    # Resources whose slot is held in this process, mapped to the
+    # (pid, thread id) holding them
+    _held = {}
+
+    def __init__(self, storagePath):
+        self.storagePath = storagePath
+        self.factory = stored_objects.QueuedTaskFactory(storagePath)
+        self.lockPath = os.path.join(storagePath,
+            stored_objects.QueuedTask.prefix, self.lockDir)
+
+    def acquire(self, jobId, kind, priority=0, timeout=None,
+            reentrant=False, interruptible=True):
+        """
+        Queue the job C{jobId} and wait for a slot for its kind. Tasks with
+        a higher C{priority} are served first; tasks with the same priority
+        are served in the order they were queued.
+        @param reentrant: if the calling thread already holds a slot for
+        the same resource, return a slot at once; releasing it is a no-op
+        @param interruptible: allow cancelling the task while it runs, if
+        its kind allows it. Cancelling a running task terminates the
+        process holding the slot.
+        @return: a L{Slot}, or None if the job was cancelled or C{timeout}
+        seconds passed before a slot was available
+        """
+        resource, count = self.resources[kind]
+        holder = (os.getpid(), thread.get_ident())
+        if reentrant and self._held.get(resource) == holder:
+            return Slot(self, None, None, 0.0)
+        interruptible = interruptible and kind in self.interruptible
+        entry = self.factory.new()
+        entry.kind = kind
+        entry.priority = priority
+        entry.jobId = jobId
+        entry.pid = os.getpid()
+        entry.interruptible = interruptible
+        entry.state = "Queued"
+        start = time.time()
+        try:
+            while True:
+                if entry.state == "Cancelled":
+                    logger.info("Job %s cancelled while queued", jobId)
+                    self._remove(entry)
+                    return None
+                if self._isNext(entry, resource):
+                    lockFile = self._lock(resource, count)
+                    if lockFile is not None:
+                        entry.state = "Running"
+                        self._held[resource] = holder
+                        waited = time.time() - start
+                        logger.info("Job %s waited %.2f seconds for a %s slot",
+                            jobId, waited, resource)
+                        return Slot(self, entry, lockFile, waited,
+                            interruptible=interruptible, resource=resource)
+                if timeout is not None and time.time() - start >= timeout:
+                    self._remove(entry)
+                    return None
+                time.sleep(self.pollInterval)
+        except:
+            self._remove(entry)
+            raise
+
+    def cancel(self, jobId):
+        """
+        Cancel the job C{jobId}. Queued jobs are dropped from the queue;
+        running jobs are terminated if they are interruptible.
+        @return: True if the job was cancelled
+        """
+        for entry in self.entries():
+            if entry.jobId != jobId:
+                continue
+            state = entry.state
+            if state == "Queued":
+                entry.state = "Cancelled"
+                return True
+            interruptible = entry.interruptible
+            if interruptible is None:
+                # Queued by an older version
+                interruptible = entry.kind in self.interruptible
+            if state == "Running" and interruptible:
+                self._kill(entry.pid, signal.SIGTERM)
+                return True
+        return False
+
+    def entries(self):
+        """
+        Return the queue entries of live processes
+        """
+        return [ self.factory.load(x['key']) for x in self._queue() ]
+
+    def stats(self, now=None):
+        """
+        Return a dictionary mapping every task kind to the number of
+        queued and running tasks, and to the number of seconds the oldest
+        queued task has been waiting
+        """
+        if now is None:
+            now = time.time()
+        stats = dict((x, dict(queued=0, running=0, oldestWait=0.0))
+            for x in self.resources)
+        for entry in self.entries():
+            kindStats = stats.get(entry.kind)
+            if kindStats is None:
+                continue
+            state = entry.state
+            if state == "Running":
+                kindStats['running'] += 1
+            elif state == "Queued":
+                kindStats['queued'] += 1
+                kindStats['oldestWait'] = max(kindStats['oldestWait'],
+                    now - (entry.created or now))
+        return stats
+
+    def _isNext(self, entry, resource):
+        """
+        Check whether C{entry} is the first entry waiting for C{resource}
+        """
+        waiting = []
+        for other in self._queue():
+            if (other.get('state') != "Queued" or
+                    self.resources.get(other.get('kind'),
+                        (None,))[0] != resource):
+                continue
+            waiting.append((-(other.get('priority') or 0),
+                other.get('created'), other['key']))
+        return bool(waiting) and min(waiting)[2] == entry.keyId
+
+    def _queue(self):
+        """
+        Return the index entries (see L{stored_index.QueueIndex}) of the
+        queue entries of live processes, dropping the others
+        """
+        ret = []
+        for entry in self.factory.getIndex().entries().itervalues():
+            pid = entry.get('pid')
+            if pid is not None and not self._isAlive(int(pid)):
+                self._remove(self.factory.load(entry['key']))
+                continue
+            ret.append(entry)
+        return ret
+
+    def _lock(self, resource, count):
+        """
+        Try to lock one of the C{count} slots of C{resource}. Return the
+        open lock file, or None if all slots are taken
+        """
+        util.mkdirChain(self.lockPath)
+        for i in range(count):
+            lockFile = open(os.path.join(self.lockPath,
+                '%s.%d' % (resource, i)), 'a')
+            try:
+                fcntl.flock(lockFile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError, e:
+                lockFile.close()
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                continue
+            return lockFile
+        return None
+
+    def _remove(self, entry):
+        strg = entry.storage
+        strg.delete(entry.keyId)
+        index = entry.getIndex(strg)
+        if index is not None:
+            index.remove([ entry.keyId ])
+
+    @classmethod
+    def _isAlive(cls, pid):
+        try:
+            os.kill(pid, 0)
+        except OSError, e:
+            if e.errno == errno.ESRCH:
+                return False
+            if e.errno != errno.EPERM:
+                raise
+        return True
+
+    @classmethod
+    def _kill(cls, pid, sig):
+        try:
+            os.kill(pid, sig)
+        except OSError, e:
+            if e.errno != errno.ESRCH:
+                raise
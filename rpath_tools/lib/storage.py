@@ -17,7 +17,11 @@
 
 
 import collections
+import errno
+import fcntl
+import json
 import os
+import tempfile
 import uuid
 
 from conary.lib import util
@@ -178,6 +182,18 @@ class BaseStorage(object):
             return self._real_delete_collection(key)
         return self._real_delete(key)
 
+    def trash(self, key):
+        """Move a key out of the way, to be deleted later.
+        This is meant to be much cheaper than deleting the key.
+        @param key: the key
+        @type key: C{str}
+        @rtype: C{str}
+        @return: the location of the trashed key, or None if the key did not
+        exist
+        """
+        key = self._sanitizeKey(key)
+        return self._real_trash(key)
+
     def getFileFromKey(self, key):
         key = self._sanitizeKey(key)
         return self._real_get_file_from_key(key)
@@ -224,6 +240,9 @@ class BaseStorage(object):
     def _real_delete_collection(self, key):
         raise NotImplementedError()
 
+    def _real_trash(self, key):
+        raise NotImplementedError()
+
     def _real_enumerate(self, keyPrefix):
         raise NotImplementedError()
 
@@ -235,7 +254,13 @@ class BaseStorage(object):
     #}
 
 class DiskStorage(BaseStorage):
+    """
+    Storage keeping every key in its own file under C{cfg.storagePath}.
+    @cvar trashDir: directory, relative to the storage path, where trashed
+    keys are moved
+    """
     separator = os.sep
+    trashDir = '.trash'
 
     def __init__(self, cfg):
         """Constructor
@@ -287,6 +312,22 @@ class DiskStorage(BaseStorage):
         fpath = self._getFileForKey(key)
         util.rmtree(fpath, ignore_errors = True)
 
+    def _real_trash(self, key):
+        fpath = self._getFileForKey(key)
+        trashPath = self.getTrashPath()
+        util.mkdirChain(trashPath)
+        dest = os.path.join(trashPath, self._generateString())
+        try:
+            os.rename(fpath, dest)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        return dest
+
+    def getTrashPath(self):
+        return os.path.join(self.cfg.storagePath, self.trashDir)
+
     def _real_enumerate(self, keyPrefix = None):
         if keyPrefix is None:
             collection = self.cfg.storagePath
@@ -313,6 +354,175 @@ class DiskStorage(BaseStorage):
 
     _real_get_file_from_key = _getFileForKey
 
+class RecordStorage(DiskStorage):
+    """
+    Disk storage that keeps small scalar fields of a collection in a single
+    record file instead of one file per field. The record is rewritten
+    atomically (write to a temporary file, then rename) so readers never
+    see a partial update. Writers hold an exclusive lock on a sidecar file
+    while they read, modify and rewrite the record, so concurrent updates
+    of different fields do not undo each other.
+    Fields that are not listed in C{recordFields} are stored as plain files,
+    and values already stored as plain files by L{DiskStorage} are still
+    readable until they get overwritten.
+    @cvar recordFields: names of the fields to be kept in the record
+    @cvar recordName: name of the record file inside the collection
+    @cvar lockName: name of the file locked while updating the record
+    """
+    recordFields = frozenset([ 'created', 'updated', 'expiration', 'state',
+        'pid', 'downloadSize', 'queueWait', 'kind', 'priority', 'jobId',
+        'interruptible', ])
+    recordName = '.record'
+    lockName = recordName + '.lock'
+
+    def setFields(self, kvlist):
+        """Set (or delete, if the value is C{None}) several fields at once.
+        All record fields belonging to the same collection are written with
+        a single record update.
+        """
+        records = {}
+        for k, v in kvlist:
+            key = self._sanitizeKey(k)
+            recordKey, field = self._splitRecordKey(key)
+            if field is None:
+                if v is None:
+                    self.delete(key)
+                else:
+                    self._real_set(key, v)
+                continue
+            records.setdefault(recordKey, []).append((field, v))
+        for recordKey, fields in records.iteritems():
+            self._updateRecord(recordKey, fields)
+
+    def _splitRecordKey(self, key):
+        recordKey, field = os.path.split(key)
+        if not recordKey or field not in self.recordFields:
+            return key, None
+        return recordKey, field
+
+    def _getRecordFile(self, recordKey):
+        return self.separator.join([self.cfg.storagePath, recordKey,
+            self.recordName])
+
+    def _readRecord(self, recordKey):
+        try:
+            data = file(self._getRecordFile(recordKey)).read()
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return {}
+        try:
+            record = json.loads(data)
+        except ValueError:
+            # A corrupted record is treated as missing; plain files, if
+            # any, will be used instead
+            return {}
+        return dict((str(k), v.encode('utf-8'))
+            for k, v in record.iteritems())
+
+    def _writeRecord(self, recordKey, record):
+        fpath = self._getRecordFile(recordKey)
+        dirName = os.path.dirname(fpath)
+        try:
+            fd, tmpPath = tempfile.mkstemp(dir=dirName,
+                prefix=self.recordName + '.')
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            util.mkdirChain(dirName)
+            fd, tmpPath = tempfile.mkstemp(dir=dirName,
+                prefix=self.recordName + '.')
+        try:
+            try:
+                os.write(fd, json.dumps(record, separators=(',', ':')))
+            finally:
+                os.close(fd)
+            os.rename(tmpPath, fpath)
+        except:
+            os.unlink(tmpPath)
+            raise
+        return fpath
+
+    def _lockRecord(self, recordKey):
+        """
+        Return the record's lock file, opened and locked exclusively; the
+        lock is released when the file is closed
+        """
+        fpath = self.separator.join([self.cfg.storagePath, recordKey,
+            self.lockName])
+        try:
+            f = open(fpath, 'a')
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            util.mkdirChain(os.path.dirname(fpath))
+            f = open(fpath, 'a')
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        return f
+
+    def _updateRecord(self, recordKey, fields):
+        lock = self._lockRecord(recordKey)
+        try:
+            record = self._readRecord(recordKey)
+            for field, val in fields:
+                if val is None:
+                    record.pop(field, None)
+                    # Make sure a stale plain file does not show up again
+                    DiskStorage._real_delete(self,
+                        self.separator.join([recordKey, field]))
+                else:
+                    record[field] = str(val)
+            return self._writeRecord(recordKey, record)
+        finally:
+            lock.close()
+
+    def _real_get(self, key):
+        recordKey, field = self._splitRecordKey(key)
+        if field is not None:
+            val = self._readRecord(recordKey).get(field)
+            if val is not None:
+                return val
+        return DiskStorage._real_get(self, key)
+
+    def _real_set(self, key, val):
+        recordKey, field = self._splitRecordKey(key)
+        if field is None:
+            return DiskStorage._real_set(self, key, val)
+        return self._updateRecord(recordKey, [ (field, val) ])
+
+    def _real_exists(self, key):
+        recordKey, field = self._splitRecordKey(key)
+        if field is not None and field in self._readRecord(recordKey):
+            return True
+        return DiskStorage._real_exists(self, key)
+
+    def _real_delete(self, key):
+        recordKey, field = self._splitRecordKey(key)
+        if field is None:
+            return DiskStorage._real_delete(self, key)
+        if not os.path.exists(self._getRecordFile(recordKey)):
+            return DiskStorage._real_delete(self, key)
+        self._updateRecord(recordKey, [ (field, None) ])
+
+    def _real_enumerate(self, keyPrefix = None):
+        keys = DiskStorage._real_enumerate(self, keyPrefix)
+        if keyPrefix is None:
+            recordPath = self.recordName
+        else:
+            keyPrefix = keyPrefix.rstrip(self.separator)
+            recordPath = self.separator.join([keyPrefix, self.recordName])
+        # The record, its lock and any leftover temporary files are never
+        # keys, even when the record itself is missing
+        tmpPrefix = recordPath + '.'
+        hasRecord = recordPath in keys
+        keys = set(x for x in keys
+            if x != recordPath and not x.startswith(tmpPrefix))
+        if hasRecord and keyPrefix is not None:
+            # Expose the record's fields instead
+            keys.update(self.separator.join([keyPrefix, x])
+                for x in self._readRecord(keyPrefix))
+        return sorted(keys)
+
 class StorageConfig(object):
     """
     Storage configuration object.
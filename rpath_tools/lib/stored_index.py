@@ -0,0 +1,308 @@
+#!/usr/bin/python
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Persistent secondary index over stored objects.
+
+The index keeps the update time, expiration time and state of every object
+sharing a key prefix, so that questions like "which is the newest object"
+or "which objects have expired" can be answered by reading a single file
+instead of opening the fields of every object.
+
+The index is an append-only journal of JSON lines, one line per change;
+later lines override earlier ones. It is compacted once it grows well past
+the number of live entries, and rebuilt from the objects themselves if it
+is missing or cannot be parsed.
+"""
+
+import errno
+import fcntl
+import json
+import os
+import tempfile
+import time
+
+from conary.lib import util
+
+
+class StoredObjectIndex(object):
+    """
+    Index of the objects stored under C{keyPrefix} in C{storage}.
+    @cvar indexDir: directory, relative to the storage path, holding the
+    index files
+    @cvar indexedFields: stored fields tracked by the index
+    @cvar textFields: indexed fields kept as strings; the others are
+    numbers
+    @cvar compactThreshold: minimum number of journal lines before a
+    compaction is considered
+    """
+    indexDir = '.index'
+    indexedFields = ('updated', 'expiration', 'state')
+    textFields = ('state', )
+    compactThreshold = 1000
+
+    def __init__(self, storage, keyPrefix):
+        self.storage = storage
+        self.keyPrefix = keyPrefix
+        self.path = os.path.join(storage.cfg.storagePath, self.indexDir,
+            keyPrefix)
+
+    def update(self, keyId, fields):
+        """
+        Record changes to the indexed fields of an object.
+        @param keyId: the object's key
+        @param fields: (key, value) pairs, as passed to the storage's
+        C{setFields}. Fields that are not indexed are ignored.
+        """
+        entry = {}
+        for key, val in fields:
+            name = key[-1] if isinstance(key, tuple) else key
+            if name not in self.indexedFields:
+                continue
+            entry[name] = self._convert(name, val)
+        if not entry:
+            return
+        entry['key'] = keyId
+        self._append([ entry ])
+
+    def remove(self, keyIds):
+        """Drop objects from the index"""
+        self._append([ dict(key=x, deleted=True) for x in keyIds ])
+
+    def entries(self):
+        """
+        Return a dictionary keyed on the object key, with a dictionary of
+        the indexed fields as value.
+        The index is reconciled with the list of objects in the storage:
+        objects removed behind the index' back are dropped, and objects it
+        does not know about yet are added.
+        """
+        entries, lineCount = self._load()
+        if entries is None:
+            entries = self.rebuild()
+            lineCount = len(entries)
+        keys = set(self.storage.enumerate(keyPrefix=self.keyPrefix))
+        vanished = [ x for x in entries if x not in keys ]
+        missing = [ self._readEntry(x) for x in keys if x not in entries ]
+        if vanished or missing:
+            for key in vanished:
+                del entries[key]
+            for entry in missing:
+                entries[entry['key']] = entry
+            self._append([ dict(key=x, deleted=True) for x in vanished ]
+                + missing)
+            lineCount += len(vanished) + len(missing)
+        if self._needsCompaction(entries, lineCount):
+            self._compact()
+        return entries
+
+    def newest(self, now=None):
+        """
+        Return the keys of the objects that have not expired yet, the most
+        recently updated first.
+        """
+        if now is None:
+            now = time.time()
+        entries = [ x for x in self.entries().itervalues()
+            if not self._isExpired(x, now) ]
+        # Objects without an update time sort last; ties are broken by key,
+        # the same order a directory scan would produce.
+        entries.sort(key=lambda x: (x.get('updated') is None,
+            -(x.get('updated') or 0), x['key']))
+        return [ x['key'] for x in entries ]
+
+    def expired(self, before=None):
+        """Return the keys of the objects that expired before C{before}"""
+        if before is None:
+            before = time.time()
+        return sorted(x['key'] for x in self.entries().itervalues()
+            if self._isExpired(x, before))
+
+    def rebuild(self):
+        """Recreate the index from the objects' stored fields"""
+        entries = {}
+        for key in self.storage.enumerate(keyPrefix=self.keyPrefix):
+            entries[key] = self._readEntry(key)
+        self._write(entries)
+        return entries
+
+    @classmethod
+    def _isExpired(cls, entry, now):
+        expiration = entry.get('expiration')
+        return bool(expiration and expiration < now)
+
+    @classmethod
+    def _convert(cls, name, val):
+        if val is None:
+            return None
+        if name in cls.textFields:
+            return str(val).strip()
+        val = str(val).strip()
+        if not val:
+            return None
+        return float(val)
+
+    def _readEntry(self, keyId):
+        entry = dict(key=keyId)
+        for name in self.indexedFields:
+            entry[name] = self._convert(name,
+                self.storage.get((keyId, name)))
+        return entry
+
+    def _load(self):
+        """
+        Read the journal, returning the entries and the number of lines,
+        or (None, 0) if the index needs to be rebuilt.
+        """
+        try:
+            f = open(self.path)
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None, 0
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_SH)
+            return self._parse(f)
+        finally:
+            f.close()
+
+    def _parse(self, f):
+        entries = {}
+        lineCount = 0
+        for line in f:
+            lineCount += 1
+            try:
+                if not line.endswith('\n'):
+                    # Torn write
+                    raise ValueError(line)
+                entry = json.loads(line)
+                key = str(entry.pop('key'))
+                deleted = entry.pop('deleted', False)
+                entry = dict((str(k), self._convert(k, v))
+                    for k, v in entry.iteritems())
+            except (ValueError, KeyError, AttributeError, TypeError):
+                return None, 0
+            if deleted:
+                entries.pop(key, None)
+                continue
+            entries.setdefault(key, dict(key=key)).update(entry)
+        return entries, lineCount
+
+    def _needsCompaction(self, entries, lineCount):
+        return (lineCount > self.compactThreshold and
+            lineCount > 2 * len(entries))
+
+    def _compact(self):
+        """
+        Rewrite the journal with a single line per object. The journal is
+        read again while holding its exclusive lock, which is only released
+        once the compacted journal replaced it, so that lines appended
+        since the caller loaded it are not lost.
+        """
+        f = self._openJournal()
+        try:
+            f.seek(0)
+            entries, lineCount = self._parse(f)
+            if entries is not None and self._needsCompaction(entries,
+                    lineCount):
+                self._write(entries, journal=f)
+        finally:
+            f.close()
+
+    def _openJournal(self):
+        # Open the journal for appending, making sure we did not get a file
+        # that was replaced by a concurrent compaction.
+        while True:
+            try:
+                f = open(self.path, 'a+')
+            except IOError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                util.mkdirChain(os.path.dirname(self.path))
+                continue
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                if os.fstat(f.fileno()).st_ino == os.stat(self.path).st_ino:
+                    return f
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    f.close()
+                    raise
+            f.close()
+
+    def _append(self, entries):
+        if not entries:
+            return
+        if not os.path.exists(self.path):
+            # Start from the current state of the storage, which will
+            # include these changes
+            self.rebuild()
+            return
+        data = ''.join(json.dumps(x, separators=(',', ':')) + '\n'
+            for x in entries)
+        f = self._openJournal()
+        try:
+            f.write(data)
+        finally:
+            f.close()
+
+    def _write(self, entries, journal=None):
+        """
+        Replace the journal with one line per entry.
+        @param journal: the current journal, already opened and locked
+        (see L{_openJournal}) by the caller
+        """
+        dirName = os.path.dirname(self.path)
+        util.mkdirChain(dirName)
+        fd, tmpPath = tempfile.mkstemp(dir=dirName,
+            prefix='.' + self.keyPrefix + '.')
+        try:
+            f = os.fdopen(fd, 'w')
+            try:
+                for key in sorted(entries):
+                    f.write(json.dumps(entries[key], separators=(',', ':')))
+                    f.write('\n')
+            finally:
+                f.close()
+            if journal is not None:
+                os.rename(tmpPath, self.path)
+            elif os.path.exists(self.path):
+                # Hold the old journal's lock while replacing it, so
+                # appenders notice the switch
+                lf = self._openJournal()
+                try:
+                    os.rename(tmpPath, self.path)
+                finally:
+                    lf.close()
+            else:
+                os.rename(tmpPath, self.path)
+        except:
+            if os.path.exists(tmpPath):
+                os.unlink(tmpPath)
+            raise
+
+
+class QueueIndex(StoredObjectIndex):
+    """
+    Index of the job scheduler's queue. It also tracks the fields the
+    scheduler orders the queue by, so that tasks waiting for a slot only
+    read the index.
+    """
+    indexedFields = StoredObjectIndex.indexedFields + ('created', 'kind',
+        'priority', 'pid')
+    textFields = ('state', 'kind')
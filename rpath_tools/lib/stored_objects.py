@@ -16,10 +16,20 @@
 #
 
 
+import bisect
+import errno
+import heapq
+import itertools
+import json
 import os
+import select
+import tempfile
 import time
+import uuid
 
+import logsegment
 import storage
+import stored_index
 
 class Log(object):
     __slots__ = [ 'timestamp', 'content' ]
@@ -40,42 +50,160 @@ class Log(object):
     __str__ = __repr__
 
 class LogEntryMixIn(object):
+    _logWriter = None
+
     class _LogList(object):
         _subdir = 'logs'
-        def __init__(self, keyId, storage):
+        def __init__(self, keyId, storage, writer = None):
             self.keyId = keyId
             self.storage = storage
+            self.writer = writer
+
+        @property
+        def segment(self):
+            return logsegment.LogSegment(self.storage.getFileFromKey(
+                (self.keyId, self._subdir)))
 
         def add(self, content, timestamp = None):
             if timestamp is None:
                 timestamp = time.time()
-            if isinstance(timestamp, basestring):
-                timestamp = float(timestamp)
-            for i in range(10):
-                # Catch collisions. This is not intended to be cross-process
-                # foolproof
-                key = (self.keyId, self._subdir, "%.4f" % timestamp)
-                if not self.storage.exists(key):
-                    break
-                timestamp += 0.0001
-            self.storage.set(key, content)
-            return Log(timestamp = key[-1], content = content)
+            timestamp = float(timestamp)
+            if self.writer is not None:
+                timestamp = self.writer.add(content, timestamp)
+            else:
+                timestamp, = self.segment.append([ (timestamp, str(content)) ])
+            return Log(timestamp = "%.4f" % timestamp, content = content)
 
         def enumerate(self):
-            for key in sorted(self.storage.enumerate((self.keyId, self._subdir))):
+            return self._iterate()
+
+        def since(self, timestamp = None, limit = None):
+            """
+            Return at most C{limit} log entries newer than C{timestamp},
+            oldest first. Passing the timestamp of the last entry seen
+            pages through the log; this relies on entries having unique
+            timestamps, which L{logsegment.LogSegment} guarantees.
+            """
+            return list(itertools.islice(self._iterate(timestamp), limit))
+
+        def follow(self, timestamp = None, timeout = None,
+                pollInterval = 0.5):
+            """
+            Generate the log entries newer than C{timestamp}, then keep
+            generating entries as they get added. Stops once no entry was
+            added for C{timeout} seconds (never, if C{timeout} is None).
+            New entries are detected by polling the segment's sequence
+            number, which only costs a stat call.
+            """
+            segment = self.segment
+            count = segment.sequence()
+            for log in self._iterate(timestamp, segment.records(stop=count)):
+                yield log
+            lastSeen = time.time()
+            while True:
+                if self.writer is not None:
+                    self.writer.flush()
+                newCount = segment.sequence()
+                if newCount > count:
+                    records = sorted(segment.records(count, newCount))
+                    count += len(records)
+                    for timestamp, content in segment.read(records):
+                        yield Log(timestamp = "%.4f" % timestamp,
+                            content = content)
+                    lastSeen = time.time()
+                    continue
+                if timeout is not None and time.time() - lastSeen >= timeout:
+                    return
+                time.sleep(pollInterval)
+
+        def _iterate(self, timestamp = None, records = None):
+            if self.writer is not None:
+                self.writer.flush()
+            segment = self.segment
+            if records is None:
+                records = segment.records()
+            records.sort()
+            if timestamp is not None:
+                # Compare timestamps as they are presented in Log objects;
+                # segments written by older versions store them unrounded
+                timestamp = float(timestamp)
+                start = bisect.bisect_right(
+                    [ self._round(x[0]) for x in records ], timestamp)
+                records = records[start:]
+            # Logs used to be stored one per file, named after their
+            # timestamp; merge them with the ones in the segment.
+            legacy = self._enumerateFiles(timestamp)
+            current = ((ts, 1, i, content) for i, (ts, content)
+                in enumerate(segment.read(records)))
+            for ts, _, _, content in heapq.merge(legacy, current):
+                yield Log(timestamp = "%.4f" % ts, content = content)
+
+        def _enumerateFiles(self, timestamp = None):
+            keys = []
+            for key in self.storage.enumerate((self.keyId, self._subdir)):
+                name = os.path.basename(key)
+                if name.startswith('.'):
+                    continue
+                ts = float(name)
+                if timestamp is None or ts > timestamp:
+                    keys.append((ts, key))
+            keys.sort()
+            for i, (ts, key) in enumerate(keys):
                 fname = self.storage.getFileFromKey(key)
-                yield Log(timestamp = os.path.basename(fname),
-                    content = file(fname).read())
+                yield ts, 0, i, file(fname).read()
+
+        @classmethod
+        def _round(cls, timestamp):
+            return float("%.4f" % timestamp)
 
     @property
     def logs(self):
-        return self._LogList(self.keyId, self.storage)
+        return self._LogList(self.keyId, self.storage, self._logWriter)
+
+    def bufferLogs(self):
+        """
+        Buffer the log entries added through this object, writing them in
+        batches. Buffered entries are written when the buffer fills up, at
+        most a second after being added, on every state change, and when
+        flushLogs or closeLogs is called.
+        """
+        if self._logWriter is None:
+            self._logWriter = logsegment.LogWriter(self.logs.segment)
+        return self._logWriter
+
+    def flushLogs(self):
+        if self._logWriter is not None:
+            self._logWriter.flush()
+
+    def closeLogs(self):
+        "Write the buffered log entries, and stop buffering"
+        if self._logWriter is not None:
+            self._logWriter.close()
+            self._logWriter = None
 
 class StateMixIn(object):
+    """
+    Processes waiting for a state change (see L{waitForState}) each create
+    a FIFO in the object's C{.waiters} directory; every state change writes
+    a byte to all of them.
+    @cvar stateRecheckInterval: maximum number of seconds between two
+    checks of the state while waiting, in case a notification is missed
+    (for instance if the state is changed by an older version of this code)
+    """
+    _waitersSubdir = '.waiters'
+    stateRecheckInterval = 5.0
+
     def _setState(self, state):
         assert self.keyId is not None
-        self._setUpdated()
-        return self.storage.set((self.keyId, 'state'), state)
+        # Whoever sees the new state must also see the logs leading to it
+        flushLogs = getattr(self, 'flushLogs', None)
+        if flushLogs is not None:
+            flushLogs()
+        _, fields = self._updatedFields()
+        fields.insert(0, ((self.keyId, 'state'), state))
+        ret = self._storeFields(fields)
+        self._notifyStateWaiters()
+        return ret
 
     def _getState(self):
         assert self.keyId is not None
@@ -83,17 +211,131 @@ class StateMixIn(object):
 
     def _deleteState(self):
         assert self.keyId is not None
-        self._setUpdated()
-        return self.storage.delete((self.keyId, 'state'))
+        _, fields = self._updatedFields()
+        fields.insert(0, ((self.keyId, 'state'), None))
+        ret = self._storeFields(fields)
+        self._notifyStateWaiters()
+        return ret
 
     state = property(_getState, _setState, _deleteState)
 
+    def waitForState(self, states, timeout = None):
+        """
+        Wait until the object reaches one of C{states}.
+        @return: the state reached, or None if C{timeout} seconds passed
+        first
+        """
+        assert self.keyId is not None
+        if isinstance(states, basestring):
+            states = [ states ]
+        states = set(states)
+        if timeout is not None:
+            deadline = time.time() + timeout
+        fifoPath, readFd, writeFd = self._addStateWaiter()
+        try:
+            while True:
+                state = self.state
+                if state in states:
+                    return state
+                wait = self.stateRecheckInterval
+                if timeout is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return None
+                    wait = min(wait, remaining)
+                try:
+                    ready = select.select([ readFd ], [], [], wait)[0]
+                except select.error, e:
+                    if e.args[0] != errno.EINTR:
+                        raise
+                    continue
+                if ready:
+                    # Drain the notifications; the state is read again
+                    try:
+                        os.read(readFd, 4096)
+                    except OSError, e:
+                        if e.errno != errno.EAGAIN:
+                            raise
+        finally:
+            os.close(readFd)
+            os.close(writeFd)
+            self._removeStateWaiter(fifoPath)
+
+    def _getWaitersDir(self):
+        return self.storage.getFileFromKey((self.keyId, self._waitersSubdir))
+
+    def _addStateWaiter(self):
+        waitersDir = self._getWaitersDir()
+        while True:
+            fifoPath = os.path.join(waitersDir, str(uuid.uuid4()))
+            try:
+                os.mkfifo(fifoPath, 0600)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                try:
+                    os.makedirs(waitersDir)
+                except OSError, e:
+                    if e.errno != errno.EEXIST:
+                        raise
+                continue
+            try:
+                readFd = os.open(fifoPath, os.O_RDONLY | os.O_NONBLOCK)
+            except OSError, e:
+                # A notifier took the FIFO for a stale one
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+            # Keeping the FIFO open for writing as well means select() never
+            # reports an end of file once notifiers close their end
+            writeFd = os.open(fifoPath, os.O_WRONLY | os.O_NONBLOCK)
+            return fifoPath, readFd, writeFd
+
+    @classmethod
+    def _removeStateWaiter(cls, fifoPath):
+        try:
+            os.unlink(fifoPath)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def _notifyStateWaiters(self):
+        waitersDir = self._getWaitersDir()
+        try:
+            names = os.listdir(waitersDir)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        for name in names:
+            fifoPath = os.path.join(waitersDir, name)
+            try:
+                fd = os.open(fifoPath, os.O_WRONLY | os.O_NONBLOCK)
+            except OSError, e:
+                if e.errno == errno.ENXIO:
+                    # Nobody is reading, the waiter is gone
+                    self._removeStateWaiter(fifoPath)
+                    continue
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+            try:
+                os.write(fd, '.')
+            except OSError, e:
+                # A full FIFO already has notifications pending
+                if e.errno != errno.EAGAIN:
+                    raise
+            os.close(fd)
+
 class BaseStoredObject(object):
     prefix = None
     ttl = 3600 * 10 # Expiration, in seconds
     keyPrefix = None
+    storageClass = storage.DiskStorage
+    indexClass = None
 
     def __init__(self, storagePath, keyId = None):
+        self.storagePath = storagePath
         self.storage = self.getStorage(storagePath)
         if keyId is None:
             self.keyId = None
@@ -102,9 +344,29 @@ class BaseStoredObject(object):
 
     @classmethod
     def getStorage(cls, storagePath):
-        return storage.DiskStorage(storage.StorageConfig(
+        return cls.storageClass(storage.StorageConfig(
             os.path.join(storagePath, cls.prefix)))
 
+    @classmethod
+    def getIndex(cls, strg):
+        """
+        Return the index for objects of this class stored in C{strg}, or
+        None if the class is not indexed.
+        """
+        if cls.indexClass is None or cls.keyPrefix is None:
+            return None
+        return cls.indexClass(strg, cls.keyPrefix)
+
+    def _storeFields(self, fields):
+        """
+        Store (key, value) fields for this object, keeping the index, if
+        any, up to date.
+        """
+        self.storage.setFields(fields)
+        index = self.getIndex(self.storage)
+        if index is not None:
+            index.update(self.keyId, fields)
+
     def new(self):
         self.keyId = self.storage.newKey(keyPrefix=self.keyPrefix)
         self._setCreated()
@@ -112,8 +374,9 @@ class BaseStoredObject(object):
 
     def _setCreated(self, tstamp = None):
         assert self.keyId is not None
-        tstamp = self._setUpdated(tstamp)
-        self.storage.set((self.keyId, 'created'), tstamp)
+        tstamp, fields = self._updatedFields(tstamp)
+        fields.append(((self.keyId, 'created'), tstamp))
+        self._storeFields(fields)
         return tstamp
 
     def _getCreated(self):
@@ -122,37 +385,90 @@ class BaseStoredObject(object):
     created = property(_getCreated, _setCreated)
 
     def _setContent(self, content):
+        """
+        Set the content. Besides strings, it accepts objects with a
+        C{writeTo(stream)} method, whose output is written straight to the
+        content file without being held in memory.
+        """
         assert self.keyId is not None
         self._setUpdated()
         if content is None:
             self.storage.delete((self.keyId, 'content'))
             return None
+        if hasattr(content, 'writeTo'):
+            return self._streamField('content', content.writeTo)
         return self.storage.set((self.keyId, 'content'), content)
 
+    def _streamField(self, field, write):
+        """
+        Store the output of C{write(stream)} as field C{field}
+        """
+        fpath = self.storage.getFileFromKey((self.keyId, field))
+        dirName = os.path.dirname(fpath)
+        if not os.path.isdir(dirName):
+            os.makedirs(dirName)
+        fd, tmpPath = tempfile.mkstemp(dir=dirName, prefix='.%s.' % field)
+        try:
+            f = os.fdopen(fd, 'w')
+            try:
+                write(f)
+            finally:
+                f.close()
+            os.rename(tmpPath, fpath)
+        except:
+            os.unlink(tmpPath)
+            raise
+        return fpath
+
     def _getContent(self):
         assert self.keyId is not None
         return self.storage.get((self.keyId, 'content'))
 
     content = property(_getContent, _setContent)
 
+    def _getContentPath(self):
+        """
+        The path of the content file, or None if there is no content. It
+        lets callers stream a large content instead of reading it.
+        """
+        assert self.keyId is not None
+        fpath = self.storage.getFileFromKey((self.keyId, 'content'))
+        if not os.path.exists(fpath):
+            return None
+        return fpath
+
+    contentPath = property(_getContentPath)
+
     def _getUpdated(self):
         return self._getTimestamp('updated')
 
     def _setUpdated(self, tstamp = None):
         assert self.keyId is not None
+        tstamp, fields = self._updatedFields(tstamp)
+        self._storeFields(fields)
+        return tstamp
+
+    def _updatedFields(self, tstamp = None):
+        """
+        Return the formatted timestamp and the list of (key, value) fields
+        to be stored when the object is updated at time C{tstamp}.
+        Setting them with a single C{setFields} call lets storage backends
+        write them at once.
+        """
         if tstamp is None:
             tstamp = time.time()
-        expiration = tstamp + self.ttl
+        expiration = "%.2f" % (tstamp + self.ttl)
         tstamp = "%.2f" % tstamp
-        self.storage.set((self.keyId, 'updated'), tstamp)
-        self._setExpiration(expiration)
-        return tstamp
+        return tstamp, [
+            ((self.keyId, 'updated'), tstamp),
+            ((self.keyId, 'expiration'), expiration),
+        ]
 
     updated = property(_getUpdated, _setUpdated)
 
     def _setExpiration(self, tstamp):
         tstamp = "%.2f" % tstamp
-        self.storage.set((self.keyId, 'expiration'), tstamp)
+        self._storeFields([ ((self.keyId, 'expiration'), tstamp) ])
         return tstamp
 
     def _getExpiration(self):
@@ -170,7 +486,8 @@ class BaseStoredObject(object):
         return None
 
 class StoredObject(BaseStoredObject, LogEntryMixIn, StateMixIn):
-    pass
+    storageClass = storage.RecordStorage
+    indexClass = stored_index.StoredObjectIndex
 
 class ConcreteUpdateJob(StoredObject):
     prefix = "jobs"
@@ -220,9 +537,173 @@ class ConcreteUpdateJob(StoredObject):
 
     downloadSize = property(_getDownloadSize, _setDownloadSize)
 
+    def _setQueueWait(self, seconds):
+        assert self.keyId is not None
+        return self.storage.set((self.keyId, "queueWait"), "%.2f" % seconds)
+
+    def _getQueueWait(self):
+        assert self.keyId is not None
+        seconds = self.storage.get((self.keyId, "queueWait"))
+        if seconds is None:
+            return None
+        return float(seconds.strip())
+
+    # Seconds spent waiting in the scheduler's queue
+    queueWait = property(_getQueueWait, _setQueueWait)
+
+    def _setJsonContent(self, content):
+        """
+        Set the JSON version of the content. Besides strings, it accepts
+        objects with a C{writeJsonTo(stream)} method, like the preview
+        formatters.
+        """
+        assert self.keyId is not None
+        if content is None:
+            self.storage.delete((self.keyId, 'jsonContent'))
+            return None
+        if hasattr(content, 'writeJsonTo'):
+            return self._streamField('jsonContent', content.writeJsonTo)
+        return self.storage.set((self.keyId, 'jsonContent'), content)
+
+    def _getJsonContent(self):
+        assert self.keyId is not None
+        return self.storage.get((self.keyId, 'jsonContent'))
+
+    jsonContent = property(_getJsonContent, _setJsonContent)
+
+    def _setSummary(self, summary):
+        assert self.keyId is not None
+        if summary is None:
+            self.storage.delete((self.keyId, 'summary'))
+            return None
+        return self.storage.set((self.keyId, 'summary'),
+            json.dumps(summary, sort_keys=True))
+
+    def _getSummary(self):
+        assert self.keyId is not None
+        summary = self.storage.get((self.keyId, 'summary'))
+        if summary is None:
+            return None
+        return json.loads(summary)
+
+    # Aggregates of the update job (see SyncModel._getPreviewSummary)
+    summary = property(_getSummary, _setSummary)
+
+    def _setTimings(self, stages):
+        assert self.keyId is not None
+        return self.storage.set((self.keyId, 'timings'), json.dumps(stages))
+
+    def _getTimings(self):
+        assert self.keyId is not None
+        stages = self.storage.get((self.keyId, 'timings'))
+        if stages is None:
+            return None
+        return json.loads(stages)
+
+    # Stages of the last operation on the job, with their duration and
+    # counts (see timings.Timings.asList)
+    timings = property(_getTimings, _setTimings)
+
+    def _setProfile(self, report):
+        assert self.keyId is not None
+        if report is None:
+            self.storage.delete((self.keyId, 'profile'))
+            return None
+        return self.storage.set((self.keyId, 'profile'), report)
+
+    def _getProfile(self):
+        assert self.keyId is not None
+        return self.storage.get((self.keyId, 'profile'))
+
+    # cProfile report of the job, if profiled (see profiling.Profiler)
+    profile = property(_getProfile, _setProfile)
+
+    def _setMemoryProfile(self, report):
+        assert self.keyId is not None
+        if report is None:
+            self.storage.delete((self.keyId, 'memoryProfile'))
+            return None
+        return self.storage.set((self.keyId, 'memoryProfile'), report)
+
+    def _getMemoryProfile(self):
+        assert self.keyId is not None
+        return self.storage.get((self.keyId, 'memoryProfile'))
+
+    # Memory allocation report of the job, if profiled
+    memoryProfile = property(_getMemoryProfile, _setMemoryProfile)
+
 class ConcreteSurveyJob(ConcreteUpdateJob):
     keyPrefix = "surveys"
 
+class QueuedTask(StoredObject):
+    """
+    Entry in the job scheduler's queue, for a task waiting for (state
+    "Queued") or holding (state "Running") a slot.
+    """
+    prefix = "scheduler"
+    keyPrefix = "queue"
+    indexClass = stored_index.QueueIndex
+
+    def _getField(self, name):
+        assert self.keyId is not None
+        value = self.storage.get((self.keyId, name))
+        if value is None:
+            return None
+        return value.strip()
+
+    def _setField(self, name, value):
+        assert self.keyId is not None
+        return self._storeFields([ ((self.keyId, name), value) ])
+
+    def _getKind(self):
+        return self._getField('kind')
+
+    def _setKind(self, kind):
+        return self._setField('kind', kind)
+
+    kind = property(_getKind, _setKind)
+
+    def _getJobId(self):
+        return self._getField('jobId')
+
+    def _setJobId(self, jobId):
+        return self._setField('jobId', jobId)
+
+    jobId = property(_getJobId, _setJobId)
+
+    def _getPriority(self):
+        priority = self._getField('priority')
+        if priority is None:
+            return 0
+        return int(priority)
+
+    def _setPriority(self, priority):
+        return self._setField('priority', priority)
+
+    priority = property(_getPriority, _setPriority)
+
+    def _getPid(self):
+        pid = self._getField('pid')
+        if pid is None:
+            return None
+        return int(pid)
+
+    def _setPid(self, pid):
+        return self._setField('pid', pid)
+
+    pid = property(_getPid, _setPid)
+
+    def _getInterruptible(self):
+        interruptible = self._getField('interruptible')
+        if interruptible is None:
+            return None
+        return interruptible == 'True'
+
+    def _setInterruptible(self, interruptible):
+        return self._setField('interruptible', bool(interruptible))
+
+    interruptible = property(_getInterruptible, _setInterruptible)
+
 class StoredObjectsFactory(object):
     factory = None
     def __init__(self, storagePath):
@@ -237,11 +718,43 @@ class StoredObjectsFactory(object):
         obj.new()
         return obj
 
+    def getIndex(self):
+        return self.factory.getIndex(
+            self.factory.getStorage(self.storagePath))
+
     def latest(self, filter = None):
         """
         Return the object that was modified the latest, or None if no object
         is found
         """
+        index = self.getIndex()
+        if index is None:
+            return self._scanLatest(filter)
+        for key in index.newest():
+            obj = self.load(key)
+            if filter is None or filter(obj):
+                return obj
+        return None
+
+    def expired(self, before = None):
+        """
+        Return the keys of the objects that expired before C{before}
+        (defaults to now)
+        """
+        if before is None:
+            before = time.time()
+        index = self.getIndex()
+        if index is not None:
+            return index.expired(before)
+        strg = self.factory.getStorage(self.storagePath)
+        ret = []
+        for key in strg.enumerate(keyPrefix=self.factory.keyPrefix):
+            expiration = self.load(key).expiration
+            if expiration and expiration < before:
+                ret.append(key)
+        return ret
+
+    def _scanLatest(self, filter):
         retobj = None
         maxModified = None
         for obj in self:
@@ -254,15 +767,15 @@ class StoredObjectsFactory(object):
         return retobj
 
     def __iter__(self):
+        # Expired objects are only moved to the trash, the actual (and
+        # potentially slow) removal is left to the reaper
         strg = self.factory.getStorage(self.storagePath)
-        now = time.time()
+        expired = set(self.expired())
         for key in strg.enumerate(keyPrefix=self.factory.keyPrefix):
-            obj = self.factory(self.storagePath, keyId = key)
-            expiration = obj.expiration
-            if expiration and expiration < now:
-                strg.delete(key)
+            if key in expired:
+                strg.trash(key)
                 continue
-            yield obj
+            yield self.factory(self.storagePath, keyId = key)
 
 class ConcreteUpdateJobFactory(StoredObjectsFactory):
     factory = ConcreteUpdateJob
@@ -270,6 +783,9 @@ class ConcreteUpdateJobFactory(StoredObjectsFactory):
 class ConcreteSurveyJobFactory(StoredObjectsFactory):
     factory = ConcreteSurveyJob
 
+class QueuedTaskFactory(StoredObjectsFactory):
+    factory = QueuedTask
+
 class FlatStoredObject(BaseStoredObject):
     def _setContent(self, content):
         assert self.keyId is not None
@@ -326,3 +842,21 @@ class FlatStoredObject(BaseStoredObject):
         return self._getUpdated() + self.ttl
 
     expiration = property(_getExpiration, _setExpiration)
+
+
+class PreviewMemo(FlatStoredObject):
+    """
+    Maps the key of a system model preview (see
+    L{update.SyncModel._getPreviewMemoKey}) to the id of the job holding
+    its frozen update job. Memos expire like the jobs they point to, and
+    are removed by the reaper (see L{PreviewMemoFactory}).
+    """
+    prefix = "previews"
+
+class PreviewMemoFactory(StoredObjectsFactory):
+    factory = PreviewMemo
+
+    def expired(self, before = None):
+        # Memos are stored at the top of the storage, next to its trash
+        return [ x for x in StoredObjectsFactory.expired(self, before)
+            if not x.startswith('.') ]
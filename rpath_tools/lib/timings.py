@@ -0,0 +1,89 @@
+#!/usr/bin/python
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Timing of the stages of an operation.
+"""
+
+import time
+
+
+class Span(object):
+    """
+    Context manager timing one run of a stage. Counts (bytes, troves...)
+    can be attached to the stage while it runs with L{count}.
+    """
+    __slots__ = [ 'timings', 'name', 'counts', 'start' ]
+
+    def __init__(self, timings, name, counts):
+        self.timings = timings
+        self.name = name
+        self.counts = counts
+        self.start = None
+
+    def count(self, **counts):
+        self.counts.update(counts)
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        # Failed stages are recorded too, it tells where the time went
+        self.timings.add(self.name, time.time() - self.start, **self.counts)
+        return False
+
+
+class Timings(dict):
+    """
+    Durations, in seconds, of the stages of an operation, by stage name.
+    Stages run more than once add up, and so do their counts.
+
+        with timings.span('download', bytes=size):
+            ...
+    """
+
+    def __init__(self):
+        dict.__init__(self)
+        self.stages = []
+        self.counts = {}
+
+    def span(self, name, **counts):
+        """Return a L{Span} timing stage C{name}"""
+        return Span(self, name, counts)
+
+    def add(self, name, duration, **counts):
+        if name not in self:
+            self.stages.append(name)
+            self[name] = 0.0
+        self[name] += duration
+        stageCounts = self.counts.setdefault(name, {})
+        for key, value in counts.iteritems():
+            stageCounts[key] = stageCounts.get(key, 0) + value
+
+    def asList(self):
+        """
+        Return the stages, in the order they first ran, as dictionaries
+        holding the stage's name, its duration in seconds, and its counts
+        """
+        result = []
+        for name in self.stages:
+            stage = dict(self.counts.get(name, {}))
+            stage.update(name=name, seconds=round(self[name], 4))
+            result.append(stage)
+        return result
@@ -0,0 +1,389 @@
+#!/usr/bin/python
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Indexed storage for the troves of a model trove cache.
+
+Troves are stored one after the other, each one as its frozen (absolute)
+trove changeset, compressed. They are followed by an index of fixed-size
+records (digest of the trove key, offset, length) sorted by digest, and
+by a trailer pointing at the index. The file is memory-mapped, and a trove
+is only read and thawed when it is looked up.
+
+Trove keys (see L{troveKey}) leave the version timestamps out, since
+versions compare equal regardless of their timestamps; the frozen trove
+tuple, timestamps included, is stored along with every trove.
+"""
+
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import zlib
+
+from conary import trove
+from conary import versions
+from conary.deps import deps
+from conary.lib import util
+
+
+class TroveIndexError(Exception):
+    "Raised when a trove index file is corrupted"
+
+
+def troveKey(troveTup):
+    """
+    Return the key a trove tuple is looked up by. Like trove tuple
+    comparisons, it ignores version timestamps.
+    """
+    name, version, flavor = troveTup
+    return '\0'.join((name, version.asString(), flavor.freeze()))
+
+
+def freezeTroveTuple(troveTup):
+    name, version, flavor = troveTup
+    return '\0'.join((name, version.freeze(), flavor.freeze()))
+
+
+def thawTroveTuple(frozen):
+    name, version, flavor = frozen.split('\0', 2)
+    return (name, versions.ThawVersion(version), deps.ThawFlavor(flavor))
+
+
+def freezeTrove(trv):
+    return trv.diff(None, absolute=True)[0].freeze()
+
+
+def thawTrove(frozen):
+    return trove.Trove(trove.ThawTroveChangeSet(frozen),
+        skipIntegrityChecks=True)
+
+
+def freezeEntry(troveTup, trv):
+    """
+    Return the (trove key, frozen trove tuple, compressed frozen trove)
+    entry stored in trove index files
+    """
+    return (troveKey(troveTup), freezeTroveTuple(troveTup),
+        zlib.compress(freezeTrove(trv)))
+
+
+class TroveIndex(object):
+    magic = 'RTTI'
+    version = 2
+    # magic, version, number of entries, offset of the index
+    trailerFormat = '!4sIIQ'
+    trailerSize = struct.calcsize(trailerFormat)
+    # digest of the trove key, offset, length
+    recordFormat = '!20sQI'
+    recordSize = struct.calcsize(recordFormat)
+    digestSize = 20
+    # trove key and frozen trove tuple lengths, preceding the entry's data
+    keyFormat = '!II'
+    keySize = struct.calcsize(keyFormat)
+
+    @classmethod
+    def digest(cls, key):
+        return hashlib.sha1(key).digest()
+
+
+class TroveIndexWriter(TroveIndex):
+    """
+    Write a trove index file atomically
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, entries):
+        """
+        @param entries: iterable of (trove key, frozen trove tuple,
+        compressed frozen trove) entries, as returned by L{freezeEntry} and
+        L{TroveIndexReader.iterRaw}; for duplicate trove keys the first
+        entry is kept
+        @return: the number of entries written
+        """
+        dirName = os.path.dirname(self.path)
+        util.mkdirChain(dirName)
+        fd, tmpPath = tempfile.mkstemp(dir=dirName,
+            prefix='.' + os.path.basename(self.path) + '.')
+        try:
+            f = os.fdopen(fd, 'wb')
+            try:
+                count = self._write(f, entries)
+            finally:
+                f.close()
+            os.rename(tmpPath, self.path)
+        except:
+            os.unlink(tmpPath)
+            raise
+        return count
+
+    def _write(self, f, entries):
+        records = {}
+        offset = 0
+        for key, frozenTup, data in entries:
+            digest = self.digest(key)
+            if digest in records:
+                continue
+            blob = (struct.pack(self.keyFormat, len(key), len(frozenTup)) +
+                key + frozenTup)
+            f.write(blob)
+            f.write(data)
+            records[digest] = (offset, len(blob) + len(data))
+            offset += len(blob) + len(data)
+        indexOffset = offset
+        for digest in sorted(records):
+            f.write(struct.pack(self.recordFormat, digest, *records[digest]))
+        f.write(struct.pack(self.trailerFormat, self.magic, self.version,
+            len(records), indexOffset))
+        return len(records)
+
+
+class TroveIndexReader(TroveIndex):
+    """
+    Look up troves in a memory-mapped trove index file
+    """
+    def __init__(self, path):
+        self.path = path
+        f = open(path, 'rb')
+        try:
+            size = os.fstat(f.fileno()).st_size
+            if size < self.trailerSize:
+                raise TroveIndexError("%s: file too short" % path)
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        magic, version, self._count, self._indexOffset = struct.unpack_from(
+            self.trailerFormat, self._map, size - self.trailerSize)
+        if (magic != self.magic or version != self.version or
+                self._indexOffset + self._count * self.recordSize !=
+                    size - self.trailerSize):
+            self.close()
+            raise TroveIndexError("%s: bad trailer" % path)
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, troveTup):
+        return self._find(troveKey(troveTup)) is not None
+
+    def get(self, troveTup, default=None):
+        data = self.getRaw(troveKey(troveTup))
+        if data is None:
+            return default
+        return thawTrove(zlib.decompress(data))
+
+    def getRaw(self, key):
+        """
+        Return the compressed frozen trove for a trove key, or None
+        """
+        found = self._find(key)
+        if found is None:
+            return None
+        offset, length = found
+        return self._map[offset:offset + length]
+
+    def iterRaw(self):
+        """
+        Generate (trove key, frozen trove tuple, compressed frozen trove)
+        entries for all the troves, in index order
+        """
+        for i in xrange(self._count):
+            offset, length = self._record(i)[1:]
+            keyLen, tupLen = struct.unpack_from(self.keyFormat, self._map,
+                offset)
+            start = offset + self.keySize
+            dataStart = start + keyLen + tupLen
+            yield (self._map[start:start + keyLen],
+                self._map[start + keyLen:dataStart],
+                self._map[dataStart:offset + length])
+
+    def keys(self):
+        return [ thawTroveTuple(x[1]) for x in self.iterRaw() ]
+
+    def close(self):
+        self._map.close()
+
+    def _record(self, i):
+        return struct.unpack_from(self.recordFormat, self._map,
+            self._indexOffset + i * self.recordSize)
+
+    def _find(self, key):
+        """
+        Return the (offset, length) of the entry's data, skipping the
+        trove key and the frozen trove tuple
+        """
+        digest = self.digest(key)
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            pos = self._indexOffset + mid * self.recordSize
+            midDigest = self._map[pos:pos + self.digestSize]
+            if midDigest < digest:
+                lo = mid + 1
+            elif midDigest > digest:
+                hi = mid
+            else:
+                offset, length = self._record(mid)[1:]
+                keyLen, tupLen = struct.unpack_from(self.keyFormat,
+                    self._map, offset)
+                start = offset + self.keySize
+                if self._map[start:start + keyLen] != key:
+                    return None
+                dataStart = start + keyLen + tupLen
+                return dataStart, offset + length - dataStart
+        return None
+
+
+_missing = object()
+
+
+class LazyTroveDict(dict):
+    """
+    Dictionary of troves keyed by trove tuple, backed by a
+    L{TroveIndexReader}. Troves from the index are thawed the first time
+    they are looked up; troves added to the dictionary (see L{added}) are
+    kept in memory until they are written to a new index. Index entries
+    that were deleted or replaced are masked by tombstones.
+    """
+    def __init__(self, reader, *args, **kwargs):
+        dict.__init__(self)
+        self.reader = reader
+        self._decoded = {}
+        self._tombstones = set()
+        self.update(*args, **kwargs)
+        self._modified = False
+
+    def _lookup(self, key):
+        if dict.__contains__(self, key):
+            return dict.__getitem__(self, key)
+        if key in self._tombstones:
+            return _missing
+        value = self._decoded.get(key, _missing)
+        if value is _missing:
+            value = self.reader.get(key, _missing)
+            if value is not _missing:
+                self._decoded[key] = value
+        return value
+
+    def _inReader(self, key):
+        return (key not in self._tombstones and
+            (key in self._decoded or key in self.reader))
+
+    def __getitem__(self, key):
+        value = self._lookup(key)
+        if value is _missing:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        value = self._lookup(key)
+        if value is _missing:
+            return default
+        return value
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or self._inReader(key)
+
+    has_key = __contains__
+
+    def __setitem__(self, key, value):
+        # Replaced index entries are kept in memory, so that they are
+        # written out along with the added troves
+        if not dict.__contains__(self, key) and self._inReader(key):
+            self._tombstones.add(key)
+            self._decoded.pop(key, None)
+        dict.__setitem__(self, key, value)
+        self._modified = True
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).iteritems():
+            self[key] = value
+
+    def setdefault(self, key, default=None):
+        value = self._lookup(key)
+        if value is _missing:
+            self[key] = value = default
+        return value
+
+    def __delitem__(self, key):
+        if dict.__contains__(self, key):
+            dict.__delitem__(self, key)
+        elif self._inReader(key):
+            self._tombstones.add(key)
+            self._decoded.pop(key, None)
+        else:
+            raise KeyError(key)
+        self._modified = True
+
+    def pop(self, key, *default):
+        value = self._lookup(key)
+        if value is _missing:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        del self[key]
+        return value
+
+    def __len__(self):
+        return dict.__len__(self) + len(self.reader) - len(self._tombstones)
+
+    def keys(self):
+        return dict.keys(self) + [ x for x in self.reader.keys()
+            if x not in self._tombstones ]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    iterkeys = __iter__
+
+    def iteritems(self):
+        for key in self.keys():
+            yield key, self[key]
+
+    def items(self):
+        return list(self.iteritems())
+
+    def itervalues(self):
+        for key, value in self.iteritems():
+            yield value
+
+    def values(self):
+        return list(self.itervalues())
+
+    def added(self):
+        """
+        Return the (trove tuple, trove) pairs added or replaced since the
+        index was loaded
+        """
+        return dict.items(self)
+
+    def modified(self):
+        "Return True if troves were added, replaced or deleted"
+        return self._modified
+
+    def iterRaw(self):
+        """
+        Generate the raw entries of the index, as L{TroveIndexReader.iterRaw}
+        does, except for the ones that were deleted or replaced
+        """
+        if not self._tombstones:
+            return self.reader.iterRaw()
+        tombstones = set(troveKey(x) for x in self._tombstones)
+        return (x for x in self.reader.iterRaw() if x[0] not in tombstones)
@@ -29,9 +29,18 @@ from conary.lib import util
 from rpath_tools.lib import errors
 from rpath_tools.lib import clientfactory
 from rpath_tools.lib import callbacks
+from rpath_tools.lib import changesets
+from rpath_tools.lib import concurrency
 from rpath_tools.lib import formatter
+from rpath_tools.lib import metrics
+from rpath_tools.lib import modelcache
+from rpath_tools.lib import scheduler
+from rpath_tools.lib import stored_objects
+from rpath_tools.lib import timings
 
 import copy
+import hashlib
+import shutil
 import types
 import time
 import os
@@ -44,7 +53,8 @@ logger = logging.getLogger(__name__)
 
 class SystemModelFlags(object):
     __slots__ = [ 'migrate', 'update', 'updateall', 'sync', 'test',
-                    'freeze', 'thaw', 'iid',  'preview', 'apply', ]
+                    'freeze', 'thaw', 'iid',  'preview', 'apply',
+                    'simplify', ]
 
     def __init__(self, **kwargs):
         for s in self.__slots__:
@@ -53,6 +63,7 @@ class SystemModelFlags(object):
 
 class UpdateService(object):
     conaryClientFactory = clientfactory.ConaryClientFactory
+    modelCachePool = modelcache.ModelCachePool
 
     def __init__(self):
         self._cclient = None
@@ -77,6 +88,20 @@ class UpdateService(object):
 
     conaryCfg = property(_getCfg)
 
+    @property
+    def modelCachePath(self):
+        cfg = self.conaryCfg
+        return ''.join([cfg.root, cfg.dbPath, '/modelcache'])
+
+    def warmCaches(self):
+        '''
+        Create the conary client and load the model cache ahead of their
+        first use
+        '''
+        cclient = self.conaryClient
+        if self.isSystemModel:
+            self.modelCachePool().warm(cclient, self.modelCachePath)
+
     @property
     def isSystemModel(self):
         return os.path.isfile(self.systemModelPath)
@@ -98,6 +123,22 @@ class UpdateService(object):
 
 
 class SystemModel(UpdateService):
+    # Maximum number of concurrent changeset downloads per repository
+    downloadWorkersPerHost = 1
+
+    # Model simplification policies:
+    # simplify the model and verify the simplification before returning
+    # the update job (the default)
+    SIMPLIFY_INLINE = 'inline'
+    # verify the simplified model in a child process, while the update job
+    # built from the original model is being frozen
+    SIMPLIFY_CONCURRENT = 'concurrent'
+    # only simplify (inline) when explicitly requested
+    SIMPLIFY_EXPLICIT = 'explicit'
+    # never simplify the model
+    SIMPLIFY_OFF = 'off'
+    simplifyPolicy = SIMPLIFY_INLINE
+
     def __init__(self, sysmod=None, callback=None):
         '''
         sysmod is a system-model string that will over write the current
@@ -115,8 +156,10 @@ class SystemModel(UpdateService):
             self._newSystemModel = self._setSystemModelContents(self._contents)
         self._manifest = None
         self._model_cache = None
-        self._cfg = self.conaryClientFactory().getCfg()
         self._call = callback
+        self._simplification = None
+        # Durations (in seconds) of the stages of the current operation
+        self.timings = timings.Timings()
 
     def _getSystemModelContents(self):
         return self._newSystemModel
@@ -134,9 +177,15 @@ class SystemModel(UpdateService):
         Create a model cache to use for updates
         '''
         cclient = self.conaryClient
-        cclient.cfg.initializeFlavors()
+        # The client factory has initialized the configuration's flavors
         cfg = cclient.cfg
         try:
+            if loadTroveCache and not changeSetList:
+                # The loaded cache is kept around for later update jobs
+                self._model_cache_path = self.modelCachePath
+                self._model_cache = self.modelCachePool().get(cclient,
+                    self._model_cache_path, callback=callback)
+                return self._model_cache
             self._model_cache = modelupdate.CMLTroveCache(
                 cclient.getDatabase(),
                 cclient.getRepos(),
@@ -201,13 +250,14 @@ class SystemModel(UpdateService):
         Start a new model with a mostly blank cfg
         '''
         # TODO
+        cfg = self.conaryCfg
         self._new_cfg = conarycfg.ConaryConfiguration(False)
         self._new_cfg.initializeFlavors()
-        self._new_cfg.dbPath = self._cfg.dbPath
-        self._new_cfg.flavor = self._cfg.flavor
+        self._new_cfg.dbPath = cfg.dbPath
+        self._new_cfg.flavor = cfg.flavor
         self._new_cfg.configLine('updateThreshold 1')
-        self._new_cfg.buildLabel = self._cfg.buildLabel
-        self._new_cfg.installLabelPath = self._cfg.installLabelPath
+        self._new_cfg.buildLabel = cfg.buildLabel
+        self._new_cfg.installLabelPath = cfg.installLabelPath
         self._new_cfg.modelPath = '/etc/conary/system-model'
         model = cml.CML(self._new_cfg)
         model.setVersion(str(time.time()))
@@ -273,64 +323,140 @@ class SystemModel(UpdateService):
         raise errors.NotImplementedError
 
     def _buildUpdateJob(self, model, modelFile, callback=None,
-                                                changeSetList=[]):
+                                    changeSetList=[], simplify=False):
         '''
         Build an update job from a system model
         @sysmod = SystemModelFile object
         @callback = UpdateCallback object
+        @simplify = simplify the model even if the simplification policy
+        is SIMPLIFY_EXPLICIT
         return updJob, suggMapp
+        With the SIMPLIFY_CONCURRENT policy, the returned model is not
+        simplified yet; call _finishSimplification once the update job has
+        been frozen to get the final model.
         '''
-        cache = self._cache(callback)
+        with self.timings.span('loadCache'):
+            cache = self._cache(callback)
         cclient = self._getClient(modelfile=modelFile)
         # Need to sync the capsule database before updating
         if cclient.cfg.syncCapsuleDatabase:
             cclient.syncCapsuleDatabase(callback)
         updJob = cclient.newUpdateJob()
-        troveSetGraph = cclient.cmlGraph(model, changeSetList = changeSetList)
+        with self.timings.span('cmlGraph'):
+            troveSetGraph = cclient.cmlGraph(model,
+                changeSetList = changeSetList)
         try:
-            suggMap = cclient._updateFromTroveSetGraph(updJob,
-                            troveSetGraph, cache)
+            with self.timings.span('resolve') as span:
+                suggMap = cclient._updateFromTroveSetGraph(updJob,
+                                troveSetGraph, cache)
+                span.count(troves=sum(len(x) for x in updJob.getJobs()))
         except Exception, e:
             logger.error("FAILED %s" % str(e))
             if callback:
                 callback.done()
             raise
 
-        # LIFTED FROM updatecmd.py
-        # TODO Remove the logger statements???
-        finalModel = copy.deepcopy(model)
-        if model.suggestSimplifications(cache, troveSetGraph.g):
-            logger.info("possible system model simplifications found")
-            troveSetGraph2 = cclient.cmlGraph(model)
-            updJob2 = cclient.newUpdateJob()
-            try:
-                suggMap2 = cclient._updateFromTroveSetGraph(updJob2,
-                                    troveSetGraph2, cache)
-            except cerrors.TroveNotFound:
-                logger.info("bad model generated; bailing")
+        policy = self.simplifyPolicy
+        if policy == self.SIMPLIFY_EXPLICIT:
+            policy = simplify and self.SIMPLIFY_INLINE or self.SIMPLIFY_OFF
+        verify = None
+        if policy == self.SIMPLIFY_OFF:
+            logger.info("skipping system model simplification")
+        else:
+            # LIFTED FROM updatecmd.py
+            finalModel = copy.deepcopy(model)
+            with self.timings.span('simplify'):
+                simplified = model.suggestSimplifications(cache,
+                    troveSetGraph.g)
+            if not simplified:
+                model = finalModel
+            elif policy == self.SIMPLIFY_CONCURRENT:
+                logger.info("possible system model simplifications found; "
+                    "verifying them in the background")
+                # Started once the cache is saved, for the child to load it
+                verify = (model, updJob.getJobs(), suggMap)
+                model = finalModel
             else:
-                if (suggMap == suggMap2 and
-                    updJob.getJobs() == updJob2.getJobs()):
-                    logger.info("simplified model verfied; using it instead")
-                    troveSetGraph = troveSetGraph2
-                    finalModel = model
-                    updJob = updJob2
-                    suggMap = suggMap2
-                else:
-                    logger.info("simplified model changed result; ignoring")
-        model = finalModel
-        modelFile.model = finalModel
+                logger.info("possible system model simplifications found")
+                with self.timings.span('verifySimplification'):
+                    verified = self._verifySimplification(cclient, cache,
+                        model, updJob.getJobs(), suggMap)
+                if not verified:
+                    model = finalModel
+        modelFile.model = model
 
         if cache.cacheModified():
             logger.info("saving model cache to %s", self._model_cache_path)
             if callback:
                 callback.savingModelCache()
-            cache.save(self._model_cache_path)
+            with self.timings.span('saveCache'):
+                self.modelCachePool().save(cache, self._model_cache_path)
             if callback:
                 callback.done()
 
+        if verify is not None:
+            self._simplification = (concurrency.ForkedCall(
+                self._verifySimplificationInChild, *verify).start(),
+                verify[0])
+
         return updJob, suggMap, model, modelFile
 
+    def _verifySimplificationInChild(self, model, jobs, suggMap):
+        '''
+        Verify a simplified model in a child process forked by
+        _buildUpdateJob. The parent's conary client and model cache keep
+        using the parent's database handle, so the child opens its own
+        client and loads the model cache again.
+        '''
+        self._cclient = None
+        cache = self._cache()
+        return self._verifySimplification(self.conaryClient, cache, model,
+            jobs, suggMap)
+
+    @classmethod
+    def _verifySimplification(cls, cclient, cache, model, jobs, suggMap):
+        '''
+        Check that the simplified model produces the same update jobs as the
+        original one
+        '''
+        troveSetGraph = cclient.cmlGraph(model)
+        updJob = cclient.newUpdateJob()
+        try:
+            suggMap2 = cclient._updateFromTroveSetGraph(updJob,
+                                troveSetGraph, cache)
+        except cerrors.TroveNotFound:
+            logger.info("bad model generated; bailing")
+            return False
+        if suggMap == suggMap2 and jobs == updJob.getJobs():
+            logger.info("simplified model verfied; using it instead")
+            return True
+        logger.info("simplified model changed result; ignoring")
+        return False
+
+    def _finishSimplification(self, model, modelFile):
+        '''
+        Wait for the background verification of the simplified model, if
+        any, and return the model to use
+        '''
+        if self._simplification is None:
+            return model
+        call, simplifiedModel = self._simplification
+        self._simplification = None
+        with self.timings.span('verifySimplification'):
+            try:
+                verified = call.wait()
+            except concurrency.ForkedCallError, e:
+                logger.error("Unable to verify the simplified model: %s", e)
+                verified = False
+        if verified:
+            model = modelFile.model = simplifiedModel
+        return model
+
+    def _cancelSimplification(self):
+        if self._simplification is not None:
+            self._simplification[0].cancel()
+            self._simplification = None
+
     def _applyUpdateJob(self, updJob, callback=None, *args, **kwargs):
         '''
         Apply a thawed|current update job to the system
@@ -355,7 +481,8 @@ class SystemModel(UpdateService):
             callback.done()
         return updated
 
-    def _downloadUpdateJob(self, updJob, destDir, callback=None):
+    def _downloadUpdateJob(self, updJob, destDir, callback=None,
+            downloadSize=0, store=None):
         downloaded = False
         jobs = updJob.getJobs()
         if not jobs:
@@ -366,7 +493,18 @@ class SystemModel(UpdateService):
         try:
             cclient = self.conaryClient
             cclient.setUpdateCallback(callback)
-            cclient.downloadUpdate(updJob, destDir)
+            if changesets.ChangeSetDownloader.canDownload(updJob):
+                downloader = changesets.ChangeSetDownloader(cclient.repos,
+                    destDir, callback=callback,
+                    perHostConcurrency=self.downloadWorkersPerHost,
+                    store=store, createRepos=self._createRepos)
+                downloader.download(updJob, downloadSize)
+                if store is not None:
+                    store.evict()
+            else:
+                logger.info("Update job erases troves or uses local "
+                    "changesets, downloading it with conary")
+                cclient.downloadUpdate(updJob, destDir)
             downloaded = True
         except Exception, e:
             raise errors.SystemModelServiceError, e
@@ -457,6 +595,20 @@ class SyncModel(SystemModel):
     '''
     Sync to system-model destructive
     '''
+    # Maximum number of concurrent changeset size queries
+    sizeQueryWorkers = 4
+    # Reuse the frozen job of an identical earlier preview
+    previewMemo = True
+    Scheduler = scheduler.Scheduler
+    # Scheduler kinds of the actions that modify the conary database
+    actionKinds = {
+        '_downloadSyncUpdateJob' : 'download',
+        '_applySyncUpdateJob' : 'apply',
+    }
+    # Include the timings of the stages run so far in previews
+    previewTimings = False
+    Metrics = metrics.Metrics
+
     def __init__(self, modelfile=None, instanceid=None, callbackClass=None):
         super(SyncModel, self).__init__()
         self._newSystemModel = None
@@ -464,7 +616,7 @@ class SyncModel(SystemModel):
         self.iid = instanceid
         # Setup flags
         self.flags = SystemModelFlags(apply=False, preview=False,
-                freeze=False, thaw=False, iid=self.iid)
+                freeze=False, thaw=False, iid=self.iid, simplify=False)
 
         # setup callback class
         if callbackClass is not None:
@@ -475,26 +627,60 @@ class SyncModel(SystemModel):
     def _callback(self, job):
         return self.callbackClass(job)
 
-    def _calculateDownloadSize(self, updateJob):
+    def _calculateDownloadSize(self, updateJob, sizeCache=None):
         serverBatch = {}
         sizes = []
         for jobs in updateJob.getJobs():
             for job in jobs:
-                _, (oldVersion, _), (newVersion, _), _ = job
+                name, (oldVersion, _), (newVersion, _), isAbsolute = job
                 oldHost = oldVersion.getHost() if oldVersion else None
                 newHost = newVersion.getHost() if newVersion else None
                 if oldHost != newHost and newHost is not None:
                     oldHost = None
+                if oldHost is None:
+                    job = (name, (None, None), job[2], isAbsolute)
                 serverBatch.setdefault((oldHost, newHost), []).append(job)
 
-        for (oldHost, newHost), jobs in serverBatch.iteritems():
-            if oldHost is None:
-                jobs = [(name, (None, None), newVersionFlavor, isAbsolute)
-                        for name, _, newVersionFlavor, isAbsolute in jobs]
-            sizes.append(
-                sum(self.conaryClient.repos.getChangeSetSize(jobs)))
+        queries = []
+        for jobs in serverBatch.itervalues():
+            if sizeCache is not None:
+                cached, jobs = sizeCache.split(jobs)
+                sizes.extend(cached)
+            if jobs:
+                queries.append(jobs)
+
+        # Each batch may be served by a different repository, so query
+        # them concurrently, each worker with its own repository client
+        repos = concurrency.PerThread(self._createRepos,
+            self.conaryClient.repos)
+        results = concurrency.parallelMap(
+            lambda jobs: repos.get().getChangeSetSize(jobs), queries,
+            self.sizeQueryWorkers)
+        for jobs, jobSizes in zip(queries, results):
+            jobSizes = list(jobSizes)
+            sizes.extend(jobSizes)
+            if sizeCache is not None:
+                sizeCache.update(zip(jobs, jobSizes))
+        if sizeCache is not None:
+            sizeCache.save()
         return sum(sizes)
 
+    def _createRepos(self):
+        """
+        Return a new repository client for the conary client, for threads
+        that must not share the client's own
+        """
+        cclient = self.conaryClient
+        return cclient.createRepos(cclient.getDatabase(), cclient.cfg)
+
+    def _getSizeCache(self, job):
+        return changesets.ChangeSetSizeCache(os.path.join(job.storagePath,
+            'cache', 'changeset-sizes'))
+
+    def _getChangeSetStore(self, job):
+        return changesets.ChangeSetStore(os.path.join(job.storagePath,
+            'cache', 'changesets'))
+
     def _getNewModelFromFile(self, modelfile):
         if not os.path.exists(modelfile):
             modelfile = '/etc/conary/system-model'
@@ -517,20 +703,62 @@ class SyncModel(SystemModel):
 
     def _getPreviewFromUpdateJob(self, updateJob, observedTopLevelItems,
             desiredTopLevelItems, jobid, downloadSize, downloaded=False):
-        preview_xml = '<preview/>'
-        preview = formatter.Formatter(updateJob)
-        if preview:
-            preview.format()
-            for ntli in desiredTopLevelItems:
-                preview.addDesiredVersion(ntli)
-            for tli in observedTopLevelItems:
-                preview.addObservedVersion(tli)
-            if jobid:
-                preview.addJobid(jobid)
-            preview.addDownloadSize(downloadSize)
-            preview.setDownloaded(downloaded)
-            preview_xml = preview.toxml()
-        return preview_xml
+        '''
+        Return the preview, as a formatter that generates the XML document
+        while writing it (see formatter.StreamingFormatter); assigning it
+        to a job's content writes it straight to the job's content file
+        '''
+        preview = formatter.StreamingFormatter(updateJob)
+        preview.format()
+        for ntli in desiredTopLevelItems:
+            preview.addDesiredVersion(ntli)
+        for tli in observedTopLevelItems:
+            preview.addObservedVersion(tli)
+        if jobid:
+            preview.addJobid(jobid)
+        preview.addDownloadSize(downloadSize)
+        preview.setDownloaded(downloaded)
+        if self.previewTimings:
+            preview.addTimings(self.timings.asList())
+        return preview
+
+    def _getPreviewSummary(self, updateJob, observedTopLevelItems,
+            desiredTopLevelItems, downloadSize, downloaded=False):
+        '''
+        Return the aggregates of the preview as a dictionary: the number
+        of packages added, removed and changed, the download size, and the
+        observed and desired versions of each top level item. They are
+        computed in a single pass over the jobs, without generating the
+        preview.
+        '''
+        added = removed = changed = 0
+        for jobList in updateJob.getJobs():
+            for job in jobList:
+                (name, (oldVersion, oldFlavor), (newVersion, newFlavor)) = \
+                    job[:3]
+                if oldVersion is None:
+                    added += 1
+                elif newVersion is None:
+                    removed += 1
+                else:
+                    changed += 1
+        topLevelItems = {}
+        for key, items in [ ('observed', observedTopLevelItems),
+                ('desired', desiredTopLevelItems) ]:
+            for item in items:
+                topLevelItems.setdefault(item.name, {})[key] = \
+                    item.asString(withTimestamp=True)
+        return dict(
+            added=added,
+            removed=removed,
+            changed=changed,
+            downloadSize=downloadSize,
+            downloaded=bool(downloaded),
+            topLevelItems=[ dict(name=name,
+                    observed=topLevelItems[name].get('observed'),
+                    desired=topLevelItems[name].get('desired'))
+                for name in sorted(topLevelItems) ],
+            )
 
     def _prepareSyncUpdateJob(self, job, callback):
         '''
@@ -544,7 +772,8 @@ class SyncModel(SystemModel):
         job.state = "Previewing"
 
         # Top Level Items
-        topLevelItems = self._getTopLevelItems()
+        with self.timings.span('topLevelItems'):
+            topLevelItems = self._getTopLevelItems()
         logger.info("Top Level Items")
         for n, v, f in topLevelItems:
             logger.info("%s %s %s" % (n, v, f))
@@ -552,30 +781,158 @@ class SyncModel(SystemModel):
         modelFile = self._getNewModelFromString(job.systemModel)
         model = modelFile.model
 
+        memoKey = None
         if not job.systemModel:
             # we are doing a system update
             model.refreshVersionSnapshots()
-
-        updateJob, suggMap, model, modelFile = self._buildUpdateJob(model, modelFile, callback)
-
-        logger.info("Conary DB Transaction Counter: %s" % updateJob.getTransactionCounter())
-
-        # update the job's system model with the newly calculated one
-        job.systemModel = model.format()
-
-        # update job download size
-        job.downloadSize = self._calculateDownloadSize(updateJob)
-
-        self.freezeSyncUpdateJob(updateJob, job)
+        elif self.previewMemo:
+            with self.timings.span('previewMemoKey'):
+                memoKey = self._getPreviewMemoKey(model,
+                    self.flags.simplify)
+
+        updateJob = None
+        if memoKey is not None:
+            with self.timings.span('reusePreview'):
+                updateJob = self._reusePreview(job, memoKey)
+
+        if updateJob is None:
+            updateJob, suggMap, model, modelFile = self._buildUpdateJob(
+                model, modelFile, callback, simplify=self.flags.simplify)
+
+            logger.info("Conary DB Transaction Counter: %s" %
+                updateJob.getTransactionCounter())
+
+            # update job download size
+            with self.timings.span('downloadSize') as span:
+                downloadSize = self._calculateDownloadSize(updateJob,
+                    self._getSizeCache(job))
+                span.count(bytes=downloadSize)
+            job.downloadSize = downloadSize
+
+            with self.timings.span('freeze'):
+                self.freezeSyncUpdateJob(updateJob, job)
+
+            # update the job's system model with the newly calculated one
+            model = self._finishSimplification(model, modelFile)
+            job.systemModel = model.format()
+            if memoKey is not None:
+                stored_objects.PreviewMemo(job.storagePath,
+                    keyId=memoKey).content = job.keyId
         job.state = "Previewed"
 
         newTopLevelItems = self._getTopLevelItemsFromUpdate(topLevelItems,
                                                                 updateJob)
+        with self.timings.span('summary'):
+            job.summary = self._getPreviewSummary(updateJob, topLevelItems,
+                newTopLevelItems, job.downloadSize)
         preview = self._getPreviewFromUpdateJob(
             updateJob, topLevelItems, newTopLevelItems, jobid, job.downloadSize)
 
         return preview
 
+    def _getPreviewMemoKey(self, model, simplify):
+        """
+        Return a key identifying the outcome of previewing C{model}. It
+        combines every operation of the model, what the trove specs of each
+        operation resolve to in the repository, the conary database's
+        transaction counter, the configured flavor and the simplification
+        settings. Specs are looked up along the search path the model
+        builds: search lines apply to the lines following them, the latest
+        one first, and the install label path is only used before the
+        first search line. Return None if the repository could not be
+        queried.
+        """
+        cclient = self.conaryClient
+        cfg = self.conaryCfg
+        counter = cclient.getDatabase().getTransactionCounter()
+
+        digest = hashlib.sha1()
+        digest.update('counter %s\0' % counter)
+        digest.update('flavor %s\0' % ' '.join(str(x) for x in cfg.flavor))
+        digest.update('simplify %s %s\0' % (bool(simplify),
+            self.simplifyPolicy))
+
+        def resolve(labelPath, specs):
+            if not specs:
+                return {}
+            found = cclient.repos.findTroves(labelPath, specs, cfg.flavor,
+                allowMissing=True)
+            for spec in specs:
+                tups = sorted("%s=%s[%s]" % (n, v.freeze(), f)
+                    for n, v, f in found.get(spec, []))
+                digest.update('%s -> %s\0' % (spec, ' '.join(tups)))
+            return found
+
+        searchPath = []
+        pending = []
+        try:
+            for op in model.modelOps:
+                items = op.item
+                if not isinstance(items, list):
+                    items = [ items ]
+                digest.update('%s %s\0' % (op.__class__.__name__,
+                    ' '.join(str(x) for x in items)))
+                labelPath = searchPath or cfg.installLabelPath
+                if isinstance(op, cml.SearchLabel):
+                    resolve(labelPath, pending)
+                    pending = []
+                    searchPath = items + searchPath
+                elif isinstance(op, cml.SearchTrove):
+                    resolve(labelPath, pending)
+                    pending = []
+                    found = resolve(labelPath, items)
+                    labels = [ v.trailingLabel() for spec in items
+                        for n, v, f in found.get(spec, []) ]
+                    searchPath = labels + searchPath
+                else:
+                    pending.extend(x for x in items
+                        if isinstance(x, trovetup.TroveSpec))
+            resolve(searchPath or cfg.installLabelPath, pending)
+        except Exception, e:
+            logger.info("Not reusing previews: %s", e)
+            return None
+        return digest.hexdigest()
+
+    def _reusePreview(self, job, memoKey):
+        """
+        If an identical preview was computed earlier and its frozen update
+        job is still available, copy it into C{job} and return the thawed
+        update job; otherwise return None.
+        """
+        memo = stored_objects.PreviewMemo(job.storagePath, keyId=memoKey)
+        sourceId = memo.content
+        if not sourceId or sourceId == job.keyId:
+            return None
+        expiration = memo.expiration
+        if expiration is None or expiration < time.time():
+            return None
+        source = job.__class__(job.storagePath, keyId=sourceId)
+        # Downloaded jobs refer to their own changesets; only reuse plain
+        # previews
+        if source.state != "Previewed":
+            return None
+        sourceDir = source.updateJobDir
+        if not os.path.exists(os.path.join(sourceDir, 'jobfile')):
+            return None
+        try:
+            destDir = job.updateJobDir
+            for name in os.listdir(sourceDir):
+                src = os.path.join(sourceDir, name)
+                if os.path.isdir(src):
+                    shutil.copytree(src, os.path.join(destDir, name))
+                else:
+                    shutil.copy2(src, destDir)
+            updateJob = self._thawUpdateJob(destDir)
+        except Exception, e:
+            logger.info("Unable to reuse preview from job %s: %s",
+                sourceId, e)
+            job.storage.delete((job.keyId, 'frozen-update-job'))
+            return None
+        logger.info("Reusing preview from job %s", sourceId)
+        job.systemModel = source.systemModel
+        job.downloadSize = source.downloadSize
+        return updateJob
+
     def _applySyncUpdateJob(self, job, callback, *args, **kwargs):
         '''
         Used to apply a frozen job
@@ -585,28 +942,36 @@ class SyncModel(SystemModel):
 
         logger.info("BEGIN Applying sync update operation JOBID : %s" % jobid)
         # Top Level Items
-        topLevelItems = self._getTopLevelItems()
+        with self.timings.span('topLevelItems'):
+            topLevelItems = self._getTopLevelItems()
         logger.info("Top Level Items")
         for n,v,f in topLevelItems: logger.info("%s %s %s" % (n,v,f))
 
-        updateJob, model = self.thawSyncUpdateJob(job)
+        with self.timings.span('thaw'):
+            updateJob, model = self.thawSyncUpdateJob(job)
         job.state = "Applying"
         model.writeSnapshot()
         logger.info("Applying update job JOBID : %s from  %s"
                                 % (jobid, job.updateJobDir))
-        self._applyUpdateJob(updateJob, callback, *args, **kwargs)
+        with self.timings.span('apply', troves=sum(len(x)
+                for x in updateJob.getJobs())):
+            self._applyUpdateJob(updateJob, callback, *args, **kwargs)
 
         model.closeSnapshot()
 
         job.state = "Applied"
 
-        newTopLevelItems = self._getTopLevelItems()
+        with self.timings.span('topLevelItems'):
+            newTopLevelItems = self._getTopLevelItems()
         logger.info("New Top Level Items")
         for n,v,f in newTopLevelItems:
             logger.info("%s %s %s" % (n,v,f))
         # Since we've just applied the update, the observed and desired
         # top level items are identical, which is usually not true for
         # previews
+        with self.timings.span('summary'):
+            job.summary = self._getPreviewSummary(updateJob, newTopLevelItems,
+                newTopLevelItems, job.downloadSize, downloaded=True)
         preview = self._getPreviewFromUpdateJob(updateJob, newTopLevelItems,
             newTopLevelItems, jobid, job.downloadSize, downloaded=True)
         return preview
@@ -618,33 +983,50 @@ class SyncModel(SystemModel):
         jobid = job.keyId
 
         logger.info("BEGIN Downloading changeset(s) for JOBID: %s" % jobid)
-        topLevelItems = self._getTopLevelItems()
+        with self.timings.span('topLevelItems'):
+            topLevelItems = self._getTopLevelItems()
         logger.info("Top Level Items")
         for n, v, f in topLevelItems:
             logger.info("%s %s %s" % (n, v, f))
 
-        updateJob, model = self.thawSyncUpdateJob(job)
+        with self.timings.span('thaw'):
+            updateJob, model = self.thawSyncUpdateJob(job)
 
         if not updateJob.getChangesetsDownloaded():
-            logger.debug('Deleting frozen update job')
-            job.storage.delete((job.keyId, 'frozen-update-job'))
             job.state = "Downloading"
             logger.info("Downloading update job JOBID: %s to %s" %
-                        (jobid, job.updateJobDir))
-            downloaded = self._downloadUpdateJob(updateJob, job.downloadDir, callback)
+                        (jobid, job.downloadDir))
+            # Changesets already downloaded by an interrupted attempt are
+            # reused
+            downloadSize = job.downloadSize
+            with self.timings.span('download', bytes=downloadSize,
+                    troves=sum(len(x) for x in updateJob.getJobs())):
+                downloaded = self._downloadUpdateJob(updateJob,
+                    job.downloadDir, callback, downloadSize,
+                    self._getChangeSetStore(job))
             updateJob.setChangesetsDownloaded(downloaded)
-            self.freezeSyncUpdateJob(updateJob, job)
+            # Only replace the frozen job once the download is complete,
+            # so it is still usable if we get interrupted
+            logger.debug('Deleting frozen update job')
+            job.storage.delete((job.keyId, 'frozen-update-job'))
+            with self.timings.span('freeze'):
+                self.freezeSyncUpdateJob(updateJob, job)
             job.state = "Downloaded"
         else:
             logger.info("Update already downloaded")
 
-        newTopLevelItems = self._getTopLevelItems()
+        with self.timings.span('topLevelItems'):
+            newTopLevelItems = self._getTopLevelItems()
         logger.info("New Top Level Items")
         for n,v,f in newTopLevelItems:
             logger.info("%s %s %s" % (n,v,f))
         # Since we've just applied the update, the observed and desired
         # top level items are identical, which is usually not true for
         # previews
+        with self.timings.span('summary'):
+            job.summary = self._getPreviewSummary(updateJob, newTopLevelItems,
+                newTopLevelItems, job.downloadSize,
+                updateJob.getChangesetsDownloaded())
         preview = self._getPreviewFromUpdateJob(updateJob, newTopLevelItems,
             newTopLevelItems, jobid, job.downloadSize,
             updateJob.getChangesetsDownloaded())
@@ -655,19 +1037,75 @@ class SyncModel(SystemModel):
         Applies the action `action` to `job`
         """
         callback = self._callback(job)
+        self.timings = timings.Timings()
+        start = time.time()
+        slot = None
+        cancelled = False
         try:
-            job.content = action(job, callback, *args, **kwargs)
-        except Exception as e:
-            callback.done()
-            job.content = str(e)
-            job.state = "Exception"
-            logger.error(job.content)
-            if raiseExceptions:
+            try:
+                with self.timings.span('queue'):
+                    slot = self._acquireSlot(action, job)
+                if slot is None:
+                    logger.info("Job %s cancelled while queued", job.keyId)
+                    job.state = "Cancelled"
+                    return None
+                preview = action(job, callback, *args, **kwargs)
+                with self.timings.span('writePreview'):
+                    job.content = preview
+                # The JSON preview is generated from the update job as
+                # well, so JSON consumers do not have to parse the XML
+                if hasattr(preview, 'writeJsonTo'):
+                    with self.timings.span('writeJsonPreview'):
+                        job.jsonContent = preview
+                else:
+                    job.jsonContent = None
+            except scheduler.TaskCancelled:
+                # The task runner records the cancellation
+                self._cancelSimplification()
+                callback.done()
+                cancelled = True
                 raise
-            return None
+            except Exception, e:
+                self._cancelSimplification()
+                callback.done()
+                job.jsonContent = None
+                job.content = str(e)
+                job.state = "Exception"
+                logger.error(job.content)
+                if raiseExceptions:
+                    raise
+                return None
+        finally:
+            if slot is not None:
+                slot.release()
+            job.timings = self.timings.asList()
+            self._recordMetrics(action, job, time.time() - start,
+                cancelled and "Cancelled" or job.state)
 
         return job.content
 
+    def _acquireSlot(self, action, job):
+        """
+        Wait for the scheduler slot of C{action}, if it modifies the conary
+        database, so that callers running it in their own process do not
+        race with job processes. Job processes started by
+        L{jobs.TaskRunner} already hold the slot, and get it at once.
+        Return the slot, or None if the job was cancelled.
+        """
+        kind = self.actionKinds.get(action.__name__)
+        if kind is None:
+            return scheduler.Slot(None, None, None, 0.0)
+        return self.Scheduler(job.storagePath).acquire(job.keyId, kind,
+            reentrant=True, interruptible=False)
+
+    def _recordMetrics(self, action, job, duration, state):
+        try:
+            self.Metrics(job.storagePath).actionFinished(
+                action.__name__.lstrip('_'), state, duration,
+                self.timings.asList())
+        except Exception:
+            logger.exception("Unable to record update metrics")
+
     def preview(self, job, raiseExceptions=False):
         '''
         return preview
@@ -704,7 +1142,7 @@ class UpdateModel(SyncModel):
         self.iid = instanceid
         # Setup flags
         self.flags = SystemModelFlags(apply=False, preview=False,
-                freeze=False, thaw=False, iid=self.iid)
+                freeze=False, thaw=False, iid=self.iid, simplify=False)
 
 
     def _newModelFile(self, model):
@@ -729,7 +1167,8 @@ class UpdateModel(SyncModel):
         logger.info("BEGIN Update operation for job : %s" % jobid)
 
         # Top Level Items
-        topLevelItems = self._getTopLevelItems()
+        with self.timings.span('topLevelItems'):
+            topLevelItems = self._getTopLevelItems()
 
         logger.info("Top Level Items")
 
@@ -748,15 +1187,21 @@ class UpdateModel(SyncModel):
             op, troveSpec = update.split(None, 1)
             model.appendOpByName(op, text=troveSpec)
 
-        updateJob, suggMap, model, modelFile = self._buildUpdateJob(model, modelFile, callback)
+        updateJob, suggMap, model, modelFile = self._buildUpdateJob(model,
+            modelFile, callback, simplify=self.flags.simplify)
 
         logger.info("Conary DB Transaction Counter: %s" % updateJob.getTransactionCounter())
 
-        job.systemModel = self._newModelFile(model)
+        with self.timings.span('freeze'):
+            self.freezeSyncUpdateJob(updateJob, job)
 
-        self.freezeSyncUpdateJob(updateJob, job)
+        model = self._finishSimplification(model, modelFile)
+        job.systemModel = self._newModelFile(model)
         newTopLevelItems = self._getTopLevelItemsFromUpdate(topLevelItems,
                                                                 updateJob)
+        with self.timings.span('summary'):
+            job.summary = self._getPreviewSummary(updateJob, topLevelItems,
+                    newTopLevelItems, job.downloadSize)
         preview = self._getPreviewFromUpdateJob(updateJob, topLevelItems,
                 newTopLevelItems, jobid, job.downloadSize)
         return preview
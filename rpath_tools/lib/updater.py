@@ -20,12 +20,12 @@ from conary.lib import util
 from conary import trovetup
 
 from rpath_tools.lib import update
+from rpath_tools.lib import formatter
 from rpath_tools.lib import jobs
 from rpath_tools.lib import errors
 from rpath_tools.lib import installation_service
 
 import tempfile
-import time
 import os
 
 import logging
@@ -50,11 +50,12 @@ class Updater(update.UpdateService):
         return path
 
     def updateOperation(self, sources=None, systemModel=None,
-                            preview=True, update=False):
+                            preview=True, update=False, json=False):
         '''
         system-model sources must be a string representation of
         the system-model file
         classic method sources is a list of top level items
+        if json is set, the preview is returned in JSON instead of XML
 
         '''
         if self.isSystemModel:
@@ -77,15 +78,12 @@ class Updater(update.UpdateService):
             flags = installation_service.InstallationService.UpdateFlags(
                                 migrate=True, test=preview)
             task = jobs.startUpdateOperation(sources=sources, flags=flags)
-            finalStates = set(['Completed', 'Exception'])
-            while task.job.state not in finalStates:
-                time.sleep(1)
+            task.job.waitForState(['Completed', 'Exception', 'Cancelled'])
             if task.job.state != 'Completed':
                 raise Exception(task.job.content)
-        xml = task.job.content
-        return xml
+        return self._getJobResults(task.job, json)
 
-    def applyOperation(self, jobid):
+    def applyOperation(self, jobid, json=False):
         xml = '<preview/>'
         if self.isSystemModel:
             task = jobs.SyncApplyTask().load(jobid)
@@ -93,21 +91,21 @@ class Updater(update.UpdateService):
             # to avoid a double fork
             task.preFork()
             task.run()
-            xml = task.job.content
+            xml = self._getJobResults(task.job, json)
         else:
             logger.error('Classic systems do not'
                 ' freeze jobs so we can not apply a frozen job')
             raise errors.NotImplementedError
         return xml
 
-    def downloadOperation(self, jobid):
+    def downloadOperation(self, jobid, json=False):
         if self.isSystemModel:
             task = jobs.DownloadTask().load(jobid)
             # Currently we have to call the steps manually
             # to avoid a double fork
             task.preFork()
             task.run()
-            xml = task.job.content
+            xml = self._getJobResults(task.job, json)
         else:
             logger.error('Classic systems do not'
                 ' freeze jobs so we can not apply a frozen job')
@@ -170,32 +168,19 @@ class Updater(update.UpdateService):
         return newsysmodel
 
     def jsonify(self, xml):
-        import json
-        from lxml import etree
-
-        root = etree.fromstring(xml)
-
-        def _handler(root):
-            result = dict()
-            if hasattr(root, 'attrib'):
-                result.update(root.attrib)
-            for e in root:
-                if len(e):
-                    if hasattr(e, 'attrib'):
-                        result.update(e.attrib)
-                    obj = _handler(e)
-                else:
-                    obj = e.text
-                if result.get(e.tag):
-                    if hasattr(result[e.tag], "append"):
-                        result[e.tag].append(obj)
-                    else:
-                        result[e.tag] = [result[e.tag], obj]
-                else:
-                    result[e.tag] = obj
-            return result
-        dump = {root.tag: _handler(root)}
-        return json.dumps(dump)
+        return formatter.xmlToJson(xml)
+
+    def _getJobResults(self, job, json=False):
+        '''
+        Return the content of a job, in JSON if json is set. The JSON
+        preview stored by system model jobs is used if available
+        '''
+        if not json:
+            return job.content
+        results = getattr(job, 'jsonContent', None)
+        if results is None:
+            results = self.jsonify(job.content)
+        return results
 
     def cmdlineUpdate(self, sources, commands=None,
                             xml=False, json=False):
@@ -205,26 +190,21 @@ class Updater(update.UpdateService):
         if self.isSystemModel:
             partialSystemModel = self.convertToPartialSystemModel(sources, commands)
             results = self.updateOperation(systemModel=partialSystemModel,
-                                           preview=xml, update=True)
+                                           preview=xml, update=True, json=json)
         else:
-            results = self.updateOperation(sources, preview=xml, update=True)
-        if json:
-            results = self.jsonify(results)
+            results = self.updateOperation(sources, preview=xml, update=True,
+                                           json=json)
         return results
 
     def cmdlineDownload(self, jobid, xml=False, json=False):
-        results = self.downloadOperation(jobid)
-        if json:
-            return self.jsonify(results)
-        if xml:
+        results = self.downloadOperation(jobid, json=json)
+        if json or xml:
             return results
         return
 
     def cmdlineApply(self, jobid, xml=False, json=False):
-        results = self.applyOperation(jobid)
-        if json:
-            return self.jsonify(results)
-        if xml:
+        results = self.applyOperation(jobid, json=json)
+        if json or xml:
             return results
         return
 
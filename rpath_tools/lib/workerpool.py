@@ -0,0 +1,290 @@
+#!/usr/bin/python
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Pool of pre-forked worker processes serving job requests.
+
+Starting a job with a fresh interpreter means importing conary, lxml and
+rpath_tools, and creating a conary client, before doing any work. The
+pool's master process does the imports once, then keeps a few idle
+workers forked from it. Workers drop the caches inherited from the
+master (see L{concurrency.registerForkHandler}) and build their own
+conary client while waiting. Every worker accepts a single request on
+a Unix socket, handles it, and exits; the master forks a replacement.
+
+Requests and responses are single lines of JSON. Only processes running
+as the same user as the pool are served. Workers do not inherit the
+master's environment: every request runs with a fixed environment, plus
+the few variables listed in L{PASS_ENVIRONMENT} taken from the client.
+"""
+
+import errno
+import json
+import logging
+import os
+import signal
+import socket
+import struct
+import StringIO
+import traceback
+
+from conary.lib import util
+
+from rpath_tools.lib import concurrency
+
+logger = logging.getLogger(__name__)
+
+# Not exported by the socket module in every python version; this is the
+# Linux value
+SO_PEERCRED = getattr(socket, 'SO_PEERCRED', 17)
+
+# Environment variables of the client passed on to the worker handling
+# its request
+PASS_ENVIRONMENT = ('RPATH_TOOLS_PROFILE', 'LANG', 'LC_ALL', 'TZ')
+
+
+class PoolUnavailable(Exception):
+    "Raised when no worker pool is listening on the socket"
+
+
+class PoolError(Exception):
+    "Raised when the worker pool failed to answer a request"
+
+
+class CompletedRequest(object):
+    """
+    Result of a request handled by the pool, with the same interface as
+    the C{subprocess.Popen} object for a process that already exited.
+    """
+    pid = None
+
+    def __init__(self, returncode, output):
+        self.returncode = returncode
+        self.stdout = StringIO.StringIO(output)
+
+    def wait(self):
+        return self.returncode
+
+    poll = wait
+
+
+def submit(socketPath, args):
+    """
+    Send the request C{args} (a list of command line arguments) to the pool
+    listening on C{socketPath}.
+    @return: a L{CompletedRequest}
+    @raises PoolUnavailable: if no pool is listening; the request was not
+    sent
+    @raises PoolError: if the request was sent, but no answer came back
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(socketPath)
+        except socket.error, e:
+            if e.errno in (errno.ENOENT, errno.ECONNREFUSED, errno.ENOTDIR):
+                raise PoolUnavailable(socketPath)
+            raise
+        environ = dict((k, v) for k, v in os.environ.iteritems()
+            if k in PASS_ENVIRONMENT)
+        sock.sendall(json.dumps(dict(args=list(args), env=environ)) + '\n')
+        response = sock.makefile('r').readline()
+    finally:
+        sock.close()
+    try:
+        response = json.loads(response)
+        return CompletedRequest(response['status'],
+            response['output'].encode('utf-8'))
+    except (ValueError, KeyError, TypeError):
+        raise PoolError("Bad response from %s: %r" % (socketPath, response))
+
+
+class WorkerPool(object):
+    """
+    Master process of the worker pool.
+    @cvar workers: number of idle workers kept ready
+    @cvar backlog: number of connections queued while all the workers
+    are busy
+    @cvar environment: environment requests are handled with
+    """
+    workers = 2
+    backlog = 32
+    environment = {
+        'PATH' : '/usr/sbin:/usr/bin:/sbin:/bin',
+    }
+
+    def __init__(self, socketPath, handler, warm=None, workers=None):
+        """
+        @param handler: function called in a worker with the request's
+        arguments, returning an (exit status, output) tuple
+        @param warm: function called in every worker before it waits for
+        a request, to load what the request will need
+        """
+        self.socketPath = socketPath
+        self.handler = handler
+        self.warm = warm
+        if workers is not None:
+            self.workers = workers
+        self._sock = None
+        self._children = set()
+        self._stopping = False
+
+    def serve(self):
+        self._listen()
+        oldHandler = signal.signal(signal.SIGTERM, self._stop)
+        try:
+            while not self._stopping:
+                while len(self._children) < self.workers:
+                    self._spawn()
+                try:
+                    pid, status = os.wait()
+                except OSError, e:
+                    if e.errno != errno.EINTR:
+                        raise
+                    continue
+                self._children.discard(pid)
+        finally:
+            signal.signal(signal.SIGTERM, oldHandler)
+            self._shutdown()
+
+    def _stop(self, signum, frame):
+        self._stopping = True
+
+    def _listen(self):
+        # Refuse to take over the socket of a live pool
+        try:
+            submitSock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                submitSock.connect(self.socketPath)
+            finally:
+                submitSock.close()
+        except socket.error:
+            pass
+        else:
+            raise PoolError("A worker pool is already listening on %s" %
+                self.socketPath)
+        util.mkdirChain(os.path.dirname(self.socketPath))
+        if os.path.exists(self.socketPath):
+            os.unlink(self.socketPath)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # The socket must never be reachable by other users, not even
+        # between its creation and a chmod
+        oldUmask = os.umask(077)
+        try:
+            self._sock.bind(self.socketPath)
+        finally:
+            os.umask(oldUmask)
+        self._sock.listen(self.backlog)
+        logger.info("Worker pool listening on %s", self.socketPath)
+
+    def _warm(self):
+        if self.warm is None:
+            return
+        try:
+            self.warm()
+        except Exception:
+            logger.exception("Unable to warm up the worker pool")
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid:
+            self._children.add(pid)
+            return
+        try:
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                concurrency.afterFork()
+                self._warm()
+                self._serveOne()
+            except Exception:
+                logger.exception("Worker failed")
+        finally:
+            os._exit(0)
+
+    def _serveOne(self):
+        conn, _ = self._sock.accept()
+        self._sock.close()
+        try:
+            request = conn.makefile('r').readline()
+            uid = self._getPeerUid(conn)
+            if uid != os.getuid():
+                logger.warning("Refusing request from uid %s", uid)
+                status, output = 1, "Permission denied\n"
+            else:
+                try:
+                    request = json.loads(request)
+                    args = [ str(x) for x in request['args'] ]
+                    environ = dict(request.get('env') or {})
+                except (ValueError, KeyError, TypeError, AttributeError):
+                    status, output = 2, "Bad request\n"
+                else:
+                    self._resetEnvironment(environ)
+                    status, output = self._handle(args)
+            conn.sendall(json.dumps(dict(status=status,
+                output=output.decode('utf-8', 'replace'))) + '\n')
+        finally:
+            conn.close()
+
+    @classmethod
+    def _getPeerUid(cls, conn):
+        try:
+            creds = conn.getsockopt(socket.SOL_SOCKET, SO_PEERCRED,
+                struct.calcsize('3i'))
+        except socket.error:
+            return None
+        pid, uid, gid = struct.unpack('3i', creds)
+        return uid
+
+    def _resetEnvironment(self, environ):
+        os.environ.clear()
+        os.environ.update(self.environment)
+        for key, value in environ.iteritems():
+            if key in PASS_ENVIRONMENT:
+                os.environ[str(key)] = str(value)
+
+    def _handle(self, args):
+        try:
+            return self.handler(args)
+        except SystemExit, e:
+            if e.code is None:
+                return 0, ''
+            if isinstance(e.code, int):
+                return e.code, ''
+            return 1, str(e.code) + '\n'
+        except Exception:
+            return 1, traceback.format_exc()
+
+    def _shutdown(self):
+        for pid in self._children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError, e:
+                if e.errno != errno.ESRCH:
+                    raise
+        for pid in self._children:
+            try:
+                os.waitpid(pid, 0)
+            except OSError, e:
+                if e.errno != errno.ECHILD:
+                    raise
+        self._children.clear()
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+            if os.path.exists(self.socketPath):
+                os.unlink(self.socketPath)
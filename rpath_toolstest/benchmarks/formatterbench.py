@@ -0,0 +1,128 @@
+#!/usr/bin/python
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Benchmark of the preview formatter on a synthetic update job.
+
+Run with::
+
+    python -m rpath_toolstest.benchmarks.formatterbench [--jobs 50000]
+"""
+
+import optparse
+import sys
+import time
+
+from conary import versions
+from conary.deps import deps
+
+from rpath_tools.lib import formatter
+
+FLAVORS = [
+    'is: x86',
+    'is: x86(i486,i586,i686)',
+    'is: x86_64',
+    '~!xen is: x86_64',
+]
+
+
+class _UpdateJob(object):
+    def __init__(self, jobs):
+        self._jobs = jobs
+
+    def getJobs(self):
+        return self._jobs
+
+
+class _UnmemoizedFormatter(formatter.StreamingFormatter):
+    __slots__ = []
+
+    def _render(self, kind, function, obj, key=None):
+        return function(obj)
+
+
+def syntheticUpdateJob(count, flavorCount=len(FLAVORS), jobsPerList=1000):
+    """
+    Return an update job with C{count} jobs, a third of them installs, a
+    third erases and a third updates
+    """
+    flavors = [ deps.parseFlavor(x) for x in FLAVORS[:flavorCount] ]
+    jobLists = []
+    jobList = None
+    for i in range(count):
+        if i % jobsPerList == 0:
+            jobList = []
+            jobLists.append(jobList)
+        name = 'package%d:runtime' % i
+        flavor = flavors[i % len(flavors)]
+        oldVersion = versions.ThawVersion(
+            '/localhost@rpl:linux/%d.000:1.0-1-1' % (1200000000 + i))
+        newVersion = versions.ThawVersion(
+            '/localhost@rpl:linux/%d.000:1.1-1-1' % (1300000000 + i))
+        if i % 3 == 0:
+            job = (name, (None, None), (newVersion, flavor), True)
+        elif i % 3 == 1:
+            job = (name, (oldVersion, flavor), (None, None), False)
+        else:
+            newFlavor = flavors[(i + 1) % len(flavors)]
+            job = (name, (oldVersion, flavor), (newVersion, newFlavor), False)
+        jobList.append(job)
+    return _UpdateJob(jobLists)
+
+
+def timeFormatter(cls, updateJob, repeat):
+    """Return the best time to format C{updateJob}, and the output"""
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        fmt = cls(updateJob)
+        fmt.format()
+        fmt.addDownloadSize(0)
+        xml = fmt.toxml()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, xml
+
+
+def main(args=None):
+    parser = optparse.OptionParser()
+    parser.add_option('--jobs', type='int', default=50000,
+        help='number of jobs in the update')
+    parser.add_option('--flavors', type='int', default=len(FLAVORS),
+        help='number of distinct flavors')
+    parser.add_option('--repeat', type='int', default=3,
+        help='number of runs per formatter; the best one is reported')
+    options, _ = parser.parse_args(args)
+
+    updateJob = syntheticUpdateJob(options.jobs, options.flavors)
+    results = []
+    for cls in [ formatter.Formatter, _UnmemoizedFormatter,
+            formatter.StreamingFormatter ]:
+        elapsed, xml = timeFormatter(cls, updateJob, options.repeat)
+        results.append((cls.__name__, elapsed, xml))
+        print "%-24s %8.3fs %8.1f jobs/s" % (cls.__name__, elapsed,
+            options.jobs / elapsed)
+    if len(set(x[2] for x in results)) != 1:
+        print "Formatters produced different output"
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
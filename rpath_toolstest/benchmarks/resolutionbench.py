@@ -0,0 +1,163 @@
+#!/usr/bin/python
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Benchmark of update jobs against the test suite's local repository.
+
+It commits two versions of a synthetic group with the requested number
+of packages, installs the first one, then previews, downloads and
+applies the update to the second one, timing every action as a whole
+and stage by stage (see L{rpath_tools.lib.timings}). The report is a
+JSON document, to be compared across releases.
+
+It needs the test suite's environment; run it from the top of the
+source tree:
+
+    python -m rpath_toolstest.benchmarks.resolutionbench \\
+        --packages 100,1000 --output report.json
+"""
+
+import json
+import optparse
+import os
+import platform
+import sys
+import time
+import unittest
+
+from rpath_toolstest import testbase
+
+from rpath_tools.lib import stored_objects, update
+
+
+class ResolutionBenchmark(testbase.TestCaseRepo):
+    """
+    Time the update of a group of C{packageCount} packages, of which a
+    C{changedRatio} fraction changes between the two versions.
+    """
+    packageCount = 100
+    changedRatio = 1.0
+    groupName = 'group-bench'
+
+    def __init__(self, methodName='runBenchmark'):
+        testbase.TestCaseRepo.__init__(self, methodName)
+        self.report = None
+
+    def buildGroups(self):
+        changed = int(self.packageCount * self.changedRatio)
+        packages = [ 'bench%05d' % x for x in range(self.packageCount) ]
+        for v in [ '1', '2' ]:
+            members = []
+            for i, name in enumerate(packages):
+                if v == '2' and i >= changed:
+                    # Unchanged package; the new group keeps version 1
+                    members.append((name, '1'))
+                    continue
+                self.addComponent(name + ':runtime', v, fileContents=[
+                    ('/usr/share/%s/data' % name, '%s %s\n' % (name, v)),
+                    ('/etc/%s.conf' % name, 'version=%s\n' % v),
+                ])
+                self.addCollection(name, v, [ ':runtime' ])
+                members.append(name)
+            self.addCollection(self.groupName, v, members)
+        return changed
+
+    def runAction(self, action, job):
+        start = time.time()
+        getattr(update.SyncModel(), action)(job, raiseExceptions=True)
+        return dict(seconds=round(time.time() - start, 4),
+            state=job.state, stages=job.timings)
+
+    def runBenchmark(self):
+        report = dict(packages=self.packageCount)
+        start = time.time()
+        report['changed'] = self.buildGroups()
+        report['commitSeconds'] = round(time.time() - start, 4)
+
+        start = time.time()
+        self.updatePkg([ '%s=1' % self.groupName ])
+        report['installSeconds'] = round(time.time() - start, 4)
+        systemModelPath = os.path.join(self.workDir,
+            '../root/etc/conary/system-model')
+        file(systemModelPath, 'w').write('install %s=%s/1\n' % (
+            self.groupName, self.defLabel))
+
+        job = stored_objects.ConcreteUpdateJobFactory(self.storagePath).new()
+        job.state = 'New'
+        job.systemModel = 'install %s=%s/2\n' % (self.groupName,
+            self.defLabel)
+        for action in [ 'preview', 'download', 'apply' ]:
+            report[action] = self.runAction(action, job)
+        report['summary'] = job.summary
+        self.report = report
+
+
+def runBenchmark(packageCount, changedRatio):
+    """
+    Run the benchmark in its own test repository and return its report
+    """
+    bench = ResolutionBenchmark()
+    bench.packageCount = packageCount
+    bench.changedRatio = changedRatio
+    result = unittest.TestResult()
+    bench.run(result)
+    problems = result.errors + result.failures
+    if problems:
+        raise RuntimeError("Benchmark with %d packages failed:\n%s" % (
+            packageCount, problems[0][1]))
+    return bench.report
+
+
+def main(args=None):
+    parser = optparse.OptionParser()
+    parser.add_option('--packages', default='100',
+        help='comma-separated sizes of the group, in packages')
+    parser.add_option('--changed', type='float', default=1.0,
+        help='fraction of the packages changed by the update')
+    parser.add_option('--output',
+        help='write the JSON report to this file instead of stdout')
+    options, _ = parser.parse_args(args)
+
+    # Set up the test suite's environment
+    import testsuite
+    testsuite.setup()
+
+    runs = []
+    for count in options.packages.split(','):
+        report = runBenchmark(int(count), options.changed)
+        sys.stderr.write("%d packages: preview %.2fs, download %.2fs, "
+            "apply %.2fs\n" % (report['packages'],
+                report['preview']['seconds'], report['download']['seconds'],
+                report['apply']['seconds']))
+        runs.append(report)
+    report = dict(
+        created=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        python=platform.python_version(),
+        machine=platform.machine(),
+        runs=runs,
+    )
+    data = json.dumps(report, indent=2, sort_keys=True) + '\n'
+    if options.output:
+        file(options.output, 'w').write(data)
+    else:
+        sys.stdout.write(data)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
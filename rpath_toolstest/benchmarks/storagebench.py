@@ -0,0 +1,278 @@
+#!/usr/bin/python
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Benchmark of the job storage layer: stored objects, their index and logs.
+
+It runs against a scratch directory (on tmpfs by default) and needs no
+conary repository. Results can be saved as a baseline, and later runs
+compared against it:
+
+    python -m rpath_toolstest.benchmarks.storagebench --jobs 5000 \\
+        --save-baseline storage-baseline.json
+    python -m rpath_toolstest.benchmarks.storagebench --jobs 5000 \\
+        --baseline storage-baseline.json
+
+The comparison fails if an operation got slower, or made more file
+system calls, by more than the tolerance.
+"""
+
+import json
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from rpath_tools.lib import jobs, stored_objects
+
+# File system calls counted while running a benchmark
+COUNTED_CALLS = [ 'stat', 'lstat', 'listdir', 'open', 'rename', 'unlink',
+    'mkdir', 'rmdir', 'utime', 'link' ]
+
+
+class SyscallCounter(object):
+    """
+    Count the file system calls made through the C{os} module, plus the
+    read and write system calls reported by the kernel for the process.
+    """
+    def __init__(self):
+        self.counts = dict((x, 0) for x in COUNTED_CALLS)
+        self._saved = {}
+        self._io = None
+
+    def __enter__(self):
+        for name in COUNTED_CALLS:
+            self._saved[name] = function = getattr(os, name)
+            setattr(os, name, self._wrap(name, function))
+        self._io = self._readIo()
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        io = self._readIo()
+        for name, function in self._saved.iteritems():
+            setattr(os, name, function)
+        for key in [ 'syscr', 'syscw' ]:
+            if key in io and key in self._io:
+                self.counts[key] = io[key] - self._io[key]
+        return False
+
+    def _wrap(self, name, function):
+        counts = self.counts
+        def wrapper(*args, **kwargs):
+            counts[name] += 1
+            return function(*args, **kwargs)
+        return wrapper
+
+    @classmethod
+    def _readIo(cls):
+        # Only available on Linux
+        try:
+            f = open('/proc/self/io')
+        except IOError:
+            return {}
+        try:
+            return dict((k, int(v)) for k, v in
+                (line.split(':', 1) for line in f))
+        finally:
+            f.close()
+
+    def total(self):
+        return sum(self.counts.itervalues())
+
+
+class StorageBenchmark(object):
+    """
+    Create synthetic update jobs, then time the storage operations on
+    them. Every benchmark returns the number of operations it ran.
+    """
+    benchmarks = [ 'latest', 'iterate', 'logAdd', 'logEnumerate',
+        'enumerateAll', 'cleanJob' ]
+
+    def __init__(self, storagePath, jobCount, logCount, expiredRatio=0.1,
+            repeat=20):
+        self.storagePath = storagePath
+        self.jobCount = jobCount
+        self.logCount = logCount
+        self.expiredRatio = expiredRatio
+        self.repeat = repeat
+        self.factory = stored_objects.ConcreteUpdateJobFactory(storagePath)
+        self.keys = []
+
+    def setup(self):
+        now = time.time()
+        expired = int(self.jobCount * self.expiredRatio)
+        for i in range(self.jobCount):
+            job = self.factory.new()
+            job.state = "Previewed"
+            job.systemModel = "install group-foo=/localhost@rpl:linux/%d\n" % i
+            job.content = "<preview id=%r/>" % job.keyId
+            for j in range(self.logCount):
+                job.logs.add("log entry %d" % j, timestamp=now + j)
+            if i < expired:
+                job.expiration = now - 60
+            self.keys.append(job.keyId)
+
+    def run(self):
+        """
+        Run the benchmarks; return a map of the benchmark name to its
+        number of operations, elapsed time and file system call counts
+        """
+        results = {}
+        for name in self.benchmarks:
+            counter = SyscallCounter()
+            start = time.time()
+            with counter:
+                ops = getattr(self, 'bench_' + name)()
+            elapsed = time.time() - start
+            results[name] = dict(ops=ops, seconds=elapsed,
+                opsPerSecond=ops / elapsed if elapsed else 0.0,
+                syscallsPerOp=float(counter.total()) / (ops or 1),
+                syscalls=counter.counts)
+        return results
+
+    def bench_latest(self):
+        for _ in range(self.repeat):
+            self.factory.latest()
+        return self.repeat
+
+    def bench_iterate(self):
+        # The first pass also moves the expired jobs to the trash
+        count = 0
+        for _ in range(self.repeat):
+            for job in self.factory:
+                count += 1
+        return count
+
+    def bench_logAdd(self):
+        count = 0
+        for key in self.keys[-self.repeat:]:
+            job = self.factory.load(key)
+            for j in range(self.logCount):
+                job.logs.add("more log %d" % j)
+                count += 1
+        return count
+
+    def bench_logEnumerate(self):
+        count = 0
+        for key in self.keys[-self.repeat:]:
+            job = self.factory.load(key)
+            for log in job.logs.enumerate():
+                count += 1
+        return count
+
+    def bench_enumerateAll(self):
+        strg = stored_objects.ConcreteUpdateJob.getStorage(self.storagePath)
+        count = 0
+        for key in strg.enumerateAll():
+            count += 1
+        return count
+
+    def bench_cleanJob(self):
+        # cleanJob removes every key of the job's storage; this has to
+        # be the last benchmark
+        task = jobs.BaseUpdateTask()
+        task.job = self.factory.load(self.keys[-1])
+        count = len(list(task.job.storage.enumerateAll()))
+        task.cleanJob()
+        return count
+
+
+def compare(results, baseline, tolerance):
+    """
+    Return the list of regressions of C{results} against C{baseline}
+    """
+    regressions = []
+    for name, result in sorted(results.iteritems()):
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result['opsPerSecond'] < base['opsPerSecond'] * (1 - tolerance):
+            regressions.append("%s: %.1f ops/s, baseline %.1f ops/s" % (
+                name, result['opsPerSecond'], base['opsPerSecond']))
+        if result['syscallsPerOp'] > base['syscallsPerOp'] * (1 + tolerance):
+            regressions.append("%s: %.1f calls/op, baseline %.1f calls/op"
+                % (name, result['syscallsPerOp'], base['syscallsPerOp']))
+    return regressions
+
+
+def main(args=None):
+    parser = optparse.OptionParser()
+    parser.add_option('--jobs', type='int', default=2000,
+        help='number of jobs created')
+    parser.add_option('--logs', type='int', default=20,
+        help='number of log entries per job')
+    parser.add_option('--repeat', type='int', default=20,
+        help='number of repetitions (or of jobs) per benchmark')
+    parser.add_option('--dir', default=None,
+        help='directory to create the jobs in (default: /dev/shm)')
+    parser.add_option('--save-baseline', dest='saveBaseline',
+        help='save the results to this file')
+    parser.add_option('--baseline',
+        help='compare the results with the ones saved in this file')
+    parser.add_option('--tolerance', type='float', default=0.3,
+        help='relative slowdown tolerated before reporting a regression')
+    options, _ = parser.parse_args(args)
+
+    baseDir = options.dir
+    if baseDir is None and os.path.isdir('/dev/shm'):
+        baseDir = '/dev/shm'
+    storagePath = tempfile.mkdtemp(prefix='storagebench.', dir=baseDir)
+    try:
+        bench = StorageBenchmark(storagePath, options.jobs, options.logs,
+            repeat=options.repeat)
+        start = time.time()
+        bench.setup()
+        print "Created %d jobs in %.2fs" % (options.jobs, time.time() - start)
+        results = bench.run()
+    finally:
+        shutil.rmtree(storagePath, ignore_errors=True)
+
+    print "%-14s %8s %9s %12s %9s" % ('benchmark', 'ops', 'seconds',
+        'ops/s', 'calls/op')
+    for name in bench.benchmarks:
+        result = results[name]
+        print "%-14s %8d %9.3f %12.1f %9.1f" % (name, result['ops'],
+            result['seconds'], result['opsPerSecond'],
+            result['syscallsPerOp'])
+
+    if options.saveBaseline:
+        f = open(options.saveBaseline, 'w')
+        try:
+            json.dump(dict(jobs=options.jobs, logs=options.logs,
+                results=results), f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+    if options.baseline:
+        baseline = json.load(open(options.baseline))
+        if (baseline.get('jobs'), baseline.get('logs')) != (options.jobs,
+                options.logs):
+            print "Baseline was run with different parameters"
+            return 1
+        regressions = compare(results, baseline['results'],
+            options.tolerance)
+        for regression in regressions:
+            print "REGRESSION %s" % regression
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -15,11 +15,17 @@
 #
 
 import os
+import signal
+import sys
+import threading
 import time
 
 from .. import testbase
 
-from rpath_tools.lib import stored_objects
+from rpath_tools.lib import concurrency, logsegment, metrics, profiling
+from rpath_tools.lib import reaper
+from rpath_tools.lib import scheduler
+from rpath_tools.lib import stored_objects, workerpool
 
 class StorageTest(testbase.TestCase):
     def testConcreteJobFactory(self):
@@ -33,6 +39,7 @@ class StorageTest(testbase.TestCase):
         fPath = os.path.join(self.workDir, "storage",
             concreteJob.prefix, key, "content")
         self.failUnless(os.path.exists(fPath), fPath)
+        self.failUnlessEqual(concreteJob.contentPath, fPath)
         logs = [ concreteJob.logs.add(str(x)) for x in range(3) ]
 
         self.failUnlessEqual(concreteJob.expiration, concreteJob.updated + 36000)
@@ -42,6 +49,107 @@ class StorageTest(testbase.TestCase):
         self.failUnlessEqual(concreteJob.pid, 12345)
         self.failUnlessEqual(list(concreteJob.logs.enumerate()), logs)
 
+        concreteJob.content = None
+        self.failUnlessEqual(concreteJob.contentPath, None)
+
+    def testBufferedLogs(self):
+        storagePath = self.workDir + '/storage'
+        uf = stored_objects.ConcreteUpdateJobFactory(storagePath)
+        concreteJob = uf.new()
+        key = concreteJob.keyId
+        # A log file from the one-file-per-entry days
+        logsDir = os.path.join(storagePath, concreteJob.prefix, key, "logs")
+        os.makedirs(logsDir)
+        file(os.path.join(logsDir, "1000.0000"), "w").write("old")
+
+        writer = concreteJob.bufferLogs()
+        writer.flushInterval = 3600
+        logs = [ concreteJob.logs.add(str(x), timestamp = 2000 + x)
+            for x in range(3) ]
+        # Nothing written yet
+        self.failUnlessEqual(
+            [ x.content for x in uf.load(key).logs.enumerate() ],
+            [ "old" ])
+        concreteJob.flushLogs()
+        self.failUnlessEqual(list(uf.load(key).logs.enumerate()),
+            [ stored_objects.Log(timestamp = "1000.0000", content = "old") ]
+            + logs)
+        self.failUnlessEqual(sorted(os.listdir(logsDir)),
+            [ '.segment', '.segment.idx', '1000.0000' ])
+
+    def testLogTimestamps(self):
+        storagePath = self.workDir + '/storage'
+        uf = stored_objects.ConcreteUpdateJobFactory(storagePath)
+        concreteJob = uf.new()
+        # Colliding timestamps are moved forward, also across writers
+        logs = [ concreteJob.logs.add(str(x), timestamp = 1000.00001)
+            for x in range(2) ]
+        writer = concreteJob.bufferLogs()
+        writer.flushInterval = 0.05
+        logs += [ concreteJob.logs.add(str(x), timestamp = 1000)
+            for x in range(2, 4) ]
+        self.failUnlessEqual([ x.timestamp for x in logs ],
+            [ "1000.0000", "1000.0001", "1000.0002", "1000.0003" ])
+
+        # The timer writes buffered entries
+        for i in range(100):
+            if uf.load(concreteJob.keyId).logs.segment.sequence() == 4:
+                break
+            time.sleep(0.05)
+        self.failUnlessEqual(list(uf.load(concreteJob.keyId).logs.enumerate()),
+            logs)
+
+        # So does every state change
+        writer.flushInterval = 3600
+        log = concreteJob.logs.add("Done")
+        concreteJob.state = "Completed"
+        self.failUnlessEqual(
+            list(uf.load(concreteJob.keyId).logs.enumerate())[-1], log)
+        concreteJob.closeLogs()
+
+    def testLogsSince(self):
+        storagePath = self.workDir + '/storage'
+        uf = stored_objects.ConcreteUpdateJobFactory(storagePath)
+        concreteJob = uf.new()
+        logs = [ concreteJob.logs.add(str(x), timestamp = 1000 + x)
+            for x in range(5) ]
+
+        self.failUnlessEqual(concreteJob.logs.since(limit = 2), logs[:2])
+        self.failUnlessEqual(
+            concreteJob.logs.since(logs[1].timestamp, limit = 2), logs[2:4])
+        self.failUnlessEqual(concreteJob.logs.since(logs[-1].timestamp), [])
+
+        follower = concreteJob.logs.follow(logs[2].timestamp, timeout = 0)
+        self.failUnlessEqual(list(follower), logs[3:])
+
+        follower = concreteJob.logs.follow(logs[-1].timestamp,
+            timeout = 5, pollInterval = 0.01)
+        log = concreteJob.logs.add("new")
+        self.failUnlessEqual(follower.next(), log)
+
+    def testLogsSinceSameTimestamp(self):
+        storagePath = self.workDir + '/storage'
+        uf = stored_objects.ConcreteUpdateJobFactory(storagePath)
+        concreteJob = uf.new()
+        logs = [ concreteJob.logs.add(str(x), timestamp = 1000)
+            for x in range(3) ]
+        writer = concreteJob.bufferLogs()
+        writer.flushInterval = 3600
+        logs += [ concreteJob.logs.add(str(x), timestamp = 1000)
+            for x in range(3, 6) ]
+
+        # Paging one entry at a time must not skip any
+        seen = []
+        page = concreteJob.logs.since(limit = 1)
+        while page:
+            seen.extend(page)
+            page = concreteJob.logs.since(page[-1].timestamp, limit = 1)
+        self.failUnlessEqual(seen, logs)
+        self.failUnlessEqual(
+            list(concreteJob.logs.follow(logs[3].timestamp, timeout = 0)),
+            logs[4:])
+        concreteJob.closeLogs()
+
     def testExpiredKey(self):
         storagePath = self.workDir + '/storage'
         uf = stored_objects.ConcreteUpdateJobFactory(storagePath)
@@ -58,6 +166,50 @@ class StorageTest(testbase.TestCase):
         self.failUnless(key1 in keys, "%s not in %s" % (key1, keys))
         self.failIf(key2 in keys)
 
+    def testReapExpired(self):
+        storagePath = self.workDir + '/storage'
+        uf = stored_objects.ConcreteUpdateJobFactory(storagePath)
+        concreteJob = uf.new()
+        key1 = concreteJob.keyId
+        concreteJob = uf.new()
+        file(os.path.join(concreteJob.downloadDir, "1.ccs"), "w").write(
+            "1" * 1000)
+        concreteJob.expiration = time.time() - 10
+        key2 = concreteJob.keyId
+
+        # Iterating only moves the expired job out of the way
+        self.failUnlessEqual([ x.keyId for x in uf ], [ key1 ])
+        trashPath = concreteJob.storage.getTrashPath()
+        self.failUnlessEqual(len(os.listdir(trashPath)), 1)
+
+        stats = reaper.ExpiryReaper(uf).run()
+        self.failUnlessEqual(stats.jobs, 1)
+        self.failUnless(stats.bytes >= 1000, stats.bytes)
+        self.failUnlessEqual(stats.pending, 0)
+        self.failUnlessEqual(os.listdir(trashPath), [])
+
+        # The reaper picks up expired jobs by itself too
+        uf.load(key1).expiration = time.time() - 10
+        stats = reaper.ExpiryReaper(uf).run()
+        self.failUnlessEqual((stats.expired, stats.jobs), (1, 1))
+        self.failUnlessEqual(list(uf), [])
+        self.failIf(key2 in uf.getIndex().entries())
+
+    def testReapPreviewMemos(self):
+        storagePath = self.workDir + '/storage'
+        mf = stored_objects.PreviewMemoFactory(storagePath)
+        stored_objects.PreviewMemo(storagePath, keyId='old').content = 'job1'
+        stored_objects.PreviewMemo(storagePath, keyId='new').content = 'job2'
+        mf.load('old').updated = time.time() - mf.factory.ttl - 10
+
+        stats = reaper.ExpiryReaper(mf).run()
+        self.failUnlessEqual((stats.expired, stats.jobs), (1, 1))
+        self.failUnlessEqual(mf.load('old').content, None)
+        self.failUnlessEqual(mf.load('new').content, 'job2')
+        # The trash itself is never considered expired
+        mf.load('new').updated = time.time() - mf.factory.ttl - 10
+        self.failUnlessEqual(mf.expired(), [ 'new' ])
+
     def testLatest(self):
         storagePath = self.workDir + '/storage'
         uf = stored_objects.ConcreteUpdateJobFactory(storagePath)
@@ -80,6 +232,65 @@ class StorageTest(testbase.TestCase):
             uf.latest(filter = lambda x: x.state != "Bloobering").keyId,
             key1)
 
+    def testLatestIndex(self):
+        storagePath = self.workDir + '/storage'
+        uf = stored_objects.ConcreteUpdateJobFactory(storagePath)
+        jobs = []
+        for i in range(3):
+            concreteJob = uf.new()
+            concreteJob.updated = 1000 + i
+            concreteJob.expiration = time.time() + 100
+            jobs.append(concreteJob)
+        jobs[0].expiration = time.time() - 10
+        jobs[2].state = "Applying"
+        jobs[2].updated = 1005
+        jobs[2].expiration = time.time() + 100
+
+        index = uf.getIndex()
+        self.failUnlessEqual(index.newest(),
+            [ jobs[2].keyId, jobs[1].keyId ])
+        self.failUnlessEqual(uf.expired(), [ jobs[0].keyId ])
+        self.failUnlessEqual(
+            uf.latest(filter = lambda x: x.state != "Applying").keyId,
+            jobs[1].keyId)
+
+        # A corrupted index gets rebuilt from the stored objects
+        file(index.path, "a").write("garbage")
+        self.failUnlessEqual(index.newest(),
+            [ jobs[2].keyId, jobs[1].keyId ])
+        self.failUnlessEqual(index.entries()[jobs[2].keyId]['state'],
+            "Applying")
+
+        # Objects deleted behind the index' back are dropped
+        jobs[2].storage.delete(jobs[2].keyId)
+        self.failUnlessEqual(uf.latest().keyId, jobs[1].keyId)
+
+    def testIndexCompaction(self):
+        storagePath = self.workDir + '/storage'
+        uf = stored_objects.ConcreteUpdateJobFactory(storagePath)
+        job1 = uf.new()
+        job2 = uf.new()
+        index = uf.getIndex()
+        index.compactThreshold = 10
+        for i in range(10):
+            job1.updated = 1000 + i
+        self.failUnlessEqual(len(file(index.path).readlines()), 12)
+
+        # A line appended after the journal was loaded, but before it is
+        # compacted, must survive the compaction
+        load = index._load
+        def staleLoad():
+            ret = load()
+            job2.state = "Applying"
+            return ret
+        index._load = staleLoad
+        index.entries()
+        del index._load
+        self.failUnlessEqual(len(file(index.path).readlines()), 2)
+        self.failUnlessEqual(index.entries()[job2.keyId]['state'],
+            "Applying")
+        self.failUnlessEqual(index.entries()[job1.keyId]['updated'], 1009)
+
     def testLatestEmpty(self):
         storagePath = self.workDir + '/storage'
         uf = stored_objects.ConcreteUpdateJobFactory(storagePath)
@@ -99,7 +310,347 @@ class StorageTest(testbase.TestCase):
         self.failUnless(os.path.isdir(dname))
         self.failUnless(dname.endswith('update-job'))
 
+    def testRecordFields(self):
+        storagePath = self.workDir + '/storage'
+        uf = stored_objects.ConcreteUpdateJobFactory(storagePath)
+        concreteJob = uf.new()
+        concreteJob.state = "Running"
+        concreteJob.pid = 12345
+        concreteJob.downloadSize = 1024
+        key = concreteJob.keyId
+        jobDir = os.path.join(storagePath, concreteJob.prefix, key)
+        # Scalar fields all live in the same record
+        self.failUnlessEqual(sorted(os.listdir(jobDir)),
+            [ concreteJob.storage.recordName,
+              concreteJob.storage.lockName ])
+
+        concreteJob = uf.load(key)
+        self.failUnlessEqual(concreteJob.state, "Running")
+        self.failUnlessEqual(concreteJob.pid, 12345)
+        self.failUnlessEqual(concreteJob.downloadSize, 1024)
+        self.failIf(concreteJob.created > concreteJob.updated)
+        self.failUnlessEqual(
+            sorted(os.path.basename(x)
+                for x in concreteJob.storage.enumerate(key)),
+            [ 'created', 'downloadSize', 'expiration', 'pid', 'state',
+              'updated' ])
+
+        del concreteJob.state
+        self.failUnlessEqual(concreteJob.state, None)
+
+    def testRecordConcurrentUpdates(self):
+        storagePath = self.workDir + '/storage'
+        uf = stored_objects.ConcreteUpdateJobFactory(storagePath)
+        concreteJob = uf.new()
+        key = concreteJob.keyId
+        fields = [ 'pid', 'downloadSize', 'queueWait', 'priority' ]
+        pids = []
+        for field in fields:
+            pid = os.fork()
+            if not pid:
+                try:
+                    st = uf.load(key).storage
+                    for i in range(50):
+                        st.set((key, field), i)
+                finally:
+                    os._exit(0)
+            pids.append(pid)
+        for pid in pids:
+            os.waitpid(pid, 0)
+        st = uf.load(key).storage
+        self.failUnlessEqual([ st.get((key, x)) for x in fields ],
+            [ '49' ] * len(fields))
+
+    def testRecordFieldsFallback(self):
+        # Fields stored one per file are still readable
+        storagePath = self.workDir + '/storage'
+        uf = stored_objects.ConcreteUpdateJobFactory(storagePath)
+        concreteJob = uf.new()
+        key = concreteJob.keyId
+        jobDir = os.path.join(storagePath, concreteJob.prefix, key)
+        file(os.path.join(jobDir, "state"), "w").write("Previewed")
+        file(os.path.join(jobDir, "pid"), "w").write("42")
+
+        concreteJob = uf.load(key)
+        self.failUnlessEqual(concreteJob.state, "Previewed")
+        self.failUnlessEqual(concreteJob.pid, 42)
+        concreteJob.state = "Applying"
+        self.failUnlessEqual(uf.load(key).state, "Applying")
+
+    def testRecordStaleFilesHidden(self):
+        # A lock or temporary file left behind without a record is not a key
+        storagePath = self.workDir + '/storage'
+        uf = stored_objects.ConcreteUpdateJobFactory(storagePath)
+        concreteJob = uf.new()
+        key = concreteJob.keyId
+        st = concreteJob.storage
+        jobDir = os.path.join(storagePath, concreteJob.prefix, key)
+        for x in os.listdir(jobDir):
+            os.unlink(os.path.join(jobDir, x))
+        file(os.path.join(jobDir, st.lockName), "w")
+        file(os.path.join(jobDir, st.recordName + ".tmpXYZ"), "w")
+        file(os.path.join(jobDir, "state"), "w").write("Previewed")
+        self.failUnlessEqual(
+            [ os.path.basename(x) for x in st.enumerate(key) ],
+            [ 'state' ])
+
 class SimpleStorageTests(testbase.TestCase):
+    def testScheduler(self):
+        storagePath = self.workDir + '/storage'
+        sched = scheduler.Scheduler(storagePath)
+        sched.pollInterval = 0.01
+        # Two previews can run at the same time, but not a third one
+        slots = [ sched.acquire('updates/%d' % x, 'preview', timeout=0)
+            for x in range(3) ]
+        self.failIf(None in slots[:2])
+        self.failUnlessEqual(slots[2], None)
+        self.failUnlessEqual(sched.stats()['preview']['running'], 2)
+        slots[0].release()
+        slot = sched.acquire('updates/2', 'preview', timeout=0)
+        self.failIf(slot is None)
+        self.failUnless(slot.waited >= 0)
+        slot.release()
+        slots[1].release()
+        self.failUnlessEqual(sched.entries(), [])
+
+        # Downloads and applies are serialized
+        slot = sched.acquire('updates/3', 'download', timeout=0)
+        self.failUnlessEqual(
+            sched.acquire('updates/4', 'apply', timeout=0), None)
+        slot.release()
+
+        # Higher priority entries go first; entries of dead processes are
+        # dropped
+        entry = sched.factory.new()
+        entry.kind = 'apply'
+        entry.priority = 10
+        entry.jobId = 'updates/5'
+        entry.pid = os.getpid()
+        entry.state = "Queued"
+        self.failUnlessEqual(
+            sched.acquire('updates/4', 'apply', timeout=0), None)
+        self.failUnlessEqual(sched.stats()['apply']['queued'], 1)
+        # Cancel the queued entry
+        self.failUnless(sched.cancel('updates/5'))
+        self.failUnlessEqual(entry.state, "Cancelled")
+        entry.pid = 2 ** 22 + 1
+        self.failUnlessEqual(sched.entries(), [])
+        slot = sched.acquire('updates/4', 'apply', timeout=0)
+        self.failIf(slot is None)
+        slot.release()
+        self.failIf(sched.cancel('updates/4'))
+
+        # Code running inside a task gets the slot its task already holds
+        slot = sched.acquire('updates/6', 'update', timeout=0)
+        nested = sched.acquire('updates/6', 'apply', timeout=0,
+            reentrant=True)
+        self.failIf(nested is None)
+        nested.release()
+        # but other threads still have to wait
+        other = []
+        thread = threading.Thread(target=lambda: other.append(
+            sched.acquire('updates/7', 'apply', timeout=0, reentrant=True)))
+        thread.start()
+        thread.join()
+        self.failUnlessEqual(other, [ None ])
+        slot.release()
+
+        # Running tasks acquired as not interruptible are not terminated
+        slot = sched.acquire('updates/8', 'download', timeout=0,
+            interruptible=False)
+        self.failUnlessEqual(sched.entries()[0].interruptible, False)
+        self.failIf(sched.cancel('updates/8'))
+        slot.release()
+
+        # Waiting tasks find the queue order in the index, without reading
+        # the queue entries
+        entry = sched.factory.new()
+        entry.kind = 'preview'
+        entry.priority = 3
+        entry.pid = os.getpid()
+        entry.state = "Queued"
+        indexed = sched.factory.getIndex().entries()[entry.keyId]
+        self.failUnlessEqual([ indexed[x] for x in
+                ('kind', 'priority', 'pid', 'state') ],
+            [ 'preview', 3, os.getpid(), 'Queued' ])
+        getField = stored_objects.QueuedTask._getField
+        def failingGetField(*args):
+            raise AssertionError("queue entry read while polling")
+        stored_objects.QueuedTask._getField = failingGetField
+        try:
+            self.failUnless(sched._isNext(entry, 'preview'))
+        finally:
+            stored_objects.QueuedTask._getField = getField
+        sched._remove(entry)
+
+    def testWaitForState(self):
+        storagePath = self.workDir + '/storage'
+        uf = stored_objects.ConcreteUpdateJobFactory(storagePath)
+        concreteJob = uf.new()
+        concreteJob.state = "Running"
+        concreteJob.stateRecheckInterval = 3600
+        self.failUnlessEqual(concreteJob.waitForState("Running"), "Running")
+        self.failUnlessEqual(
+            concreteJob.waitForState("Completed", timeout = 0.1), None)
+
+        pid = os.fork()
+        if not pid:
+            try:
+                time.sleep(0.2)
+                uf.load(concreteJob.keyId).state = "Completed"
+            finally:
+                os._exit(0)
+        start = time.time()
+        try:
+            state = concreteJob.waitForState([ "Completed", "Exception" ],
+                timeout = 30)
+        finally:
+            os.waitpid(pid, 0)
+        self.failUnlessEqual(state, "Completed")
+        # Notified, not polled
+        self.failUnless(time.time() - start < 10)
+        self.failUnlessEqual(os.listdir(concreteJob._getWaitersDir()), [])
+
+    def testStreamedContent(self):
+        class Content(object):
+            def writeTo(self, stream):
+                for x in range(3):
+                    stream.write("line %d\n" % x)
+        storagePath = self.workDir + '/storage'
+        uf = stored_objects.ConcreteUpdateJobFactory(storagePath)
+        concreteJob = uf.new()
+        concreteJob.content = Content()
+        self.failUnlessEqual(uf.load(concreteJob.keyId).content,
+            "line 0\nline 1\nline 2\n")
+
+    def testMetrics(self):
+        storagePath = self.workDir + '/storage'
+        m = metrics.Metrics(storagePath)
+        m.jobFinished('SyncPreviewTask', 'Completed', 0.2, 0.05)
+        m.jobFinished('SyncPreviewTask', 'Completed', 42, 0)
+        m.jobFinished('SyncPreviewTask', 'Cancelled')
+        m.actionFinished('prepareSyncUpdateJob', 'Previewed', 3,
+            [ dict(name='resolve', seconds=2.5, troves=10) ])
+
+        text = file(m.textfilePath).read()
+        self.failUnlessEqual(text, metrics.Metrics(storagePath).format())
+        lines = text.splitlines()
+        labels = 'state="Completed",task="SyncPreviewTask"'
+        for line in [
+                '# TYPE rpath_tools_jobs_total counter',
+                'rpath_tools_jobs_total{%s} 2' % labels,
+                'rpath_tools_jobs_total{state="Cancelled",'
+                    'task="SyncPreviewTask"} 1',
+                '# TYPE rpath_tools_job_duration_seconds histogram',
+                'rpath_tools_job_duration_seconds_bucket{%s,le="0.1"} 0'
+                    % labels,
+                'rpath_tools_job_duration_seconds_bucket{%s,le="0.5"} 1'
+                    % labels,
+                'rpath_tools_job_duration_seconds_bucket{%s,le="60"} 2'
+                    % labels,
+                'rpath_tools_job_duration_seconds_bucket{%s,le="+Inf"} 2'
+                    % labels,
+                'rpath_tools_job_duration_seconds_sum{%s} 42.2' % labels,
+                'rpath_tools_job_duration_seconds_count{%s} 2' % labels,
+                'rpath_tools_job_queue_wait_seconds_count'
+                    '{task="SyncPreviewTask"} 2',
+                'rpath_tools_actions_total{action="prepareSyncUpdateJob",'
+                    'state="Previewed"} 1',
+                'rpath_tools_action_stage_seconds_count'
+                    '{action="prepareSyncUpdateJob",stage="resolve"} 1',
+                ]:
+            self.failUnless(line in lines, line)
+
+    def testProfiler(self):
+        self.failUnlessEqual(profiling.Profiler.parse('cpu, memory'),
+            set([ 'cpu', 'memory' ]))
+        self.failUnlessEqual(profiling.Profiler.parse('all'),
+            set([ 'cpu', 'memory' ]))
+        self.failUnlessRaises(ValueError, profiling.Profiler.parse, 'disk')
+        self.failUnlessEqual(profiling.Profiler.fromEnvironment({}), set())
+        self.failUnlessEqual(profiling.Profiler.fromEnvironment(
+            { profiling.Profiler.envVar : 'cpu' }), set([ 'cpu' ]))
+
+        def slowFunction(count):
+            return sum(len(str(x)) == 1 for x in range(count))
+        profiler = profiling.Profiler([ 'cpu', 'memory' ])
+        self.failUnlessEqual(profiler.runcall(slowFunction, 1000), 10)
+        self.failUnless('slowFunction' in profiler.cpuReport)
+        self.failUnless('Peak resident set size' in profiler.memoryReport)
+
+        profiler = profiling.Profiler([ 'memory' ])
+        self.failUnlessRaises(ZeroDivisionError, profiler.runcall,
+            lambda: 1 / 0)
+        self.failUnlessEqual(profiler.cpuReport, None)
+        self.failIfEqual(profiler.memoryReport, None)
+
+        storagePath = self.workDir + '/storage'
+        job = stored_objects.ConcreteUpdateJobFactory(storagePath).new()
+        self.failUnlessEqual(job.profile, None)
+        job.profile = profiler.memoryReport
+        job.memoryProfile = profiler.memoryReport
+        self.failUnlessEqual(job.memoryProfile, profiler.memoryReport)
+        job.profile = None
+        self.failUnlessEqual(job.profile, None)
+
+    def testForkHandlers(self):
+        cache = dict(client='parent')
+        handlers = len(concurrency._forkHandlers)
+        concurrency.registerForkHandler(cache.clear)
+        try:
+            concurrency.registerForkHandler(cache.clear)
+            self.failUnlessEqual(len(concurrency._forkHandlers),
+                handlers + 1)
+            call = concurrency.ForkedCall(lambda: sorted(cache)).start()
+            self.failUnlessEqual(call.wait(), [])
+            self.failUnlessEqual(cache, dict(client='parent'))
+        finally:
+            concurrency._forkHandlers.remove(cache.clear)
+
+    def testLogWriterAfterFork(self):
+        segment = logsegment.LogSegment(self.workDir + '/log')
+        os.makedirs(segment.path)
+        writer = logsegment.LogWriter(segment)
+        writer.add('parent')
+        # Another thread (the timer, say) holds the writer's lock while
+        # the process forks
+        locked, release = threading.Event(), threading.Event()
+        def hold():
+            writer._lock.acquire()
+            locked.set()
+            release.wait()
+            writer._lock.release()
+        thread = threading.Thread(target=hold)
+        thread.start()
+        locked.wait()
+        try:
+            def child():
+                writer.add('child')
+                writer.flush()
+            call = concurrency.ForkedCall(child).start()
+            self.failUnlessEqual(call.wait(), None)
+        finally:
+            release.set()
+            thread.join()
+        writer.close()
+        # The parent's buffered entry is only written by the parent
+        self.failUnlessEqual(sorted(x[1] for x in segment.read()),
+            [ 'child', 'parent' ])
+
+    def testPerThread(self):
+        perThread = concurrency.PerThread(object, 'main')
+        self.failUnlessEqual(perThread.get(), 'main')
+        def get(x):
+            time.sleep(0.01)
+            return threading.currentThread(), perThread.get()
+        results = concurrency.parallelMap(get, range(4), 2)
+        self.failIf('main' in [ x[1] for x in results ])
+        # One object per thread
+        self.failUnlessEqual(len(set(results)),
+            len(set(x[0] for x in results)))
+        self.failUnlessEqual(len(set(results)),
+            len(set(id(x[1]) for x in results)))
+
     def testSimpleStorage(self):
         storagePath = self.workDir + '/storage'
 
@@ -134,3 +685,89 @@ class SimpleStorageTests(testbase.TestCase):
         for obj in expected:
             nobj = sf.load(obj.keyId)
             self.failUnlessEqual(nobj.keyId, obj.keyId)
+
+
+class WorkerPoolTest(testbase.TestCase):
+    def _startPool(self, pool):
+        pid = os.fork()
+        if not pid:
+            try:
+                pool.serve()
+            finally:
+                os._exit(0)
+        while not os.path.exists(pool.socketPath):
+            time.sleep(0.01)
+        return pid
+
+    def _stopPool(self, pid):
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+
+    def _submit(self, socketPath, args):
+        # The socket file shows up just before the pool listens on it
+        for i in range(100):
+            try:
+                return workerpool.submit(socketPath, args)
+            except workerpool.PoolUnavailable:
+                time.sleep(0.01)
+        return workerpool.submit(socketPath, args)
+
+    def testRequest(self):
+        socketPath = os.path.join(self.workDir, 'pool', 'worker.sock')
+        self.failUnlessRaises(workerpool.PoolUnavailable,
+            workerpool.submit, socketPath, [ 'x' ])
+
+        def handler(args):
+            if args == [ 'exit' ]:
+                sys.exit(3)
+            return 0, '%s %s\n' % (' '.join(args),
+                ' '.join(sorted(os.environ)))
+        environ = os.environ.copy()
+        os.environ['RPATH_TOOLS_SECRET'] = 'secret'
+        os.environ['TZ'] = 'UTC'
+        try:
+            pid = self._startPool(workerpool.WorkerPool(socketPath, handler,
+                workers=1))
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+        try:
+            # Only the client's passed variables reach the worker
+            os.environ['RPATH_TOOLS_SECRET'] = 'secret'
+            os.environ['TZ'] = 'UTC'
+            try:
+                request = self._submit(socketPath, [ 'a', 'b' ])
+            finally:
+                os.environ.clear()
+                os.environ.update(environ)
+            self.failUnlessEqual(request.wait(), 0)
+            self.failUnlessEqual(request.stdout.read(), 'a b PATH TZ\n')
+            # The socket is only accessible to its owner
+            self.failUnlessEqual(os.stat(socketPath).st_mode & 0777, 0700)
+            self.failUnlessEqual(
+                self._submit(socketPath, [ 'exit' ]).wait(), 3)
+            # A second pool does not take over the socket
+            self.failUnlessRaises(workerpool.PoolError,
+                workerpool.WorkerPool(socketPath, handler).serve)
+        finally:
+            self._stopPool(pid)
+
+    def testForeignUidRefused(self):
+        socketPath = os.path.join(self.workDir, 'pool', 'worker.sock')
+        handled = os.path.join(self.workDir, 'handled')
+        def handler(args):
+            file(handled, 'w').write('handled')
+            return 0, ''
+
+        class Pool(workerpool.WorkerPool):
+            @classmethod
+            def _getPeerUid(cls, conn):
+                return os.getuid() + 1
+        pid = self._startPool(Pool(socketPath, handler, workers=1))
+        try:
+            request = self._submit(socketPath, [ 'a' ])
+        finally:
+            self._stopPool(pid)
+        self.failUnlessEqual(request.wait(), 1)
+        self.failUnlessEqual(request.stdout.read(), "Permission denied\n")
+        self.failIf(os.path.exists(handled))
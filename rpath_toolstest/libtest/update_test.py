@@ -15,12 +15,18 @@
 #
 
 from conary import trovetup
+from conary import versions
 from lxml import etree
+import json
 import os
+import threading
+import time
 
 from rpath_toolstest import testbase
 
-from rpath_tools.lib import stored_objects, update
+from rpath_tools.lib import changesets, clientfactory, formatter, modelcache
+from rpath_tools.lib import stored_objects
+from rpath_tools.lib import scheduler, troveindex, update
 
 class UpdateTest(testbase.TestCaseRepo):
 
@@ -152,6 +158,240 @@ class UpdateTest(testbase.TestCaseRepo):
         self.assertTrue(len(downloadSize) == 1)
         self.assertEqual(job.state, "Previewed")
 
+    def testSyncModelDownloadSizeCached(self):
+        job = self.testSyncModelPreviewOperation()
+        downloadSize = job.downloadSize
+
+        # A second preview of the same model does not query the repository
+        def getChangeSetSize(*args, **kwargs):
+            raise AssertionError("changeset size should be cached")
+        self.mock(self._conaryClient.repos, 'getChangeSetSize',
+            getChangeSetSize)
+        job = self.newJob()
+        job.systemModel = "install group-bar=%s/2\n" % self.defLabel
+        operation = update.SyncModel()
+        operation.preview(job)
+        self.assertEqual(job.state, "Previewed")
+        self.assertEqual(job.downloadSize, downloadSize)
+
+    def testSyncModelPreviewCancelled(self):
+        def _prepareSyncUpdateJob(*args, **kwargs):
+            raise scheduler.TaskCancelled("Task cancelled")
+        self.mock(update.SyncModel, '_prepareSyncUpdateJob',
+            _prepareSyncUpdateJob)
+        recorded = []
+        class Metrics(object):
+            def __init__(slf, storagePath):
+                pass
+            def actionFinished(slf, action, state, duration, stages=()):
+                recorded.append((action, state))
+        self.mock(update.SyncModel, 'Metrics', Metrics)
+        job = self.newJob()
+        job.state = "Running"
+        # The cancellation reaches the task runner, which records it
+        self.assertRaises(scheduler.TaskCancelled,
+            update.SyncModel().preview, job)
+        self.assertEqual(job.state, "Running")
+        self.assertEqual(recorded,
+            [ ('prepareSyncUpdateJob', "Cancelled") ])
+
+    def testSyncModelPreviewReused(self):
+        job1 = self.testSyncModelPreviewOperation()
+
+        def _buildUpdateJob(*args, **kwargs):
+            raise AssertionError("preview should have been reused")
+        self.mock(update.SyncModel, '_buildUpdateJob', _buildUpdateJob)
+        job2 = self.testSyncModelPreviewOperation()
+        self.assertNotEqual(job1.keyId, job2.keyId)
+        self.assertEqual(job2.systemModel, job1.systemModel)
+        self.assertEqual(job2.downloadSize, job1.downloadSize)
+        self.assertTrue(os.path.exists(
+            os.path.join(job2.updateJobDir, 'jobfile')))
+
+        # Once the system changes, the preview is computed again
+        self.unmock()
+        self.updatePkg(["group-bar=2"])
+        job3 = self.newJob()
+        job3.systemModel = job1.systemModel
+        operation = update.SyncModel()
+        self.mock(update.SyncModel, '_reusePreview',
+            lambda *args: self.fail("should not match an earlier preview"))
+        preview = operation.preview(job3)
+        self.assertEqual(job3.state, "Previewed")
+
+    def testSyncModelPreviewSimplifyPolicies(self):
+        systemModel = "install group-bar=%s/2\n" % self.defLabel
+        self.assertEqual(update.SyncModel.simplifyPolicy,
+            update.SyncModel.SIMPLIFY_INLINE)
+        for policy, simplify in [
+                (update.SyncModel.SIMPLIFY_INLINE, False),
+                (update.SyncModel.SIMPLIFY_OFF, False),
+                (update.SyncModel.SIMPLIFY_CONCURRENT, False),
+                (update.SyncModel.SIMPLIFY_EXPLICIT, False),
+                (update.SyncModel.SIMPLIFY_EXPLICIT, True), ]:
+            self.mock(update.SyncModel, 'previewMemo', False)
+            self.mock(update.SyncModel, 'simplifyPolicy', policy)
+            job = self.newJob()
+            job.systemModel = systemModel
+            operation = update.SyncModel()
+            operation.flags.simplify = simplify
+            preview = operation.preview(job)
+            self.assertEqual(job.state, "Previewed")
+            self.assertEqual(etree.fromstring(preview).attrib['id'],
+                job.keyId)
+            self.assertTrue('resolve' in operation.timings)
+            self.assertEqual('simplify' in operation.timings,
+                policy in (update.SyncModel.SIMPLIFY_INLINE,
+                    update.SyncModel.SIMPLIFY_CONCURRENT) or simplify)
+            self.assertEqual(operation._simplification, None)
+            self.unmock()
+
+    def testSyncModelPreviewModelCacheShared(self):
+        self.mock(update.SyncModel, 'previewMemo', False)
+        systemModel = "install group-bar=%s/2\n" % self.defLabel
+        caches = []
+        for i in range(2):
+            job = self.newJob()
+            job.systemModel = systemModel
+            operation = update.SyncModel()
+            operation.preview(job)
+            self.assertEqual(job.state, "Previewed")
+            caches.append(operation._model_cache)
+        self.assertTrue(caches[0] is caches[1])
+
+    def testSyncModelPreviewModelCacheLazy(self):
+        self.mock(update.SyncModel, 'previewMemo', False)
+        systemModel = "install group-bar=%s/2\n" % self.defLabel
+        for i in range(2):
+            # Load the model cache from disk every time
+            modelcache.ModelCachePool.clearCache()
+            job = self.newJob()
+            job.systemModel = systemModel
+            operation = update.SyncModel()
+            operation.preview(job)
+            self.assertEqual(job.state, "Previewed")
+        path = operation._model_cache_path
+        self.assertTrue(os.path.exists(path + '.troves'))
+        self.assertTrue(isinstance(operation._model_cache,
+            modelcache.LazyTroveCache))
+        troves = operation._model_cache.cache
+        self.assertTrue(isinstance(troves, troveindex.LazyTroveDict))
+        self.assertTrue(len(troves.reader) > 1)
+
+        # Like trove tuples, lookups ignore version timestamps
+        name, version, flavor = troves.reader.keys()[0]
+        noTimeStamps = versions.VersionFromString(version.asString())
+        self.assertTrue((name, noTimeStamps, flavor) in troves.reader)
+        self.assertTrue((name, noTimeStamps, flavor) in troves)
+
+        # Entries of the index can be replaced and deleted
+        count = len(troves)
+        replaced, deleted = troves.reader.keys()[:2]
+        troves[replaced] = troves[replaced]
+        self.assertEqual(len(troves), count)
+        self.assertEqual(troves.keys().count(replaced), 1)
+        del troves[deleted]
+        self.assertFalse(deleted in troves)
+        self.assertRaises(KeyError, troves.__getitem__, deleted)
+        self.assertRaises(KeyError, troves.__delitem__, deleted)
+        self.assertEqual(troves.get(deleted), None)
+        self.assertFalse(deleted in troves.keys())
+        self.assertEqual(len(troves), count - 1)
+        modelcache.ModelCachePool().save(operation._model_cache, path)
+        reader = troveindex.TroveIndexReader(path + '.troves')
+        self.assertTrue(replaced in reader)
+        self.assertFalse(deleted in reader)
+        reader.close()
+
+    def testSyncModelModelCacheSharedByClients(self):
+        self.mock(update.SyncModel, 'previewMemo', False)
+        systemModel = "install group-bar=%s/2\n" % self.defLabel
+        caches = []
+        for i in range(2):
+            # Every preview gets a new conary client
+            clientfactory.ConaryClientFactory.clearCache()
+            job = self.newJob()
+            job.systemModel = systemModel
+            operation = update.SyncModel()
+            operation.preview(job)
+            self.assertEqual(job.state, "Previewed")
+            caches.append(operation._model_cache)
+        self.assertTrue(caches[0] is caches[1])
+
+    def testStreamingFormatter(self):
+        job = self.testSyncModelPreviewOperation()
+        operation = update.SyncModel()
+        updateJob, model = operation.thawSyncUpdateJob(job)
+        topLevelItems = operation._getTopLevelItems()
+        for uj in [ updateJob, None ]:
+            outputs = []
+            for klass in [ formatter.Formatter, formatter.StreamingFormatter ]:
+                preview = klass(uj)
+                preview.format()
+                for tli in topLevelItems:
+                    preview.addDesiredVersion(tli)
+                    preview.addObservedVersion(tli)
+                preview.addJobid(job.keyId)
+                preview.addDownloadSize(1234)
+                preview.setDownloaded(False)
+                outputs.append(preview.toxml())
+            self.assertEqual(outputs[0], outputs[1])
+
+    def testJsonPreview(self):
+        job = self.testSyncModelPreviewOperation()
+        self.assertEqual(json.loads(job.jsonContent),
+            json.loads(formatter.xmlToJson(job.content)))
+
+        operation = update.SyncModel()
+        updateJob, model = operation.thawSyncUpdateJob(job)
+        topLevelItems = operation._getTopLevelItems()
+        for uj in [ updateJob, None ]:
+            for klass in [ formatter.Formatter, formatter.StreamingFormatter ]:
+                preview = klass(uj)
+                preview.format()
+                for tli in topLevelItems:
+                    preview.addDesiredVersion(tli)
+                preview.addJobid(job.keyId)
+                preview.addDownloadSize(1234)
+                preview.setDownloaded(False)
+                self.assertEqual(json.loads(preview.tojson()),
+                    json.loads(formatter.xmlToJson(preview.toxml())))
+
+    def testPreviewSummary(self):
+        job = self.testSyncModelPreviewOperation()
+        tree = etree.fromstring(job.content)
+        summary = job.summary
+        types = [ x.text for x in tree.iterfind(
+            'conary_package_changes/conary_package_change/type') ]
+        for changeType in [ 'added', 'removed', 'changed' ]:
+            self.assertEqual(summary[changeType], types.count(changeType))
+        self.assertEqual(summary['downloadSize'], job.downloadSize)
+        self.assertEqual(summary['downloaded'], False)
+        self.assertEqual([ x['name'] for x in summary['topLevelItems'] ],
+            [ 'group-bar' ])
+        self.assertEqual(summary['topLevelItems'][0]['observed'],
+            tree.findtext('observed'))
+        self.assertEqual(summary['topLevelItems'][0]['desired'],
+            tree.findtext('desired'))
+
+    def testPreviewTimings(self):
+        job = self.testSyncModelPreviewOperation()
+        stages = dict((x['name'], x) for x in job.timings)
+        for name in [ 'topLevelItems', 'loadCache', 'cmlGraph', 'resolve',
+                'downloadSize', 'freeze', 'writePreview' ]:
+            self.assertTrue(stages[name]['seconds'] >= 0, name)
+        self.assertTrue(stages['resolve']['troves'] > 0)
+        self.assertEqual(stages['downloadSize']['bytes'], job.downloadSize)
+        self.assertEqual(etree.fromstring(job.content).find('timings'), None)
+
+        self.mock(update.SyncModel, 'previewTimings', True)
+        self.mock(update.SyncModel, 'previewMemo', False)
+        job = self.newJob()
+        job.systemModel = "install group-bar=%s/2\n" % self.defLabel
+        tree = etree.fromstring(update.SyncModel().preview(job))
+        self.assertTrue('resolve' in [ x.text for x in
+            tree.iterfind('timings/stage/name') ])
+
     def testSyncModelDownloadOperation(self):
         job = self.testSyncModelPreviewOperation()
         job_test = self.loadJob(job.keyId)
@@ -163,6 +403,48 @@ class UpdateTest(testbase.TestCaseRepo):
         self.assertTrue(tree.findtext('downloaded') == 'true')
         return job_test
 
+    def testSyncModelDownloadInterrupted(self):
+        job = self.testSyncModelPreviewOperation()
+        repos = self._conaryClient.repos
+        createChangeSetFile = repos.createChangeSetFile
+        def failingCreateChangeSetFile(*args, **kwargs):
+            raise IOError("connection reset")
+        self.mock(repos, 'createChangeSetFile', failingCreateChangeSetFile)
+        operation = update.SyncModel()
+        self.assertEqual(operation.download(self.loadJob(job.keyId)), None)
+        self.assertEqual(job.state, "Exception")
+
+        # The frozen job survived, so the download can be restarted
+        self.mock(repos, 'createChangeSetFile', createChangeSetFile)
+        job_test = self.loadJob(job.keyId)
+        preview = operation.download(job_test)
+        tree = etree.fromstring(preview)
+        self.assertEqual(job_test.state, "Downloaded")
+        self.assertTrue(tree.findtext('downloaded') == 'true')
+        self.assertTrue([ x for x in os.listdir(job_test.downloadDir)
+            if x.endswith('.ccs') ])
+
+    def testSyncModelDownloadShared(self):
+        job1 = self.testSyncModelDownloadOperation()
+
+        # Same update, different job: changesets come from the store
+        def createChangeSetFile(*args, **kwargs):
+            raise AssertionError("changeset should come from the store")
+        self.mock(self._conaryClient.repos, 'createChangeSetFile',
+            createChangeSetFile)
+        job2 = self.testSyncModelPreviewOperation()
+        operation = update.SyncModel()
+        operation.download(self.loadJob(job2.keyId))
+        job2 = self.loadJob(job2.keyId)
+        self.assertEqual(job2.state, "Downloaded")
+        csFiles = [ x for x in os.listdir(job2.downloadDir)
+            if x.endswith('.ccs') ]
+        self.assertTrue(csFiles)
+        for csFile in csFiles:
+            st1 = os.stat(os.path.join(job1.downloadDir, csFile))
+            st2 = os.stat(os.path.join(job2.downloadDir, csFile))
+            self.assertEqual(st1.st_ino, st2.st_ino)
+
     def testDuplicateDownload(self):
         job = self.testSyncModelDownloadOperation()
         job_test = self.loadJob(job.keyId)
@@ -310,3 +592,135 @@ class UpdateTest(testbase.TestCaseRepo):
                 # list. See the other test that's failing
                 [ self._trvAsString(group1) ])
         return job
+
+
+class ChangeSetDownloaderTest(testbase.TestCase):
+    class UpdateJob(object):
+        def __init__(self, jobs):
+            self.jobs = jobs
+            self.csList = None
+        def getJobs(self):
+            return self.jobs
+        def setJobsChangesetList(self, csList):
+            self.csList = csList
+
+    @classmethod
+    def _job(cls, host, name='foo:runtime', erase=False):
+        version = versions.VersionFromString('/%s@rpl:1/1-1-1' % host)
+        if erase:
+            return (name, (version, None), (None, None), False)
+        return (name, (None, None), (version, None), True)
+
+    def testCanDownload(self):
+        UpdateJob = self.UpdateJob
+        canDownload = changesets.ChangeSetDownloader.canDownload
+        self.assertTrue(canDownload(UpdateJob([ [ self._job('a.com') ] ])))
+        self.assertFalse(canDownload(UpdateJob([ [ self._job('a.com') ],
+            [ self._job('a.com', erase=True) ] ])))
+        self.assertFalse(canDownload(UpdateJob([ [ self._job('local') ] ])))
+
+    def testChangeSetStore(self):
+        store = changesets.ChangeSetStore(self.workDir + '/store',
+            maxSize=15)
+        src = self.workDir + '/src.ccs'
+        file(src, 'w').write('1' * 10)
+        store.add('ab12', src)
+        os.unlink(src)
+        dest = self.workDir + '/dest.ccs'
+        self.assertTrue(store.fetch('ab12', dest))
+        self.assertEqual(file(dest).read(), '1' * 10)
+        self.assertFalse(store.fetch('cd34', dest))
+
+        # Unchanged entries are not hashed again when reused
+        sha1 = store._sha1
+        store._sha1 = lambda path: self.fail("entry hashed again")
+        self.assertTrue(store.fetch('ab12', dest))
+        store._sha1 = sha1
+
+        # Damaged entries are dropped instead of being reused
+        file(dest, 'r+').write('2')
+        os.utime(dest, (0, 0))
+        os.unlink(dest)
+        self.assertFalse(store.fetch('ab12', dest))
+        self.assertFalse(os.path.exists(dest))
+        self.assertFalse(os.path.exists(store._entryPath('ab12')))
+
+        # Unreferenced entries are evicted, least recently used first
+        for digest in [ 'ef56', 'ab78' ]:
+            file(src, 'w').write('3' * 10)
+            store.add(digest, src)
+            os.unlink(src)
+            time.sleep(0.01)
+        self.assertEqual(store.evict(), 10)
+        self.assertFalse(store.fetch('ef56', dest))
+        self.assertTrue(store.fetch('ab78', dest))
+
+    def testPerHostConcurrency(self):
+        running = {}
+        maxRunning = {}
+        threads = {}
+        lock = threading.Lock()
+        class Repos(object):
+            def createChangeSetFile(slf, jobList, path, **kwargs):
+                hosts = changesets.ChangeSetDownloader._getHosts(jobList)
+                lock.acquire()
+                threads.setdefault(id(slf), set()).add(
+                    threading.currentThread())
+                for host in hosts:
+                    running[host] = running.get(host, 0) + 1
+                    maxRunning[host] = max(maxRunning.get(host, 0),
+                        running[host])
+                lock.release()
+                time.sleep(0.05)
+                lock.acquire()
+                for host in hosts:
+                    running[host] -= 1
+                lock.release()
+                file(path, 'w').write(jobList[0][0])
+
+        # Batches spanning several servers count against each of them
+        updateJob = self.UpdateJob([ [ self._job('a.com', str(i)) ]
+                for i in range(3) ]
+            + [ [ self._job('a.com', 'x%d' % i), self._job('b.com') ]
+                for i in range(3) ])
+        downloader = changesets.ChangeSetDownloader(Repos(),
+            self.workDir + '/download', createRepos=Repos)
+        csFiles = downloader.download(updateJob)
+        self.assertEqual(updateJob.csList, csFiles)
+        self.assertEqual(len(csFiles), 6)
+        self.assertEqual(maxRunning, { 'a.com' : 1, 'b.com' : 1 })
+        # Download threads do not share repository clients
+        self.assertEqual([ len(x) for x in threads.values() ],
+            [ 1 ] * len(threads))
+
+
+class ConaryClientFactoryTest(testbase.TestCase):
+    def testConfigChangeInvalidatesCache(self):
+        confDir = os.path.join(self.workDir, 'etc', 'conary')
+        os.makedirs(os.path.join(confDir, 'config.d'))
+        created = []
+        class Factory(clientfactory.ConaryClientFactory):
+            configPaths = [ confDir, confDir + '/config.d' ]
+            _cache = {}
+            def _newCfg(slf, readconfig, initflv):
+                created.append(readconfig)
+                return dict(count=len(created))
+
+        factory = Factory()
+        cfg = factory.getCfg()
+        self.assertEqual(cfg, dict(count=1))
+        # Every caller gets its own copy of the cached configuration
+        cfg['count'] = 0
+        self.assertEqual(factory.getCfg(), dict(count=1))
+        self.assertEqual(len(created), 1)
+
+        # Files added to or changed under the configuration directories
+        # invalidate the cache
+        extra = os.path.join(confDir, 'config.d', 'extra')
+        file(extra, 'w').write('flavor is: x86\n')
+        self.assertEqual(factory.getCfg(), dict(count=2))
+        file(extra, 'w').write('flavor is: x86_64\n')
+        self.assertEqual(factory.getCfg(), dict(count=3))
+        file(os.path.join(confDir, 'config'), 'w').write('\n')
+        self.assertEqual(factory.getCfg(), dict(count=4))
+        self.assertEqual(factory.getCfg(), dict(count=4))
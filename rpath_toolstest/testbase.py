@@ -24,6 +24,7 @@ from conary_test import rephelp
 from testrunner import testcase
 from testutils import mock
 from rpath_tools.lib import clientfactory, installation_service, jobs, update
+from rpath_tools.lib import modelcache
 
 
 class TestCase(testcase.TestCaseWithWorkDir):
@@ -49,6 +50,8 @@ class TestCaseRepo(rephelp.RepositoryHelper):
         self.storagePath = os.path.join(self.workDir, "storage")
         self.mock(installation_service.UpdateSet, "storagePath", self.storagePath)
         self.mock(jobs.BaseUpdateTask, "storagePath", self.storagePath)
+        # Don't reuse model caches loaded by earlier tests
+        modelcache.ModelCachePool.clearCache()
 
     def tearDown(self):
         rephelp.RepositoryHelper.tearDown(self)